@@ -0,0 +1,87 @@
+# Admission control of ballot ingestion.
+# Every stage of the ingestion admits a bounded number of requests at once. Requests over the limit are rejected
+# right away with a busy response that tells the client when to retry, instead of waiting in unbounded queues
+# until the client times out. So a surge of voters is spread over time rather than dropped.
+
+import threading
+from contextlib import contextmanager
+
+from protocol import ServerBusy
+
+# Stages of the ingestion.
+STAGE_CONNECTIONS = 'connections'
+STAGE_SESSIONS = 'sessions'
+STAGE_INGEST = 'ingest'
+STAGE_JOURNAL = 'journal'
+
+# Clients are asked to retry after this number of seconds by default.
+RETRY_AFTER = 1.0
+
+# Prefix of the metric names in the Prometheus text format.
+METRIC_PREFIX = 'legit_elections'
+
+
+class AdmissionStage(object):
+
+    # Constructor. Limit is the number of requests admitted at once.
+    def __init__(self, name, limit, retry_after=RETRY_AFTER):
+        self.name = name
+        self.limit = limit
+        self.retry_after = retry_after
+
+        self.depth = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    # Admits the request if the stage has a free place. Returns whether it was admitted.
+    def try_enter(self):
+        with self.lock:
+            if self.depth >= self.limit:
+                self.rejected += 1
+                return False
+
+            self.depth += 1
+            self.admitted += 1
+            return True
+
+    # Frees the place of the admitted request.
+    def leave(self):
+        with self.lock:
+            self.depth -= 1
+
+    # Runs the block as an admitted request. Raises ServerBusy if the stage is full.
+    @contextmanager
+    def admit(self):
+        if not self.try_enter():
+            raise ServerBusy(self.retry_after)
+        try:
+            yield
+        finally:
+            self.leave()
+
+
+# Returns state of the stages in the Prometheus text format.
+# Depths are depths of queues without admission limits, e.g. journal records waiting to be synced, as {stage: depth}.
+def prometheus_text(stages, depths=None):
+    lines = [
+        f'# HELP {METRIC_PREFIX}_queue_depth Number of requests in the stage.',
+        f'# TYPE {METRIC_PREFIX}_queue_depth gauge',
+    ]
+    for stage in stages:
+        lines.append(f'{METRIC_PREFIX}_queue_depth{{stage="{stage.name}"}} {stage.depth}')
+    for name, depth in (depths or {}).items():
+        lines.append(f'{METRIC_PREFIX}_queue_depth{{stage="{name}"}} {depth}')
+
+    families = [
+        ('queue_limit', 'gauge', 'limit', 'Number of requests admitted to the stage at once.'),
+        ('admitted_total', 'counter', 'admitted', 'Number of requests admitted to the stage.'),
+        ('rejected_total', 'counter', 'rejected', 'Number of requests rejected as busy by the stage.'),
+    ]
+    for metric, kind, field, description in families:
+        lines.append(f'# HELP {METRIC_PREFIX}_{metric} {description}')
+        lines.append(f'# TYPE {METRIC_PREFIX}_{metric} {kind}')
+        for stage in stages:
+            lines.append(f'{METRIC_PREFIX}_{metric}{{stage="{stage.name}"}} {getattr(stage, field)}')
+
+    return '\n'.join(lines) + '\n'
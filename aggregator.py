@@ -1,32 +1,194 @@
 # This is responsible for the aggregation of voting results.
 
+import multiprocessing
+import os
+import pickle
+import random
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
 import numpy as np
 
 from candidates import *
+from packing import packed_width, unpack_encrypted
+from cryptosystem import instrumentation
 from cryptosystem.encrypted_routine import *
 from cryptosystem.cryptosystem_utils import *
 from cryptosystem.cryptosystem_setup import *
 from cryptosystem.encryption import *
 from cryptosystem.decryption import *
 
+# Length of shard ids in bytes.
+SHARD_ID_SIZE = 16
+
 
 class Aggregator(object):
+    # Accumulation modes supported by add_vote.
+    # Homomorphic mode multiplies ciphertexts, which corresponds to adding the underlying plaintexts.
+    # Bitwise mode is the original path through bit extraction and addition gates, kept for comparison.
+    HOMOMORPHIC = 'homomorphic'
+    BITWISE = 'bitwise'
+
+    # Winner selection modes supported by aggregate.
+    # Tournament mode compares candidates in a knockout tree, all comparisons of a round in one batch.
+    # Sequential mode is the original chain of get_better_candidate calls, kept for comparison.
+    TOURNAMENT = 'tournament'
+    SEQUENTIAL = 'sequential'
+
+    # Bit extraction modes used by aggregate.
+    # Bounded mode extracts only the bits needed for the largest value possible for the number of ballots.
+    # It relies on every ballot adding at most 1 to every cell and exactly 1 to every row, so it must only be used
+    # when validity of every ballot is enforced, e.g. by validity proofs, and ballots are not packed.
+    # Full mode extracts all bits of values modulo n and is correct for any ballots.
+    BOUNDED = 'bounded'
+    FULL = 'full'
+
+    # Pairs of tiebreak values of candidates x and y compared by the additional tests.
+    TIEBREAK_PAIRS = [('x1', 'x2'), ('y1', 'y2'), ('x1', 'y1'), ('y1', 'x1'), ('x2', 'y2'), ('y2', 'x2')]
 
     # Constructor.
-    def __init__(self, encryptor, decryptor, rows, cols):
+    # If workers is greater than one, independent cells are evaluated in a pool of worker processes.
+    # If slot_width is provided, ballots packed into a single ciphertext with slots of this width are accepted.
+    # Shard is id of the votes accumulated by this aggregator in exported tallies, random if not provided.
+    def __init__(self, encryptor, decryptor, rows, cols, accumulation=HOMOMORPHIC, workers=1, selection=TOURNAMENT,
+                 extraction=FULL, slot_width=None, shard=None):
+        if accumulation not in (Aggregator.HOMOMORPHIC, Aggregator.BITWISE):
+            raise Exception(f'Unknown accumulation mode: {accumulation}')
+        if selection not in (Aggregator.TOURNAMENT, Aggregator.SEQUENTIAL):
+            raise Exception(f'Unknown selection mode: {selection}')
+        if extraction not in (Aggregator.BOUNDED, Aggregator.FULL):
+            raise Exception(f'Unknown extraction mode: {extraction}')
+
         self.encryptor = encryptor
         self.decryptor = decryptor
+        self.accumulation = accumulation
+        self.selection = selection
+        self.extraction = extraction
+
+        self.workers = workers
+        self.executor = None
+
+        # Number of accumulated ballots.
+        self.ballots = 0
+
+        # Ids of the shards merged into the tally, so that no tally is merged twice.
+        self.shard = shard if shard is not None else os.urandom(SHARD_ID_SIZE)
+        self.merged_shards = set()
+
+        self.matrix = np.array(encryptor.encrypt_many([0] * (rows * cols)), dtype=object).reshape(rows, cols)
+
+        # Packed ballots are accumulated separately and unpacked into the matrix before they are needed.
+        self.slot_width = slot_width
+        self.packed = encryptor.encrypt(0)
+        self.packed_ballots = 0
 
-        self.matrix = np.array([encryptor.encrypt(0) for i in range(rows * cols)], dtype=object).reshape(rows, cols)
+        self.reset_selection_cache()
 
     # Add votes to current matrix.
     def add_vote(self, data):
+        data = np.array(data, dtype=object)
+        if self.matrix.shape != data.shape:
+            raise Exception(f'Vote has shape {data.shape}, expected {self.matrix.shape}')
+
+        if self.accumulation == Aggregator.HOMOMORPHIC:
+            self.add_vote_homomorphic(data)
+        else:
+            self.add_vote_bitwise(data)
+
+        self.ballots += 1
+
+    # Adds ballot packed into a single ciphertext by packing.encrypt_packed. Costs one multiplication.
+    def add_packed_vote(self, ciphertext, shape, slot_width):
+        if self.slot_width is None:
+            raise Exception('Packed ballots are not accepted')
+        if tuple(shape) != self.matrix.shape or slot_width != self.slot_width:
+            raise Exception(f'Packed vote has shape {tuple(shape)} and slots of {slot_width} bits, '
+                            f'expected {self.matrix.shape} and {self.slot_width} bits')
+
+        # Slots would overflow with the next ballot.
+        if self.packed_ballots == (1 << self.slot_width) - 1:
+            self.unpack_votes()
+
         modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
+        self.packed = (self.packed * ciphertext) % modulo
+        self.packed_ballots += 1
+        self.ballots += 1
 
-        data = np.array(data, dtype=object)
-        n, m = self.matrix.shape
-        assert (n, m) == data.shape
+    # Unpacks accumulated packed ballots into the matrix: bits of the packed value are extracted once,
+    # and bits of every slot are combined into the encrypted value of its cell.
+    def unpack_votes(self):
+        if self.packed_ballots == 0:
+            return
+
+        modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
+        rows, cols = self.matrix.shape
+        bound = (1 << packed_width(rows, cols, self.slot_width)) - 1
+
+        bits = bounded_bit_extraction_gate(self.packed, bound, self.encryptor, self.decryptor)
+        values = unpack_encrypted(bits, rows * cols, self.slot_width, modulo)
+        self.add_vote_homomorphic(np.array(values, dtype=object).reshape(rows, cols))
+
+        self.packed = self.encryptor.encrypt(0)
+        self.packed_ballots = 0
+
+    # Returns accumulated votes as (ballots, matrix, shards), so that they can be merged into aggregator on another
+    # node. Shards are ids of this aggregator and of all tallies merged into it.
+    def export_tally(self):
+        self.unpack_votes()
+        return self.ballots, self.matrix.tolist(), [self.shard] + sorted(self.merged_shards)
+
+    # Merges votes accumulated by another node. Both nodes must use the same keys.
+    # Raises if any of the shards has already been merged, since its votes would be counted twice.
+    def merge_tally(self, ballots, matrix, shards):
+        shards = set(shards)
+        if self.shard in shards or not self.merged_shards.isdisjoint(shards):
+            raise Exception('Tally has already been merged')
+        if self.extraction == Aggregator.BOUNDED:
+            self.check_tally_ballots(ballots, matrix)
+
+        self.add_tally(ballots, matrix)
+        self.merged_shards.update(shards)
+
+    # Raises if any row of the tally does not add up to its number of ballots, as every row of valid ballots adds
+    # exactly 1. Bounded extraction takes its width from the number of ballots, so a tally reporting fewer ballots
+    # than it holds would break the extraction. Only row totals are decrypted, they reveal nothing but the number.
+    def check_tally_ballots(self, ballots, matrix):
+        modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
+        totals = []
+        for row in matrix:
+            total = 1
+            for value in row:
+                total = (total * value) % modulo
+            totals.append(total)
+
+        if any(total != ballots for total in self.decryptor.decrypt_many(totals)):
+            raise Exception(f'Tally of {ballots} ballots has rows that do not add up to it')
+
+    # Restores votes exported by this aggregator, e.g. from a snapshot written before a restart.
+    def restore_tally(self, ballots, matrix, shards):
+        self.add_tally(ballots, matrix)
+        self.merged_shards.update(shard for shard in shards if shard != self.shard)
+
+    # Adds accumulated votes to the tally.
+    def add_tally(self, ballots, matrix):
+        data = np.array(matrix, dtype=object)
+        if self.matrix.shape != data.shape:
+            raise Exception(f'Tally has shape {data.shape}, expected {self.matrix.shape}')
+
+        self.add_vote_homomorphic(data)
+        self.ballots += ballots
+
+    # Adds votes by multiplying ciphertexts, one modular multiplication per cell.
+    def add_vote_homomorphic(self, data):
+        modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
+
+        self.matrix = (self.matrix * data) % modulo
+
+    # Adds votes bit by bit using addition gate.
+    def add_vote_bitwise(self, data):
+        modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
 
+        n, m = self.matrix.shape
         for i in range(n):
             for j in range(m):
                 x, y = prepare_different_arrays(
@@ -40,30 +202,39 @@ class Aggregator(object):
     # Aggregate the votes.
     def aggregate(self):
         print('Aggregation started...')
-        start = time.clock()
+        start = time.perf_counter()
 
+        self.unpack_votes()
         n, m = self.matrix.shape
+        self.reset_selection_cache()
 
         # Create candidate matrix.
-        c = self.create_candidate_matrix(self.matrix)
+        with instrumentation.stage(instrumentation.STAGE_CANDIDATE_MATRIX):
+            c = self.create_candidate_matrix(self.matrix)
 
-        print(f'All up to candidate matrix creation took: {time.clock() - start}')
+        print(f'All up to candidate matrix creation took: {time.perf_counter() - start}')
 
         # Create grade vector.
-        g = self.create_grade_vector(c)
+        with instrumentation.stage(instrumentation.STAGE_GRADE_VECTOR):
+            g = self.create_grade_vector(c)
 
-        print(f'All up to grade vector creation took: {time.clock() - start}')
+        print(f'All up to grade vector creation took: {time.perf_counter() - start}')
 
         # Create tiebreak matrix.
-        t = self.create_tiebreak_matrix(self.matrix, g)
+        with instrumentation.stage(instrumentation.STAGE_TIEBREAK):
+            t = self.create_tiebreak_matrix(self.matrix, g)
 
-        print(f'All up to tiebreak matrix creation took: {time.clock() - start}')
+        print(f'All up to tiebreak matrix creation took: {time.perf_counter() - start}')
 
-        winner = 0
-        for i in range(1, n):
-            winner = self.get_better_candidate(winner, i, c, t)
+        with instrumentation.stage(instrumentation.STAGE_COMPARISON):
+            if self.selection == Aggregator.TOURNAMENT:
+                winner = self.select_winner_tournament(c, t)
+            else:
+                winner = 0
+                for i in range(1, n):
+                    winner = self.get_better_candidate(winner, i, c, t)
 
-        print(f'Finished. Full aggregation took: {time.clock() - start}')
+        print(f'Finished. Full aggregation took: {time.perf_counter() - start}')
 
         return winner
 
@@ -72,30 +243,75 @@ class Aggregator(object):
         n, m = aggregated_matrix.shape
         c = np.zeros((n, m), dtype=object)
 
-        for i in range(n):
-            row_total = self.array_sum(aggregated_matrix[i, 0:(m + 1)])
-            bitwise_row_total = bit_extraction_gate(row_total, self.encryptor, self.decryptor)
+        # Prefix sums are computed homomorphically once per row, the last one is the row total.
+        prefix_sums = [self.prefix_sums(aggregated_matrix[i]) for i in range(n)]
 
-            for j in range(m):
-                left = self.array_sum(aggregated_matrix[i, 0:j], aggregated_matrix[i, 0:j])
-                bitwise_left = bit_extraction_gate(left, self.encryptor, self.decryptor)
+        with self.parallel():
+            rows = self.map_batches('candidate_matrix_rows', prefix_sums, self.ballots)
 
-                left, total = prepare_similar_arrays(bitwise_left, bitwise_row_total, self.encryptor)
-                c[i, j] = greater_than_gate(total, left, self.encryptor, self.decryptor)
+        for i in range(n):
+            for j in range(m):
+                c[i, j] = rows[i][j]
 
         return c
 
+    # Calculates rows of candidate matrix from prefix sums of the rows.
+    # Cell j is 1 if row total is greater than the doubled sum of first j values.
+    # All rows are processed by batched gates together.
+    # Row totals are equal to the number of ballots, doubled sums are not greater than twice that.
+    def candidate_matrix_rows(self, prefix_sums, ballots):
+        modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
+
+        values, bounds = [], []
+        for sums in prefix_sums:
+            values.extend(powmod(left, 2, modulo) for left in sums[:-1])
+            values.append(sums[-1])
+            bounds.extend([2 * ballots] * (len(sums) - 1) + [ballots])
+        bitwise_values = self.extract_bits(values, bounds)
+
+        # Pad all values of a row to the same width, then compare the row total with every left sum at once.
+        totals, lefts = [], []
+        offset = 0
+        for sums in prefix_sums:
+            m = len(sums) - 1
+            row = pad_bit_arrays(bitwise_values[offset:offset + m + 1], self.encryptor)
+            lefts.extend(row[:m])
+            totals.extend([row[m]] * m)
+            offset += m + 1
+
+        cells = greater_than_gate_many(totals, lefts, self.encryptor, self.decryptor)
+
+        rows = []
+        offset = 0
+        for sums in prefix_sums:
+            m = len(sums) - 1
+            rows.append(cells[offset:offset + m])
+            offset += m
+
+        return rows
+
+    # Calculates encrypted prefix sums of the row. Element j of the result is the sum of first j values.
+    def prefix_sums(self, row):
+        modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
+
+        sums = [self.encryptor.encrypt(0)]
+        for value in row:
+            sums.append((sums[-1] * value) % modulo)
+
+        return sums
+
     # Creates grade vector.
+    # Columns are independent, so row i of all columns is processed in one decryption round.
     def create_grade_vector(self, candidate_matrix):
         n, m = candidate_matrix.shape
         g = np.zeros(m, dtype=object)
 
-        for j in range(m):
-            encrypted_res = self.encryptor.encrypt(1)
-            for i in range(n):
-                encrypted_res = conditional_gate(encrypted_res, candidate_matrix[i, j], self.decryptor)
+        encrypted_res = self.encryptor.encrypt_many([1] * m)
+        for i in range(n):
+            encrypted_res = conditional_gate_many(encrypted_res, list(candidate_matrix[i]), self.decryptor)
 
-            g[j] = encrypted_res
+        for j in range(m):
+            g[j] = encrypted_res[j]
 
         return g
 
@@ -104,12 +320,76 @@ class Aggregator(object):
         n, m = aggregated_matrix.shape
         t = np.zeros((n, 2), dtype=object)
 
+        with self.parallel():
+            rows = self.map_batches('tiebreak_rows', [list(aggregated_matrix[i]) for i in range(n)], list(grade_vector))
+
         for i in range(0, n):
-            t[i, 0] = self.linear_combination(self.matrix[i], grade_vector, reverse=False)
-            t[i, 1] = self.linear_combination(self.matrix[i], grade_vector, reverse=True)
+            t[i, 0], t[i, 1] = rows[i]
 
         return t
 
+    # Calculates rows of tiebreak matrix. All conditional gates are resolved in one decryption round.
+    def tiebreak_rows(self, rows, grade_vector):
+        xs, ys, lengths = [], [], []
+        for row in rows:
+            for reverse in (False, True):
+                x, y = self.linear_combination_terms(row, grade_vector, reverse)
+                xs.extend(x)
+                ys.extend(y)
+                lengths.append(len(x))
+
+        products = conditional_gate_many(xs, ys, self.decryptor)
+
+        sums = []
+        offset = 0
+        for length in lengths:
+            sums.append(self.encrypted_sum(products[offset:offset + length]))
+            offset += length
+
+        return [(sums[2 * i], sums[2 * i + 1]) for i in range(len(rows))]
+
+    # Opens pool of worker processes for the duration of the block, unless it is already open or not needed.
+    @contextmanager
+    def parallel(self):
+        if self.workers <= 1 or self.executor is not None:
+            yield
+            return
+
+        # Workers are spawned rather than forked: the server runs threads that may hold locks at fork time,
+        # and a forked child would wait for such lock forever.
+        state = pickle.dumps((self.encryptor, self.decryptor, self.extraction, instrumentation.enabled))
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_worker, initargs=(state,)) as executor:
+            self.executor = executor
+            try:
+                yield
+            finally:
+                self.executor = None
+
+    # Calls the method for every tuple of arguments, in worker processes if the pool is open.
+    # Instrumentation counters of the workers are added to the current stage.
+    def map(self, method, arguments):
+        if self.executor is None:
+            return [getattr(self, method)(*args) for args in arguments]
+
+        results = []
+        for result, counters in self.executor.map(call_worker, [method] * len(arguments), arguments):
+            instrumentation.merge(counters)
+            results.append(result)
+
+        return results
+
+    # Calls the method that processes a list of items and returns a list of results.
+    # Without the pool all items are processed in one call, so batched gates see all of them at once.
+    # With the pool items are split into one chunk per worker.
+    def map_batches(self, method, items, *args):
+        if self.executor is None:
+            return getattr(self, method)(items, *args)
+
+        size = -(-len(items) // self.workers)
+        chunks = [(items[i:i + size],) + args for i in range(0, len(items), size)]
+        return [result for results in self.map(method, chunks) for result in results]
+
     # Adds encrypted array.
     def array_sum(self, x, y=[]):
         modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
@@ -126,107 +406,188 @@ class Aggregator(object):
 
     # Computes sum(x[i] * g[i]) or sum(x[n - i] * g[i]) depending on the reverse parameter.
     def linear_combination(self, x, g, reverse=False):
-        modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
+        return self.encrypted_sum(conditional_gate_many(*self.linear_combination_terms(x, g, reverse), self.decryptor))
 
-        encrypted_result = self.encryptor.encrypt(0)
+    # Returns arguments of conditional gates which products are summed up by linear_combination.
+    def linear_combination_terms(self, x, g, reverse=False):
+        modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
 
         if not reverse:
-            for i in range(len(x)):
-                cur_result = conditional_gate(x[i], g[i], self.decryptor)
-                encrypted_result = self.add_encrypted(encrypted_result, cur_result, modulo)
+            return list(x), list(g)
 
-        else:
-            for i in range(1, len(x)):
-                cur_result = (self.encryptor.encrypt(1) * invmod(g[i - 1], modulo)) % modulo
-                cur_result = conditional_gate(x[i], cur_result, self.decryptor)
+        inverses = batch_invmod(list(g[:len(x) - 1]), modulo)
+        return list(x[1:]), [(self.encryptor.encrypt(1) * inverse) % modulo for inverse in inverses]
 
-                encrypted_result = self.add_encrypted(encrypted_result, cur_result, modulo)
+    # Adds encrypted values by multiplying them.
+    def encrypted_sum(self, values):
+        modulo = self.encryptor.public_key[0] * self.encryptor.public_key[0]
+
+        encrypted_result = self.encryptor.encrypt(0)
+        for value in values:
+            encrypted_result = (encrypted_result * value) % modulo
 
         return encrypted_result
 
     # Picks better candidate between the two. If all fields are equal picks first candidate.
     def get_better_candidate(self, winner, potential, candidate_matrix, t):
-        index_w = self.get_first_zero_index(candidate_matrix[winner])
-        index_p = self.get_first_zero_index(candidate_matrix[potential])
+        index_w, index_p = self.cached_first_zero_indices([winner, potential], candidate_matrix)
 
         if index_w < index_p:
             return winner
         elif index_p < index_w:
             return potential
 
-        # Convert to bit representations.
-        bitwise_w_one = bit_extraction_gate(t[winner, 0], self.encryptor, self.decryptor)
-        bitwise_w_two = bit_extraction_gate(t[winner, 1], self.encryptor, self.decryptor)
-        bitwise_p_one = bit_extraction_gate(t[potential, 0], self.encryptor, self.decryptor)
-        bitwise_p_two = bit_extraction_gate(t[potential, 1], self.encryptor, self.decryptor)
-
-        bitwise_w_one, bitwise_w_two = prepare_similar_arrays(bitwise_w_one, bitwise_w_two, self.encryptor)
-        bitwise_p_one, bitwise_p_two = prepare_similar_arrays(bitwise_p_one, bitwise_p_two, self.encryptor)
-        bitwise_w_one, bitwise_p_one = prepare_similar_arrays(bitwise_w_one, bitwise_p_one, self.encryptor)
-        bitwise_w_two, bitwise_p_two = prepare_similar_arrays(bitwise_w_two, bitwise_p_two, self.encryptor)
-
-        return self.additional_tests_winner(winner, potential,
-                                            bitwise_w_one, bitwise_w_two,
-                                            bitwise_p_one, bitwise_p_two)
+        gt = self.compare_candidate_tiebreaks([(winner, potential)], t)[0]
+        return self.tests_winner(gt, winner, potential)
+
+    # Picks the winner in a knockout tree: candidates are paired up, the better one of every pair goes to the
+    # next round. Comparisons of a round do not depend on each other, so they are evaluated in one batch.
+    # Equal candidates are resolved in favour of the earlier one, like in get_better_candidate.
+    def select_winner_tournament(self, candidate_matrix, t):
+        candidates = list(range(candidate_matrix.shape[0]))
+        indices = self.cached_first_zero_indices(candidates, candidate_matrix)
+
+        while len(candidates) > 1:
+            pairs = [(candidates[i], candidates[i + 1]) for i in range(0, len(candidates) - 1, 2)]
+            tied = [(x, y) for x, y in pairs if indices[x] == indices[y]]
+            comparisons = self.compare_candidate_tiebreaks(tied, t)
+            tiebreak_winners = {pair: self.tests_winner(gt, *pair) for pair, gt in zip(tied, comparisons)}
+
+            winners = []
+            for x, y in pairs:
+                if indices[x] != indices[y]:
+                    winners.append(x if indices[x] < indices[y] else y)
+                else:
+                    winners.append(tiebreak_winners[x, y])
+            if len(candidates) % 2 == 1:
+                winners.append(candidates[-1])
+
+            candidates = winners
+
+        return candidates[0]
+
+    # Clears values cached by winner selection. They are valid only for the aggregation they were computed in.
+    def reset_selection_cache(self):
+        # Indices of the first zeros in the rows of candidate matrix, keyed by candidate.
+        self.first_zero_indices = {}
+
+        # Bit representations of tiebreak values, keyed by (candidate, column of tiebreak matrix).
+        self.bitwise_tiebreaks = {}
+
+        # Decrypted results of greater than gate, keyed by pairs of keys of bitwise_tiebreaks.
+        self.tiebreak_comparisons = {}
+
+    # Gets indices of the first zeros in the rows of candidates. Every row is decrypted at most once.
+    def cached_first_zero_indices(self, candidates, candidate_matrix):
+        missing = [k for k in candidates if k not in self.first_zero_indices]
+        if len(missing) > 0:
+            m = candidate_matrix.shape[1]
+            values = self.decryptor.decrypt_many([candidate_matrix[k, j] for k in missing for j in range(m)])
+            for position, k in enumerate(missing):
+                self.first_zero_indices[k] = self.first_zero_index(values[position * m:(position + 1) * m])
+
+        return [self.first_zero_indices[k] for k in candidates]
+
+    # Compares tiebreak values of pairs of candidates. Every bit extraction and comparison is done at most once,
+    # all missing ones in one batch. Returns results keyed like the ones of compare_tiebreaks.
+    def compare_candidate_tiebreaks(self, pairs, t):
+        names = [{'x1': (x, 0), 'x2': (x, 1), 'y1': (y, 0), 'y2': (y, 1)} for x, y in pairs]
+        keys = [{(a, b): (values[a], values[b]) for a, b in Aggregator.TIEBREAK_PAIRS} for values in names]
+
+        missing = sorted(set(key for pair_keys in keys for key in pair_keys.values()) - set(self.tiebreak_comparisons))
+        self.extract_tiebreaks(sorted(set(value for key in missing for value in key)), t)
+
+        # Arrays of a comparison are padded to the same length, trailing zeros do not change the result.
+        padded = [pad_bit_arrays([self.bitwise_tiebreaks[a], self.bitwise_tiebreaks[b]], self.encryptor)
+                  for a, b in missing]
+        results = greater_than_gate_many([a for a, b in padded], [b for a, b in padded], self.encryptor, self.decryptor)
+        self.tiebreak_comparisons.update(zip(missing, self.decryptor.decrypt_many(results)))
+
+        return [{name: self.tiebreak_comparisons[key] for name, key in pair_keys.items()} for pair_keys in keys]
+
+    # Extracts bit representations of tiebreak values that are not extracted yet, in one batch.
+    # Tiebreak values are sums of parts of a row, so they are not greater than the number of ballots.
+    def extract_tiebreaks(self, values, t):
+        missing = [value for value in values if value not in self.bitwise_tiebreaks]
+        bitwise = self.extract_bits([t[value] for value in missing], [self.ballots] * len(missing))
+        self.bitwise_tiebreaks.update(zip(missing, bitwise))
+
+    # Extracts bit representations of the values not greater than the bounds with the extraction mode.
+    def extract_bits(self, values, bounds):
+        if self.extraction == Aggregator.BOUNDED:
+            return bounded_bit_extraction_gate_many(values, bounds, self.encryptor, self.decryptor)
+
+        return bit_extraction_gate_many(values, self.encryptor, self.decryptor)
 
     # Applies additional tests to determine winner between two candidates.
     def additional_tests_winner(self, x, y, bitwise_x_one, bitwise_x_two, bitwise_y_one, bitwise_y_two):
+        gt = self.compare_tiebreaks(bitwise_x_one, bitwise_x_two, bitwise_y_one, bitwise_y_two)
+        return self.tests_winner(gt, x, y)
+
+    # Applies additional tests to the results of compare_tiebreaks to determine winner between two candidates.
+    def tests_winner(self, gt, x, y):
         # Apply second test.
-        if self.better_second_test(bitwise_x_one, bitwise_x_two, bitwise_y_one, bitwise_y_two):
+        if self.better_second_test(gt, 'x', 'y'):
             return x
-        elif self.better_second_test(bitwise_y_one, bitwise_y_two, bitwise_x_one, bitwise_x_two):
+        elif self.better_second_test(gt, 'y', 'x'):
             return y
 
         # Apply third test if second test can't determine the winner.
-        if self.better_third_test(bitwise_x_one, bitwise_x_two, bitwise_y_one, bitwise_y_two):
+        if self.better_third_test(gt, 'x', 'y'):
             return x
-        elif self.better_third_test(bitwise_y_one, bitwise_y_two, bitwise_x_one, bitwise_x_two):
+        elif self.better_third_test(gt, 'y', 'x'):
             return y
 
         # Apply fourth test if previous tests can't determine the winner.
-        if self.better_fourth_test(bitwise_x_one, bitwise_x_two, bitwise_y_one, bitwise_y_two):
+        if self.better_fourth_test(gt, 'x', 'y'):
             return x
-        elif self.better_fourth_test(bitwise_y_one, bitwise_y_two, bitwise_x_one, bitwise_x_two):
+        elif self.better_fourth_test(gt, 'y', 'x'):
             return y
 
         # Candidates are equal. Return x.
         return x
 
+    # Compares tiebreak values of two candidates with each other in one batch.
+    # Returns decrypted results of greater than gate keyed by pairs of value names, e.g. gt['x1', 'y1'].
+    def compare_tiebreaks(self, bitwise_x_one, bitwise_x_two, bitwise_y_one, bitwise_y_two):
+        return self.compare_tiebreaks_many([(bitwise_x_one, bitwise_x_two, bitwise_y_one, bitwise_y_two)])[0]
+
+    # Batched compare_tiebreaks. Accepts list of (x1, x2, y1, y2) tuples of bit arrays of the same length.
+    def compare_tiebreaks_many(self, tiebreaks):
+        pairs = Aggregator.TIEBREAK_PAIRS
+
+        lefts, rights = [], []
+        for tiebreak in tiebreaks:
+            values = dict(zip(('x1', 'x2', 'y1', 'y2'), tiebreak))
+            lefts.extend(values[a] for a, b in pairs)
+            rights.extend(values[b] for a, b in pairs)
+
+        results = self.decryptor.decrypt_many(greater_than_gate_many(lefts, rights, self.encryptor, self.decryptor))
+        return [dict(zip(pairs, results[i:i + len(pairs)])) for i in range(0, len(results), len(pairs))]
+
     # Applies second test to determine better candidate between the two.
-    def better_second_test(self, bitwise_x_one, bitwise_x_two, bitwise_y_one, bitwise_y_two):
-        first = self.decryptor.decrypt(
-            greater_than_gate(bitwise_x_one, bitwise_x_two, self.encryptor, self.decryptor)) == 1
-        second = self.decryptor.decrypt(
-            greater_than_gate(bitwise_y_one, bitwise_y_two, self.encryptor, self.decryptor)) == 0
-        return first and second
+    def better_second_test(self, gt, x, y):
+        return gt[x + '1', x + '2'] == 1 and gt[y + '1', y + '2'] == 0
 
     # Applies third test to determine better candidate between the two.
-    def better_third_test(self, bitwise_x_one, bitwise_x_two, bitwise_y_one, bitwise_y_two):
-        first = self.decryptor.decrypt(
-            greater_than_gate(bitwise_x_one, bitwise_x_two, self.encryptor, self.decryptor)) == 1
-        second = self.decryptor.decrypt(
-            greater_than_gate(bitwise_y_one, bitwise_y_two, self.encryptor, self.decryptor)) == 1
-        third = self.decryptor.decrypt(
-            greater_than_gate(bitwise_x_one, bitwise_y_one, self.encryptor, self.decryptor)) == 1
-        return first and second and third
+    def better_third_test(self, gt, x, y):
+        return gt[x + '1', x + '2'] == 1 and gt[y + '1', y + '2'] == 1 and gt[x + '1', y + '1'] == 1
 
     # Applies fourth test to determine better candidate between the two.
-    def better_fourth_test(self, bitwise_x_one, bitwise_x_two, bitwise_y_one, bitwise_y_two):
-        first = self.decryptor.decrypt(
-            greater_than_gate(bitwise_x_one, bitwise_x_two, self.encryptor, self.decryptor)) == 0
-        second = self.decryptor.decrypt(
-            greater_than_gate(bitwise_y_one, bitwise_y_two, self.encryptor, self.decryptor)) == 0
-        third = self.decryptor.decrypt(
-            greater_than_gate(bitwise_y_two, bitwise_x_two, self.encryptor, self.decryptor)) == 1
-        return first and second and third
+    def better_fourth_test(self, gt, x, y):
+        return gt[x + '1', x + '2'] == 0 and gt[y + '1', y + '2'] == 0 and gt[y + '2', x + '2'] == 1
 
     # Gets index of the first zero in a row of the matrix c.
     def get_first_zero_index(self, candidate_matrix_row):
-        for i in range(len(candidate_matrix_row)):
-            if self.decryptor.decrypt(candidate_matrix_row[i]) == 0:
+        return self.first_zero_index(self.decryptor.decrypt_many(list(candidate_matrix_row)))
+
+    # Gets index of the first zero in a decrypted row of the matrix c.
+    def first_zero_index(self, row):
+        for i in range(len(row)):
+            if row[i] == 0:
                 return i
 
-        return len(candidate_matrix_row) - 1
+        return len(row) - 1
 
     # Adds encrypted and unencrypted numbers.
     def add_encrypted(self, encrypted_x, unencrypted_y, modulo):
@@ -238,3 +599,28 @@ class Aggregator(object):
 
         return to_number(
             addition_gate(left, right, self.encryptor, self.decryptor), modulo, self.encryptor, self.decryptor)
+
+
+# Aggregator used by the worker process. It holds only encryptor and decryptor, without votes.
+worker_aggregator = None
+
+
+# Initializes worker process of Aggregator.parallel.
+def init_worker(state):
+    global worker_aggregator
+
+    # Workers must not pick the same random values, so every one is reseeded.
+    random.seed()
+
+    encryptor, decryptor, extraction, instrumented = pickle.loads(state)
+    worker_aggregator = Aggregator(encryptor, decryptor, 0, 0, extraction=extraction)
+
+    # Counters of the worker are collected after every call, starting from zero.
+    if instrumented:
+        instrumentation.enable()
+        instrumentation.reset()
+
+
+# Calls method of the worker aggregator. Returns the result and instrumentation counters of the call.
+def call_worker(method, args):
+    return getattr(worker_aggregator, method)(*args), instrumentation.collect()
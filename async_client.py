@@ -0,0 +1,164 @@
+import asyncio
+import random
+from contextlib import asynccontextmanager
+
+from client import (Client, BallotUnconfirmed, RETRY_ATTEMPTS, RETRY_DELAY, ballot_frame, text_ballot,
+                    votes_to_matrix, encrypt_matrix)
+from cryptosystem.encryption import Encryptor
+from protocol import *
+
+
+# Asyncio implementation of Client speaking the same KEY/DATA/NAMES protocol.
+class AsyncClient:
+    KEY_REQUEST = Client.KEY_REQUEST
+    DATA_REQUEST = Client.DATA_REQUEST
+    NAMES_REQUEST = Client.NAMES_REQUEST
+    SUCCESS = Client.SUCCESS
+    ERROR = Client.ERROR
+
+    # If binary is set, keys and votes are transferred in binary frames instead of text.
+    # If token is set, it is the voter credential sent with the ballot.
+    def __init__(self, server_ip="127.0.0.1", server_port=9999, binary=False, token=None):
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.binary = binary
+        self.token = token
+        self.keys = None
+
+        self.reader = None
+        self.writer = None
+        self.pending_data_send = False
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.server_ip, self.server_port)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.reader = None
+        self.writer = None
+
+    # Drops the connection and the pending ballot.
+    async def abort(self):
+        self.pending_data_send = False
+        await self.close()
+
+    # Reads response frame of the expected type. If the server is busy, drops the connection and raises ServerBusy.
+    async def read_response(self, frame_type):
+        try:
+            return expect_frame(await read_frame_async(self.reader), frame_type)
+        except ServerBusy:
+            await self.abort()
+            raise
+
+    # Raises ServerBusy if the text response is the busy response, dropping the connection first.
+    # Overloaded server may also close the connection without any response.
+    async def check_busy(self, response):
+        if len(response) == 0:
+            await self.abort()
+            raise ConnectionResetError('Server closed the connection')
+        try:
+            check_busy_text(response)
+        except ServerBusy:
+            await self.abort()
+            raise
+
+    # Runs the block that sends the ballot and reads the response, like Client.confirming.
+    @asynccontextmanager
+    async def confirming(self):
+        try:
+            yield
+        except (OSError, asyncio.IncompleteReadError, ProtocolError) as e:
+            if self.writer is not None:
+                await self.abort()
+            raise BallotUnconfirmed('Connection was lost after the ballot was sent') from e
+
+    async def request_names(self):
+        await self.connect()
+        assert self.pending_data_send == False
+        self.writer.write(AsyncClient.NAMES_REQUEST)
+        response = await self.reader.read(4096)
+        await self.check_busy(response)
+        assert response.startswith(AsyncClient.NAMES_REQUEST)
+        # Status may arrive in the same packet as the names.
+        if response.endswith(AsyncClient.SUCCESS):
+            response = response[:-len(AsyncClient.SUCCESS)]
+        else:
+            await self.reader.read(4096)
+        await self.close()
+        return response[len(AsyncClient.NAMES_REQUEST):].decode("utf-8").split("\n")
+
+    async def request_keys(self):
+        await self.connect()
+        assert self.pending_data_send == False
+        if self.binary:
+            self.writer.write(BINARY_KEY_REQUEST)
+            self.keys = decode_key(await self.read_response(FRAME_KEY))
+            self.pending_data_send = True
+            return self.keys
+
+        self.writer.write(AsyncClient.KEY_REQUEST)
+        response = await self.reader.read(4096)
+        await self.check_busy(response)
+        assert response.startswith(AsyncClient.KEY_REQUEST)
+        self.pending_data_send = True
+        self.keys = [int(k) for k in response[len(AsyncClient.KEY_REQUEST):].decode("utf-8").split("\n")]
+        return self.keys
+
+    async def send_matrix(self, matrix):
+        # Should have pending connection here
+        assert self.pending_data_send == True
+
+        if self.binary:
+            payload = encode_matrix(matrix, ciphertext_width(self.keys[0]))
+            async with self.confirming():
+                self.writer.write(ballot_frame(FRAME_BALLOT, payload, self.token))
+                status = decode_status(await self.read_response(FRAME_STATUS))
+            self.pending_data_send = False
+            await self.close()
+            return status == STATUS_SUCCESS
+
+        data = text_ballot(matrix, self.token)
+
+        async with self.confirming():
+            self.writer.write(AsyncClient.DATA_REQUEST + data)
+            await self.writer.drain()
+            response = await self.reader.read(4096)
+            await self.check_busy(response)
+            self.pending_data_send = False
+            await self.reader.read(4096)
+        await self.close()
+        return response.startswith(AsyncClient.SUCCESS)
+
+
+# Awaits coroutines made by the function until one is not rejected by a busy server, like client.with_retries.
+async def with_retries(function, attempts=RETRY_ATTEMPTS):
+    delay = RETRY_DELAY
+    for attempt in range(attempts):
+        try:
+            return await function()
+        except ServerBusy as e:
+            if attempt + 1 == attempts:
+                raise
+            wait = e.retry_after
+        except ConnectionError:
+            if attempt + 1 == attempts:
+                raise
+            wait = delay
+            delay *= 2
+
+        await asyncio.sleep(wait * (1 + random.random() / 2))
+
+
+# Sends votes to the server, retrying while it is busy. Raises BallotUnconfirmed if the connection failed after
+# the ballot was sent. Encryption runs in the default executor to keep the event loop responsive.
+async def send_votes(votes, server_ip="127.0.0.1", server_port=9999, binary=False, token=None):
+    client = AsyncClient(server_ip, server_port, binary, token)
+    matrix = votes_to_matrix(votes)
+
+    async def send():
+        keys = await client.request_keys()
+        enc_matrix = await asyncio.get_running_loop().run_in_executor(None, encrypt_matrix, matrix, Encryptor(keys))
+        return await client.send_matrix(enc_matrix)
+
+    return await with_retries(send)
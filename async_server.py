@@ -0,0 +1,216 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from candidates import candidates as names
+
+import admission
+from crypto import DEFAULT_KEY_SIZE, Crypto
+from cryptosystem import instrumentation
+from protocol import *
+from server import (SESSION_BALLOT_FRAMES, SESSION_TIMEOUT, Server, busy_response, check_tally_request,
+                    error_response, process_session_ballots)
+
+# Ballots waiting for the executor are limited to this number per executor worker by default.
+INGEST_PER_WORKER = 4
+
+
+# Serves the same KEY/DATA/NAMES protocol as Server on a single asyncio event loop.
+# Crypto work is offloaded to an executor, so the loop only does network I/O.
+class AsyncServer:
+    KEY_REQUEST = Server.KEY_REQUEST
+    DATA_REQUEST = Server.DATA_REQUEST
+    NAMES_REQUEST = Server.NAMES_REQUEST
+    METRICS_REQUEST = Server.METRICS_REQUEST
+    SUCCESS = Server.SUCCESS
+    ERROR = Server.ERROR
+
+    # Connections over max_connections and ballots over max_ingest processed at once are answered as busy.
+    # If tally_token is provided, partial tally is exported to sessions that send it with the tally request.
+    # Keys of key_size bits are generated if key_file has none, insecure_keys allows keys shorter than production
+    # keys for tests and development.
+    def __init__(self, ip_address="127.0.0.1", post=9999, backlog=1024, max_seconds=5 * 60, key_file=None,
+                 journal_dir=None, executor_workers=4, require_proofs=False, credentials_file=None,
+                 trust_packed_ballots=False, max_connections=1024, max_ingest=None, retry_after=admission.RETRY_AFTER,
+                 session_timeout=SESSION_TIMEOUT, tally_token=None, key_size=DEFAULT_KEY_SIZE,
+                 insecure_keys=False):
+        self.crypto = Crypto(key_file, key_size, journal_dir=journal_dir, require_proofs=require_proofs,
+                             credentials_file=credentials_file, trust_packed_ballots=trust_packed_ballots,
+                             insecure_keys=insecure_keys)
+        self.backlog = backlog
+        self.max_seconds = max_seconds
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers)
+        self.connection_stage = admission.AdmissionStage(admission.STAGE_CONNECTIONS, max_connections, retry_after)
+        self.ingest_stage = admission.AdmissionStage(
+            admission.STAGE_INGEST, max_ingest or executor_workers * INGEST_PER_WORKER, retry_after)
+        self.session_timeout = session_timeout
+        self.tally_token = tally_token
+
+        self.bind_ip = ip_address
+        self.bind_port = post
+        self.main_thread = None
+        self.loop = None
+        self.stop_signal = None
+        self.started = threading.Event()
+
+    def run(self):
+        self.started.clear()
+        self.main_thread = threading.Thread(target=asyncio.run, args=(self.serve_forever(),))
+        self.main_thread.start()
+        self.started.wait()
+
+    async def serve_forever(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_signal = asyncio.Event()
+
+        try:
+            server = await asyncio.start_server(
+                self.handle_client_connection, self.bind_ip, self.bind_port, backlog=self.backlog)
+        finally:
+            self.started.set()
+        print(f"Started listening on {self.bind_ip}:{self.bind_port}")
+
+        try:
+            await asyncio.wait_for(self.stop_signal.wait(), timeout=self.max_seconds)
+        except asyncio.TimeoutError:
+            print("Server exceeded time limit")
+
+        server.close()
+        await server.wait_closed()
+        self.executor.shutdown()
+
+    def stop(self):
+        if self.main_thread is not None:
+            if self.main_thread.is_alive():
+                self.loop.call_soon_threadsafe(self.stop_signal.set)
+            self.main_thread.join()
+            self.main_thread = None
+        else:
+            print("Server is already stopped")
+
+    async def handle_data_request(self, reader, writer):
+        message = AsyncServer.KEY_REQUEST + b'\n'.join([str(k).encode("utf-8") for k in self.crypto.public_key])
+        writer.write(message)
+        await writer.drain()
+
+        request = await reader.read(4096)
+        if not request.startswith(AsyncServer.DATA_REQUEST):
+            writer.write(AsyncServer.ERROR)
+        else:
+            data = request[len(AsyncServer.DATA_REQUEST):]
+            with self.ingest_stage.admit():
+                await self.loop.run_in_executor(self.executor, self.crypto.process, data.decode("utf-8"))
+
+    async def handle_binary_data_request(self, reader, writer):
+        writer.write(encode_frame(FRAME_KEY, encode_key(self.crypto.public_key)))
+        await writer.drain()
+
+        status = STATUS_SUCCESS
+        try:
+            frame = await read_frame_async(reader)
+            with self.ingest_stage.admit():
+                await self.loop.run_in_executor(self.executor, self.crypto.process_ballot_frame, frame)
+        except ServerBusy as e:
+            writer.write(encode_frame(FRAME_BUSY, encode_busy(e.retry_after)))
+            return
+        except Exception as e:
+            print(f"Server error: {e}")
+            status = STATUS_ERROR
+
+        writer.write(encode_frame(FRAME_STATUS, encode_status(status)))
+
+    # Handles frames of the session until it is closed by the client or stays idle for the session timeout.
+    # Idle sessions still count against the connection limit, so they are closed as well.
+    async def handle_session(self, reader, writer):
+        writer.write(encode_frame(FRAME_STATUS, encode_status(STATUS_SUCCESS)))
+
+        while True:
+            try:
+                frame_type, payload = await asyncio.wait_for(read_frame_async(reader), self.session_timeout)
+            except asyncio.TimeoutError:
+                print("Closed idle session")
+                return
+            if frame_type == FRAME_CLOSE:
+                return
+            writer.write(await self.session_response(frame_type, payload))
+            await writer.drain()
+
+    # Returns response frame to the session frame.
+    async def session_response(self, frame_type, payload):
+        if frame_type == FRAME_NAMES:
+            return encode_frame(FRAME_NAMES, encode_names(names))
+        elif frame_type == FRAME_KEY:
+            return encode_frame(FRAME_KEY, encode_key(self.crypto.public_key))
+        elif frame_type == FRAME_TALLY:
+            check_tally_request(self.tally_token, payload)
+            return encode_frame(FRAME_TALLY, await self.loop.run_in_executor(self.executor, self.crypto.export_tally))
+        elif frame_type in SESSION_BALLOT_FRAMES:
+            # Busy session stays open, the client may send the same frame again later.
+            try:
+                with self.ingest_stage.admit():
+                    return await self.loop.run_in_executor(
+                        self.executor, process_session_ballots, self.crypto, frame_type, payload)
+            except ServerBusy as e:
+                return encode_frame(FRAME_BUSY, encode_busy(e.retry_after))
+
+        raise ProtocolError(f'Unexpected frame in session: {frame_type}')
+
+    async def handle_name_request(self, reader, writer):
+        message = AsyncServer.NAMES_REQUEST + b'\n'.join([k.encode("utf-8") for k in names])
+        writer.write(message)
+        await writer.drain()
+
+    async def handle_metrics_request(self, reader, writer):
+        text = instrumentation.prometheus_text() + admission.prometheus_text(
+            [self.connection_stage, self.ingest_stage], self.crypto.queue_depths())
+        writer.write(text.encode("utf-8"))
+
+    # Handles the request by its first line. Returns whether the request expects the text status line after it.
+    # Binary requests report their status in a status frame, metrics text is the whole response, so that it may
+    # be parsed as is.
+    async def handle_request(self, request, reader, writer):
+        handlers = [
+            (SESSION_REQUEST, self.handle_session, False),
+            (BINARY_KEY_REQUEST, self.handle_binary_data_request, False),
+            (AsyncServer.METRICS_REQUEST, self.handle_metrics_request, False),
+            (AsyncServer.KEY_REQUEST, self.handle_data_request, True),
+            (AsyncServer.NAMES_REQUEST, self.handle_name_request, True),
+        ]
+        for prefix, handler, text in handlers:
+            if request.startswith(prefix):
+                await handler(reader, writer)
+                return text
+
+        writer.write(AsyncServer.ERROR)
+        return True
+
+    async def handle_client_connection(self, reader, writer):
+        admitted = False
+        request = b''
+        try:
+            request = await reader.read(4096)
+            # Metrics are served even when overloaded, so that overload can be observed.
+            if not request.startswith(AsyncServer.METRICS_REQUEST):
+                admitted = self.connection_stage.try_enter()
+                if not admitted:
+                    writer.write(busy_response(request, self.connection_stage.retry_after))
+                    return
+
+            if await self.handle_request(request, reader, writer):
+                writer.write(AsyncServer.SUCCESS)
+        except ServerBusy as e:
+            writer.write(busy_response(request, e.retry_after))
+        except Exception as e:
+            print(f"Server error: {e}")
+            writer.write(error_response(request))
+        finally:
+            if admitted:
+                self.connection_stage.leave()
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+    def wait_until_done(self):
+        if self.main_thread is not None:
+            self.main_thread.join()
@@ -0,0 +1,315 @@
+# Durable append-only journal of accepted ballots with periodic snapshots of the accumulated tally.
+# Ballots are written in binary format and synced to disk in groups: while one group is being synced,
+# newly appended ballots wait in memory and are synced together by the next write.
+# On restart the latest snapshot is loaded and only the journal records after it are replayed.
+# Records included in a snapshot are dropped from the journal once the snapshot is synced. Offsets of records
+# are counted from the very first record, the journal header tells the offset of the first record kept in the file.
+
+import os
+import struct
+import threading
+import zlib
+
+from credentials import DIGEST_SIZE
+from protocol import decode_matrix, decode_packed_ballot, decode_tally
+
+JOURNAL_FILE = 'journal.bin'
+SNAPSHOT_FILE = 'snapshot.bin'
+
+# Record kinds.
+RECORD_BALLOT = 1
+RECORD_TALLY = 2
+RECORD_PACKED_BALLOT = 3
+RECORD_CREDENTIAL_BALLOT = 4
+
+# Credential ballot record wraps another ballot record: digest of the voter token and kind of the wrapped record,
+# followed by its payload. Token and ballot are written in one record, so a crash can not separate them.
+CREDENTIAL_RECORD_HEADER = struct.Struct(f'>{DIGEST_SIZE}sB')
+
+# Record header is sequence number, kind, payload length and CRC32 of the payload.
+RECORD_HEADER = struct.Struct('>QBII')
+
+# Journal header is magic and offset of the first record in the file. Journal without the header starts at zero.
+JOURNAL_MAGIC = b'LEBJ'
+JOURNAL_HEADER = struct.Struct('>4sQ')
+
+# Snapshot header is sequence number of the last included record and journal offset right after it.
+SNAPSHOT_HEADER = struct.Struct('>QQ')
+
+
+class JournalError(Exception):
+    pass
+
+
+# Reads header of the journal file. Returns offset of its first record and position of that record in the file.
+def read_journal_header(journal):
+    header = journal.read(JOURNAL_HEADER.size)
+    if len(header) == JOURNAL_HEADER.size:
+        magic, base = JOURNAL_HEADER.unpack(header)
+        if magic == JOURNAL_MAGIC:
+            return base, JOURNAL_HEADER.size
+
+    journal.seek(0)
+    return 0, 0
+
+
+# Encodes ballot record together with digest of the voter token.
+def encode_credential_record(digest, kind, payload):
+    return CREDENTIAL_RECORD_HEADER.pack(digest, kind) + bytes(payload)
+
+
+# Applies the record to the aggregator. Tokens of credential ballots are marked used in the credentials registry.
+# Returns digest of the voter token of credential ballot, None for other records.
+def apply_record(aggregator, kind, payload, credentials=None):
+    if kind == RECORD_BALLOT:
+        aggregator.add_vote(decode_matrix(payload))
+    elif kind == RECORD_TALLY:
+        aggregator.merge_tally(*decode_tally(payload, aggregator.encryptor.public_key))
+    elif kind == RECORD_PACKED_BALLOT:
+        rows, cols, slot_width, ciphertext = decode_packed_ballot(payload)
+        aggregator.add_packed_vote(ciphertext, (rows, cols), slot_width)
+    elif kind == RECORD_CREDENTIAL_BALLOT:
+        digest, wrapped_kind = CREDENTIAL_RECORD_HEADER.unpack_from(payload)
+        if credentials is not None:
+            credentials.mark_used(digest)
+        apply_record(aggregator, wrapped_kind, payload[CREDENTIAL_RECORD_HEADER.size:], credentials)
+        return digest
+
+    return None
+
+
+class BallotJournal(object):
+
+    # Constructor.
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+
+        # Sequence number of the last appended record and journal size including it.
+        self.sequence = 0
+        self.offset = 0
+
+        # Sequence number of the last record synced to disk.
+        self.committed = 0
+        self.records_since_checkpoint = 0
+
+        # Sequence number of the last record included in the written snapshot. Snapshots are written one at a time.
+        self.snapshot_sequence = 0
+        self.snapshot_lock = threading.Lock()
+
+        # Digests of voter tokens of the credential ballots replayed by restore. They are not in any snapshot yet.
+        self.restored_credentials = []
+
+        # Error that stopped the commit thread. Records appended after it are never synced.
+        self.error = None
+
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+        self.stop_signal = False
+        self.journal = None
+        self.committer = None
+
+        # Offset of the first record in the journal file and its position in the file. Records are written and
+        # the file is replaced by compaction one at a time.
+        self.base = 0
+        self.start = 0
+        self.write_lock = threading.Lock()
+
+    # Loads the snapshot and replays the journal tail into the aggregator, then opens the journal for appending.
+    # Tokens of the replayed credential ballots are marked used in the credentials registry, if it is provided.
+    # Returns number of replayed records.
+    def restore(self, aggregator, credentials=None):
+        snapshot_sequence, snapshot_offset = 0, 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as snapshot:
+                data = snapshot.read()
+            snapshot_sequence, snapshot_offset = SNAPSHOT_HEADER.unpack_from(data)
+            self.snapshot_sequence = snapshot_sequence
+            aggregator.restore_tally(*decode_tally(data[SNAPSHOT_HEADER.size:], aggregator.encryptor.public_key))
+
+        self.sequence, self.offset = snapshot_sequence, snapshot_offset
+        replayed = 0
+        for sequence, kind, payload, end in self.read_records(snapshot_offset):
+            digest = apply_record(aggregator, kind, payload, credentials)
+            if digest is not None:
+                self.restored_credentials.append(digest)
+            self.sequence, self.offset = sequence, end
+            replayed += 1
+
+        self.committed = self.sequence
+        self.records_since_checkpoint = replayed
+        self.open()
+        return replayed
+
+    # Reads valid records starting from the offset. Stops at the end of file or at a torn record.
+    # Yields (sequence, kind, payload, offset after the record).
+    def read_records(self, offset):
+        if not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path, 'rb') as journal:
+            self.base, self.start = read_journal_header(journal)
+            if offset < self.base:
+                raise JournalError(f'Journal {self.journal_path} starts after the snapshot')
+            journal.seek(offset - self.base + self.start)
+            while True:
+                header = journal.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+
+                sequence, kind, length, checksum = RECORD_HEADER.unpack(header)
+                payload = journal.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    return
+
+                offset += RECORD_HEADER.size + length
+                yield sequence, kind, payload, offset
+
+    # Opens the journal for appending and starts the commit thread. Torn tail left by a crash is cut off.
+    def open(self):
+        self.journal = open(self.journal_path, 'ab')
+        if self.journal.tell() == 0:
+            self.journal.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, 0))
+            self.base, self.start = 0, JOURNAL_HEADER.size
+        if self.journal.tell() < self.offset - self.base + self.start:
+            raise Exception(f'Journal {self.journal_path} is shorter than the snapshot refers to')
+        self.journal.truncate(self.offset - self.base + self.start)
+        self.stop_signal = False
+        self.committer = threading.Thread(target=self.commit_forever, daemon=True)
+        self.committer.start()
+
+    # Appends the record to the journal. Returns its sequence number to wait for with wait.
+    # Callers must append records in the same order they apply them to the aggregator.
+    def append(self, payload, kind=RECORD_BALLOT):
+        payload = bytes(payload)
+        with self.condition:
+            self.sequence += 1
+            self.buffer += RECORD_HEADER.pack(self.sequence, kind, len(payload), zlib.crc32(payload)) + payload
+            self.offset += RECORD_HEADER.size + len(payload)
+            self.records_since_checkpoint += 1
+            self.condition.notify_all()
+            return self.sequence
+
+    # Returns number of appended records that are not synced to disk yet.
+    def pending(self):
+        with self.condition:
+            return self.sequence - self.committed
+
+    # Waits until the record with the given sequence number is synced to disk.
+    # Raises JournalError if the journal failed to write it.
+    def wait(self, sequence):
+        with self.condition:
+            while self.committed < sequence:
+                self.check()
+                self.condition.wait()
+
+    # Raises JournalError if the journal can no longer write records.
+    def check(self):
+        if self.error is not None:
+            raise JournalError(f'Journal write failed: {self.error}')
+
+    # Writes and syncs appended records in groups. Runs in the commit thread.
+    def commit_forever(self):
+        while True:
+            with self.condition:
+                while len(self.buffer) == 0 and not self.stop_signal:
+                    self.condition.wait()
+                if len(self.buffer) == 0:
+                    return
+
+                data, self.buffer = self.buffer, bytearray()
+                sequence = self.sequence
+
+            # Failed write leaves the file in unknown state, so nothing is written after it and waiters are woken up
+            # to report the error instead of waiting forever.
+            try:
+                with self.write_lock:
+                    self.journal.write(data)
+                    self.journal.flush()
+                    os.fsync(self.journal.fileno())
+            except Exception as e:
+                print(f"Journal error: {e}")
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                self.committed = sequence
+                self.condition.notify_all()
+
+    # Starts checkpoint of all appended records. Returns its position to pass to checkpoint.
+    # Must be called together with taking the tally, so that no records are appended in between.
+    def start_checkpoint(self):
+        with self.condition:
+            self.records_since_checkpoint = 0
+            return self.sequence, self.offset
+
+    # Writes snapshot of the tally that includes records up to the position returned by start_checkpoint.
+    # Tally is encoded by encode_tally. Without position, the snapshot includes all appended records.
+    # Records may be appended while it is written. Snapshot older than the written one is skipped.
+    def checkpoint(self, tally, position=None):
+        if position is None:
+            position = self.start_checkpoint()
+        sequence, offset = position
+        self.wait(sequence)
+
+        with self.snapshot_lock:
+            if sequence <= self.snapshot_sequence:
+                return
+
+            temporary_path = self.snapshot_path + '.tmp'
+            with open(temporary_path, 'wb') as snapshot:
+                snapshot.write(SNAPSHOT_HEADER.pack(sequence, offset) + tally)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(temporary_path, self.snapshot_path)
+            self.sync_directory()
+            self.snapshot_sequence = sequence
+
+            self.compact(offset)
+
+    # Drops records up to the offset, which are included in the synced snapshot, from the journal.
+    # Records after it are copied into a new file, which replaces the journal, so a crash leaves one of them whole.
+    # Records may be appended meanwhile, they are written to the new file.
+    def compact(self, offset):
+        if self.journal is None:
+            return
+
+        with self.write_lock:
+            with open(self.journal_path, 'rb') as journal:
+                journal.seek(offset - self.base + self.start)
+                tail = journal.read()
+
+            temporary_path = self.journal_path + '.tmp'
+            with open(temporary_path, 'wb') as compacted:
+                compacted.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, offset) + tail)
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            os.replace(temporary_path, self.journal_path)
+            self.sync_directory()
+
+            self.journal.close()
+            self.journal = open(self.journal_path, 'ab')
+            self.base, self.start = offset, JOURNAL_HEADER.size
+
+    # Syncs the directory so that renamed snapshot survives a crash.
+    def sync_directory(self):
+        if hasattr(os, 'O_DIRECTORY'):
+            descriptor = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+
+    # Syncs remaining records and closes the journal.
+    def close(self):
+        if self.committer is not None:
+            with self.condition:
+                self.stop_signal = True
+                self.condition.notify_all()
+            self.committer.join()
+            self.committer = None
+            self.journal.close()
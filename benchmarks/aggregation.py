@@ -0,0 +1,197 @@
+# Benchmarks encryption, decryption, gates, vote accumulation and full aggregation.
+# Every measurement is repeated for all combinations of key sizes, numbers of candidates and numbers of marks,
+# so the results show how the costs scale. Results are written as JSON and may be compared with a stored
+# baseline: measurements slower than the baseline by more than the threshold are reported as regressions.
+# Usage: python -m benchmarks.aggregation [--key-sizes 128,256] [--candidates 3,5] [--marks 3,5] [--ballots 10]
+#                                         [--output results.json] [--baseline baseline.json] [--threshold 0.25]
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import platform
+import sys
+import time
+from random import randrange
+
+import numpy as np
+
+from aggregator import Aggregator
+from cryptosystem import arithmetic
+from cryptosystem.cryptosystem_setup import generate_keys
+from cryptosystem.decryption import Decryptor
+from cryptosystem.encrypted_routine import *
+from cryptosystem.encryption import Encryptor
+
+
+# Parses comma separated list of integers.
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+# Runs the function repeat times. Returns the best time of a single run in seconds.
+def best_time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+# Times operations per call on operations inputs. Returns seconds per operation.
+def time_per_operation(operation, inputs, repeat):
+    return best_time(lambda: [operation(*args) for args in inputs], repeat) / len(inputs)
+
+
+# Generates random ballot: every candidate gets exactly one mark.
+def random_ballot(candidates, marks):
+    ballot = [[0] * marks for _ in range(candidates)]
+    for row in ballot:
+        row[randrange(marks)] = 1
+
+    return ballot
+
+
+# Measures primitives that depend only on the key. Returns {benchmark: seconds per operation}.
+def benchmark_key(encryptor, decryptor, operations, repeat):
+    n = encryptor.public_key[0]
+    values = [randrange(n) for _ in range(operations)]
+    bits = [randrange(2) for _ in range(operations)]
+    ciphertexts = encryptor.encrypt_many(values)
+    encrypted_bits = encryptor.encrypt_many(bits)
+
+    bitwise_values = [encryptor.encrypt_many(convert_to_bit_array(value)) for value in values]
+    addition_inputs = [prepare_different_arrays(list(x), convert_to_bit_array(y), encryptor)
+                       for x, y in zip(bitwise_values, reversed(values))]
+    comparison_inputs = [pad_bit_arrays([x, y], encryptor)
+                         for x, y in zip(bitwise_values, bitwise_values[1:] + bitwise_values[:1])]
+
+    return {
+        'encrypt': time_per_operation(encryptor.encrypt, [(value,) for value in values], repeat),
+        'decrypt': time_per_operation(decryptor.decrypt, [(ciphertext,) for ciphertext in ciphertexts], repeat),
+        'conditional_gate': time_per_operation(
+            conditional_gate, [(c, b, decryptor) for c, b in zip(ciphertexts, encrypted_bits)], repeat),
+        'addition_gate': time_per_operation(
+            addition_gate, [(x, y, encryptor, decryptor) for x, y in addition_inputs], repeat),
+        'bit_extraction_gate': time_per_operation(
+            bit_extraction_gate, [(c, encryptor, decryptor) for c in ciphertexts], repeat),
+        'greater_than_gate': time_per_operation(
+            greater_than_gate, [(x, y, encryptor, decryptor) for x, y in comparison_inputs], repeat),
+    }
+
+
+# Measures vote accumulation and full aggregation. Returns {benchmark: seconds}.
+# add_vote is reported per ballot, aggregate per election of the given number of ballots.
+def benchmark_election(encryptor, decryptor, candidates, marks, ballots, repeat):
+    encrypted_ballots = [np.array([encryptor.encrypt_many(row) for row in random_ballot(candidates, marks)],
+                                  dtype=object) for _ in range(ballots)]
+
+    # Every run starts from an empty tally, so all runs aggregate the same number of ballots.
+    aggregators = []
+
+    def add_votes():
+        aggregators.append(Aggregator(encryptor, decryptor, candidates, marks))
+        for ballot in encrypted_ballots:
+            aggregators[-1].add_vote(ballot)
+
+    add_vote = best_time(add_votes, repeat) / ballots
+    aggregator = aggregators[-1]
+
+    # Aggregation prints progress, which is not part of the results.
+    with contextlib.redirect_stdout(io.StringIO()):
+        aggregate = best_time(aggregator.aggregate, repeat)
+
+    return {'add_vote': add_vote, 'aggregate': aggregate}
+
+
+# Runs all benchmarks. Returns list of results, one per measurement.
+def run(key_sizes, candidate_counts, mark_counts, ballots, operations, repeat, log=print):
+    results = []
+    for key_size in key_sizes:
+        with contextlib.redirect_stdout(io.StringIO()):
+            keys = generate_keys(key_size)
+        encryptor = Encryptor(keys[0:2])
+        decryptor = Decryptor(keys[0:2], keys[2:4], keys[4:6])
+
+        for name, seconds in benchmark_key(encryptor, decryptor, operations, repeat).items():
+            results.append({'benchmark': name, 'key_size': key_size, 'seconds': seconds})
+            log(f'{name:>20} key {key_size:>5}: {seconds:.6f}s')
+
+        for candidates, marks in itertools.product(candidate_counts, mark_counts):
+            timings = benchmark_election(encryptor, decryptor, candidates, marks, ballots, repeat)
+            for name, seconds in timings.items():
+                results.append({'benchmark': name, 'key_size': key_size, 'candidates': candidates, 'marks': marks,
+                                'ballots': ballots, 'seconds': seconds})
+                log(f'{name:>20} key {key_size:>5}, {candidates} candidates, {marks} marks: {seconds:.6f}s')
+
+    return results
+
+
+# Returns key that identifies the measurement across runs.
+def result_key(result):
+    return tuple((field, result[field]) for field in ('benchmark', 'key_size', 'candidates', 'marks', 'ballots')
+                 if field in result)
+
+
+# Compares results with the baseline. Returns list of (result, baseline seconds) slower than allowed.
+def find_regressions(results, baseline, threshold):
+    baseline_seconds = {result_key(result): result['seconds'] for result in baseline}
+
+    regressions = []
+    for result in results:
+        expected = baseline_seconds.get(result_key(result))
+        if expected is not None and result['seconds'] > expected * (1 + threshold):
+            regressions.append((result, expected))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark encryption, gates and aggregation.')
+    parser.add_argument('--key-sizes', type=int_list, default=[128, 256], help='bit lengths of n')
+    parser.add_argument('--candidates', type=int_list, default=[2, 3], help='numbers of candidates')
+    parser.add_argument('--marks', type=int_list, default=[2, 3], help='numbers of marks')
+    parser.add_argument('--ballots', type=int, default=10, help='number of ballots per election')
+    parser.add_argument('--operations', type=int, default=10, help='number of operations per primitive')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the best one is reported')
+    parser.add_argument('--output', help='file to write JSON results to, standard output if not provided')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown relative to the baseline, 0.25 means 25%%')
+    args = parser.parse_args()
+
+    # Progress goes to standard error, so standard output contains only the results.
+    def log(message):
+        print(message, file=sys.stderr)
+
+    results = run(args.key_sizes, args.candidates, args.marks, args.ballots, args.operations, args.repeat, log)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'backend': arithmetic.backend.name,
+        'results': results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline:
+            regressions = find_regressions(results, json.load(baseline)['results'], args.threshold)
+
+        for result, expected in regressions:
+            log(f'Regression: {dict(result_key(result))} took {result["seconds"]:.6f}s, baseline {expected:.6f}s')
+        if len(regressions) > 0:
+            sys.exit(1)
+        log(f'No regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
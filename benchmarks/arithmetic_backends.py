@@ -0,0 +1,69 @@
+# Benchmarks arithmetic backends against each other.
+# Checks that every backend produces the same results as the reference one and reports timings.
+# Usage: python -m benchmarks.arithmetic_backends [--bits 2048] [--operations 200]
+
+import argparse
+import time
+from random import getrandbits
+
+from cryptosystem import arithmetic
+from cryptosystem.cryptosystem_utils import generate_coprime
+
+REFERENCE_BACKEND = arithmetic.PythonBackend.name
+
+
+# Generates inputs of the form (a, b, mod) similar to ones used in encryption modulo n^2.
+def generate_inputs(bits, operations):
+    n = getrandbits(bits) | (1 << (bits - 1)) | 1
+    modulo = n * n
+    return [(generate_coprime(modulo), n, modulo) for _ in range(operations)]
+
+
+# Times the operation over all inputs. Returns results and elapsed seconds.
+def time_operation(operation, inputs):
+    start = time.perf_counter()
+    results = [operation(*args) for args in inputs]
+    return results, time.perf_counter() - start
+
+
+# Runs the benchmark and returns {backend: {operation: seconds}}.
+def run(bits, operations):
+    inputs = generate_inputs(bits, operations)
+    inverse_inputs = [(a, modulo) for a, b, modulo in inputs]
+
+    reference = arithmetic.BACKENDS[REFERENCE_BACKEND]
+    expected_powmod, _ = time_operation(reference.powmod, inputs)
+    expected_invmod, _ = time_operation(reference.invmod, inverse_inputs)
+
+    timings = {}
+    for name in arithmetic.available_backends():
+        backend = arithmetic.BACKENDS[name]
+
+        powmod_results, powmod_time = time_operation(backend.powmod, inputs)
+        invmod_results, invmod_time = time_operation(backend.invmod, inverse_inputs)
+
+        if powmod_results != expected_powmod or invmod_results != expected_invmod:
+            raise Exception(f'Backend {name} results differ from {REFERENCE_BACKEND} backend')
+
+        timings[name] = {'powmod': powmod_time, 'invmod': invmod_time}
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark arithmetic backends.')
+    parser.add_argument('--bits', type=int, default=2048, help='bit length of n, operations are modulo n^2')
+    parser.add_argument('--operations', type=int, default=20, help='number of operations per backend')
+    args = parser.parse_args()
+
+    timings = run(args.bits, args.operations)
+    reference = timings[REFERENCE_BACKEND]
+
+    print(f'All backends match {REFERENCE_BACKEND} backend on {args.operations} operations modulo n^2, n of {args.bits} bits')
+    for name, timing in timings.items():
+        print(f'{name:>8}: powmod {timing["powmod"]:.4f}s ({reference["powmod"] / timing["powmod"]:.1f}x), '
+              f'invmod {timing["invmod"]:.4f}s ({reference["invmod"] / timing["invmod"]:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,50 @@
+import random
 import socket
+import time
+from contextlib import contextmanager
 
 from cryptosystem.encryption import Encryptor
+from cryptosystem.proofs import encrypt_ballot
+from packing import DEFAULT_MAX_VOTERS, encrypt_packed, slot_width
+from protocol import *
+
+# Number of attempts of a request before giving up.
+RETRY_ATTEMPTS = 5
+
+# Delay in seconds before retrying a request that failed to connect, doubled after every attempt.
+# Busy server tells the delay itself.
+RETRY_DELAY = 0.5
+
+
+# Connection failed after the ballot was sent, so the server may or may not have counted it.
+# Such ballot is not sent again, since it could be counted twice.
+class BallotUnconfirmed(Exception):
+    pass
+
+
+# Encodes ballot frame, wrapped together with the voter credential token if it is set.
+def ballot_frame(frame_type, payload, token=None):
+    if token is not None:
+        return encode_frame(FRAME_CREDENTIAL_BALLOT, encode_credential_ballot(token, frame_type, payload))
+    return encode_frame(frame_type, payload)
+
+
+# Encodes encrypted matrix as text ballot, preceded by the voter credential line if token is set.
+def text_ballot(matrix, token=None):
+    data = '\n'.join(
+        ','.join(map(lambda x: str(x), row))
+        for row in matrix
+    )
+    if token is not None:
+        data = CREDENTIAL_LINE + token + '\n' + data
+    return data.encode("utf-8")
+
+
+# Encrypts plain matrix, proves its validity and encodes both for a proven ballot frame.
+def encode_proven_matrix(matrix, keys):
+    width = ciphertext_width(keys[0])
+    ciphertexts, proof = encrypt_ballot(matrix, Encryptor(keys))
+    return encode_proven_ballot(encode_matrix(ciphertexts, width), encode_proof(proof, width))
 
 
 class Client:
@@ -10,9 +54,14 @@ class Client:
     SUCCESS = b"SUCCESS\n"
     ERROR = b"ERROR\n"
 
-    def __init__(self, server_ip="127.0.0.1", server_port=9999):
+    # If binary is set, keys and votes are transferred in binary frames instead of text.
+    # If token is set, it is the voter credential sent with the ballot.
+    def __init__(self, server_ip="127.0.0.1", server_port=9999, binary=False, token=None):
         self.server_ip = server_ip
         self.server_port = server_port
+        self.binary = binary
+        self.token = token
+        self.keys = None
 
         self.client = None
         self.pending_data_send = False
@@ -25,42 +74,234 @@ class Client:
         self.client.close()
         self.client = None
 
+    # Drops the connection and the pending ballot.
+    def abort(self):
+        self.pending_data_send = False
+        self.close()
+
+    # Reads response frame of the expected type. If the server is busy, drops the connection and raises ServerBusy.
+    def read_response(self, frame_type):
+        try:
+            return expect_frame(read_frame(self.client), frame_type)
+        except ServerBusy:
+            self.abort()
+            raise
+
+    # Raises ServerBusy if the text response is the busy response, dropping the connection first.
+    # Overloaded server may also close the connection without any response.
+    def check_busy(self, response):
+        if len(response) == 0:
+            self.abort()
+            raise ConnectionResetError('Server closed the connection')
+        try:
+            check_busy_text(response)
+        except ServerBusy:
+            self.abort()
+            raise
+
+    # Runs the block that sends the ballot and reads the response. Connection errors in the block are raised as
+    # BallotUnconfirmed, dropping the connection, so that the ballot is not retried. Busy server has not counted it.
+    @contextmanager
+    def confirming(self):
+        try:
+            yield
+        except (OSError, ProtocolError) as e:
+            if self.client is not None:
+                self.abort()
+            raise BallotUnconfirmed('Connection was lost after the ballot was sent') from e
+
     def request_names(self):
         self.connect()
         assert self.pending_data_send == False
         self.client.send(Client.NAMES_REQUEST)
         response = self.client.recv(4096)
+        self.check_busy(response)
         assert response.startswith(Client.NAMES_REQUEST)
-        self.client.recv(4096)
+        # Status may arrive in the same packet as the names.
+        if response.endswith(Client.SUCCESS):
+            response = response[:-len(Client.SUCCESS)]
+        else:
+            self.client.recv(4096)
         self.close()
         return response[len(Client.NAMES_REQUEST):].decode("utf-8").split("\n")
 
     def request_keys(self):
         self.connect()
         assert self.pending_data_send == False
+        if self.binary:
+            self.client.sendall(BINARY_KEY_REQUEST)
+            self.keys = decode_key(self.read_response(FRAME_KEY))
+            self.pending_data_send = True
+            return self.keys
+
         self.client.send(Client.KEY_REQUEST)
         response = self.client.recv(4096)
+        self.check_busy(response)
         assert response.startswith(Client.KEY_REQUEST)
         self.pending_data_send = True
-        return [int(k) for k in response[len(Client.KEY_REQUEST):].decode("utf-8").split("\n")]
+        self.keys = [int(k) for k in response[len(Client.KEY_REQUEST):].decode("utf-8").split("\n")]
+        return self.keys
+
+    # Sends plain matrix encrypted as a single packed ciphertext. Requires binary mode.
+    def send_packed_matrix(self, matrix, max_voters=DEFAULT_MAX_VOTERS):
+        assert self.pending_data_send == True and self.binary
+
+        width = slot_width(max_voters)
+        ciphertext = encrypt_packed(matrix, Encryptor(self.keys), width)
+        payload = encode_packed_ballot(len(matrix), len(matrix[0]), width, ciphertext, ciphertext_width(self.keys[0]))
+        with self.confirming():
+            self.client.sendall(ballot_frame(FRAME_PACKED_BALLOT, payload, self.token))
+            status = decode_status(self.read_response(FRAME_STATUS))
+        self.pending_data_send = False
+        self.close()
+        return status == STATUS_SUCCESS
+
+    # Sends plain matrix encrypted together with proof of its validity. Requires binary mode.
+    def send_proven_matrix(self, matrix):
+        assert self.pending_data_send == True and self.binary
+
+        frame = ballot_frame(FRAME_PROVEN_BALLOT, encode_proven_matrix(matrix, self.keys), self.token)
+        with self.confirming():
+            self.client.sendall(frame)
+            status = decode_status(self.read_response(FRAME_STATUS))
+        self.pending_data_send = False
+        self.close()
+        return status == STATUS_SUCCESS
 
     def send_matrix(self, matrix):
         # Should have pending connection here
         assert self.pending_data_send == True
 
-        data = '\n'.join(
-            ','.join(map(lambda x: str(x), row))
-            for row in matrix
-        ).encode("utf-8")
+        if self.binary:
+            payload = encode_matrix(matrix, ciphertext_width(self.keys[0]))
+            with self.confirming():
+                self.client.sendall(ballot_frame(FRAME_BALLOT, payload, self.token))
+                status = decode_status(self.read_response(FRAME_STATUS))
+            self.pending_data_send = False
+            self.close()
+            return status == STATUS_SUCCESS
 
-        self.client.send(Client.DATA_REQUEST + data)
-        response = self.client.recv(4096)
-        self.pending_data_send = False
-        self.client.recv(4096)
+        data = text_ballot(matrix, self.token)
+
+        with self.confirming():
+            self.client.send(Client.DATA_REQUEST + data)
+            response = self.client.recv(4096)
+            self.check_busy(response)
+            self.pending_data_send = False
+            self.client.recv(4096)
         self.close()
         return response.startswith(self.SUCCESS)
 
 
+# Persistent connection for relaying many ballots, e.g. from a polling station kiosk.
+# Names and key are requested once per session, ballots are sent in batches.
+class ClientSession:
+
+    def __init__(self, server_ip="127.0.0.1", server_port=9999):
+        self.server_ip = server_ip
+        self.server_port = server_port
+
+        self.client = None
+        self.names = None
+        self.keys = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.client.connect((self.server_ip, self.server_port))
+        self.client.sendall(SESSION_REQUEST)
+        try:
+            status = decode_status(expect_frame(read_frame(self.client), FRAME_STATUS))
+        except ServerBusy:
+            self.client.close()
+            self.client = None
+            raise
+        if status != STATUS_SUCCESS:
+            raise ProtocolError('Server refused to open session')
+
+    def close(self):
+        if self.client is not None:
+            self.client.sendall(encode_frame(FRAME_CLOSE, b''))
+            self.client.close()
+            self.client = None
+
+    def request(self, frame_type, payload, response_type):
+        self.client.sendall(encode_frame(frame_type, payload))
+        return expect_frame(read_frame(self.client), response_type)
+
+    def request_names(self):
+        if self.names is None:
+            self.names = decode_names(self.request(FRAME_NAMES, b'', FRAME_NAMES))
+        return self.names
+
+    def request_keys(self):
+        if self.keys is None:
+            self.keys = decode_key(self.request(FRAME_KEY, b'', FRAME_KEY))
+        return self.keys
+
+    # Requests serialized partial tally of the server, to be merged on the coordinator. Token is the tally export
+    # token of the server.
+    def request_tally(self, token):
+        return bytes(self.request(FRAME_TALLY, token.encode('utf-8'), FRAME_TALLY))
+
+    # Sends plain matrix encrypted as a single packed ciphertext. Returns whether it was accepted.
+    def send_packed_matrix(self, matrix, max_voters=DEFAULT_MAX_VOTERS):
+        keys = self.request_keys()
+        width = slot_width(max_voters)
+        ciphertext = encrypt_packed(matrix, Encryptor(keys), width)
+        payload = encode_packed_ballot(len(matrix), len(matrix[0]), width, ciphertext, ciphertext_width(keys[0]))
+        return decode_status(self.request(FRAME_PACKED_BALLOT, payload, FRAME_STATUS)) == STATUS_SUCCESS
+
+    # Sends plain matrices encrypted together with proofs of their validity in one request.
+    # Returns whether each of them was accepted.
+    def send_proven_matrices(self, matrices):
+        keys = self.request_keys()
+        payload = encode_batch([encode_proven_matrix(matrix, keys) for matrix in matrices])
+        statuses = decode_batch_status(self.request(FRAME_PROVEN_BATCH, payload, FRAME_BATCH_STATUS))
+        return [status == STATUS_SUCCESS for status in statuses]
+
+    # Sends encrypted matrix of a voter with the credential token. Returns whether it was accepted.
+    def send_matrix(self, matrix, token):
+        width = ciphertext_width(self.request_keys()[0])
+        payload = encode_credential_ballot(token, FRAME_BALLOT, encode_matrix(matrix, width))
+        return decode_status(self.request(FRAME_CREDENTIAL_BALLOT, payload, FRAME_STATUS)) == STATUS_SUCCESS
+
+    # Sends encrypted matrices in one request. Returns whether each of them was accepted.
+    def send_matrices(self, matrices):
+        width = ciphertext_width(self.request_keys()[0])
+        payload = encode_batch([encode_matrix(matrix, width) for matrix in matrices])
+        statuses = decode_batch_status(self.request(FRAME_BATCH, payload, FRAME_BATCH_STATUS))
+        return [status == STATUS_SUCCESS for status in statuses]
+
+
+# Calls function until it is not rejected by a busy server, at most the given number of times.
+# Busy server tells when to retry, connection errors are retried with exponential backoff. Delays are stretched
+# by a random factor, so that clients rejected together do not come back together. Raises the last error.
+# Ballot that was sent before the connection failed raises BallotUnconfirmed, which is never retried.
+def with_retries(function, attempts=RETRY_ATTEMPTS):
+    delay = RETRY_DELAY
+    for attempt in range(attempts):
+        try:
+            return function()
+        except ServerBusy as e:
+            if attempt + 1 == attempts:
+                raise
+            wait = e.retry_after
+        except ConnectionError:
+            if attempt + 1 == attempts:
+                raise
+            wait = delay
+            delay *= 2
+
+        time.sleep(wait * (1 + random.random() / 2))
+
+
 def prompt_voting(names):
     print(f"For each candidate name please type you grade from 1 (best) to {len(names)} (worst)")
     print("Each vote should be unique")
@@ -78,6 +319,15 @@ def prompt_voting(names):
     return votes
 
 
+# Requests partial tallies of the ingest nodes given as (ip, port), to be merged on the coordinator.
+def request_tallies(nodes, token):
+    tallies = []
+    for ip, port in nodes:
+        with ClientSession(ip, port) as session:
+            tallies.append(session.request_tally(token))
+    return tallies
+
+
 def votes_to_matrix(votes):
     return [
         [1 if i + 1 == v else 0 for i in range(len(votes))]
@@ -86,21 +336,20 @@ def votes_to_matrix(votes):
 
 
 def encrypt_matrix(matrix, encryptor):
-    return [
-        [encryptor.encrypt(it) for it in row]
-        for row in matrix
-    ]
+    return [encryptor.encrypt_many(row) for row in matrix]
 
 
 def run_votes():
-    client = Client()
-    names = client.request_names()
+    token = input("Voter token (leave empty if not required): ").strip()
+    client = Client(token=token if token else None)
+    names = with_retries(client.request_names)
     votes = prompt_voting(names)
-    keys = client.request_keys()
     matrix = votes_to_matrix(votes)
-    encryptor = Encryptor(keys)
-    enc_matrix = encrypt_matrix(matrix, encryptor)
-    success = client.send_matrix(enc_matrix)
+    try:
+        success = with_retries(lambda: client.send_matrix(encrypt_matrix(matrix, Encryptor(client.request_keys()))))
+    except BallotUnconfirmed:
+        print("Connection was lost after your vote was sent, it may have been counted. Please do not vote again")
+        return
     if success:
         print("Your vote was sent successfully")
     else:
@@ -0,0 +1,173 @@
+# Registry of voter credentials: every eligible voter gets a secret token and may cast exactly one ballot with it.
+#
+# Eligible tokens are stored on disk as digests in an open addressing hash table, which is memory-mapped, so
+# lookups take a few page reads even for millions of voters and the table is shared by all threads without locks.
+# Tokens that have already voted are kept in memory in sets split into stripes, every stripe guarded by its own
+# lock, so concurrent ballots only contend when their tokens fall into the same stripe.
+# Used tokens are written to the ballot journal together with the ballots, and appended to a file of used tokens
+# before every snapshot, since the journal records before the snapshot are not replayed.
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+
+# Length of the stored token digest in bytes.
+DIGEST_SIZE = 16
+
+# Registry file header is magic and number of slots of the table.
+REGISTRY_MAGIC = b'LECR'
+REGISTRY_HEADER = struct.Struct('>4sQ')
+
+# Table has at least this many slots per token, so that probe sequences stay short.
+SLOTS_PER_TOKEN = 2
+
+# Number of stripes of the used tokens.
+LOCK_STRIPES = 64
+
+EMPTY_SLOT = bytes(DIGEST_SIZE)
+
+
+class CredentialError(Exception):
+    pass
+
+
+# Returns digest of the token that is stored in the registry.
+def token_digest(token):
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).digest()[:DIGEST_SIZE]
+
+
+# Returns index of the first slot probed for the digest. Number of slots is a power of two.
+def first_slot(digest, slots):
+    return int.from_bytes(digest[:8], 'big') & (slots - 1)
+
+
+# Writes registry of the eligible tokens to the file. Returns number of distinct tokens written.
+def build_registry(path, tokens):
+    digests = {token_digest(token) for token in tokens}
+    digests.discard(EMPTY_SLOT)
+
+    slots = 1
+    while slots < len(digests) * SLOTS_PER_TOKEN:
+        slots <<= 1
+
+    table = bytearray(slots * DIGEST_SIZE)
+    for digest in digests:
+        slot = first_slot(digest, slots)
+        while table[slot * DIGEST_SIZE:(slot + 1) * DIGEST_SIZE] != EMPTY_SLOT:
+            slot = (slot + 1) & (slots - 1)
+        table[slot * DIGEST_SIZE:(slot + 1) * DIGEST_SIZE] = digest
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as registry:
+        registry.write(REGISTRY_HEADER.pack(REGISTRY_MAGIC, slots))
+        registry.write(table)
+    os.replace(temporary_path, path)
+
+    return len(digests)
+
+
+# Appends digests of used tokens to the file and syncs it.
+def append_used(path, digests):
+    with open(path, 'ab') as used:
+        used.write(b''.join(digests))
+        used.flush()
+        os.fsync(used.fileno())
+
+
+class CredentialRegistry(object):
+
+    # Constructor. Path is the registry file written by build_registry.
+    def __init__(self, path):
+        with open(path, 'rb') as registry:
+            self.table = mmap.mmap(registry.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.table) < REGISTRY_HEADER.size:
+            raise CredentialError(f'Credential registry {path} is truncated')
+        magic, self.slots = REGISTRY_HEADER.unpack_from(self.table)
+        if magic != REGISTRY_MAGIC or self.slots & (self.slots - 1) != 0:
+            raise CredentialError(f'File {path} is not a credential registry')
+        if len(self.table) != REGISTRY_HEADER.size + self.slots * DIGEST_SIZE:
+            raise CredentialError(f'Credential registry {path} has wrong length')
+
+        self.used = [set() for _ in range(LOCK_STRIPES)]
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    # Checks that the digest belongs to an eligible token.
+    def is_eligible(self, digest):
+        slot = first_slot(digest, self.slots)
+        for _ in range(self.slots):
+            offset = REGISTRY_HEADER.size + slot * DIGEST_SIZE
+            stored = self.table[offset:offset + DIGEST_SIZE]
+            if stored == digest:
+                return True
+            if stored == EMPTY_SLOT:
+                return False
+            slot = (slot + 1) & (self.slots - 1)
+
+        return False
+
+    # Returns index of the stripe of the digest.
+    @staticmethod
+    def stripe(digest):
+        return digest[-1] % LOCK_STRIPES
+
+    # Marks the token as used. Returns its digest, which is passed to release if the ballot is not accepted.
+    # Raises CredentialError if the token is not eligible or has already been used.
+    def claim(self, token):
+        digest = token_digest(token)
+        if not self.is_eligible(digest):
+            raise CredentialError('Voter credential is not eligible')
+
+        stripe = self.stripe(digest)
+        with self.locks[stripe]:
+            if digest in self.used[stripe]:
+                raise CredentialError('Voter credential has already been used')
+            self.used[stripe].add(digest)
+
+        return digest
+
+    # Returns claimed token back, so that the voter may vote again.
+    def release(self, digest):
+        stripe = self.stripe(digest)
+        with self.locks[stripe]:
+            self.used[stripe].discard(digest)
+
+    # Marks digest of the token as used, e.g. while restoring accepted ballots.
+    def mark_used(self, digest):
+        digest = bytes(digest)
+        stripe = self.stripe(digest)
+        with self.locks[stripe]:
+            self.used[stripe].add(digest)
+
+    # Returns number of used tokens.
+    def used_count(self):
+        return sum(len(used) for used in self.used)
+
+    # Marks digests written by append_used as used. Missing file means no token has been used.
+    # Torn digest left by a crash is cut off, so that the next digests are appended at the right offset.
+    def load_used(self, path):
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'r+b') as used:
+            data = used.read()
+            used.truncate(len(data) - len(data) % DIGEST_SIZE)
+
+        for offset in range(0, len(data) - len(data) % DIGEST_SIZE, DIGEST_SIZE):
+            self.mark_used(data[offset:offset + DIGEST_SIZE])
+
+    # Unmaps the registry file.
+    def close(self):
+        self.table.close()
+
+
+# Builds registry from a file with one token per line: python credentials.py tokens.txt registry.bin
+if __name__ == "__main__":
+    with open(sys.argv[1], encoding='utf-8') as tokens:
+        count = build_registry(sys.argv[2], (line.strip() for line in tokens if line.strip()))
+    print(f'Registered {count} voter credentials')
@@ -4,27 +4,415 @@ from candidates import NUMBER_OF_CANDIDATES, NUMBER_OF_MARKS
 from cryptosystem.encryption import *
 from cryptosystem.decryption import *
 from cryptosystem.cryptosystem_setup import *
+from cryptosystem.proofs import verify_ballots
+import os
+import threading
+from admission import STAGE_JOURNAL
 from aggregator import *
+from ballot_journal import *
+from credentials import CredentialError, CredentialRegistry, append_used
+from packing import DEFAULT_MAX_VOTERS, can_pack, slot_width
+from protocol import *
+
+# Number of encryption randomizers precomputed in background.
+RANDOMIZER_POOL_SIZE = 256
+
+# Number of worker processes used to aggregate the votes.
+AGGREGATION_WORKERS = os.cpu_count() or 1
+
+# Snapshot of the tally is written after this number of journal records.
+CHECKPOINT_INTERVAL = 1000
+
+# Digests of voter tokens used before the latest snapshot are kept in this file of the journal directory.
+USED_CREDENTIALS_FILE = 'credentials.bin'
+
+# Shard id of the node is kept in this file of the journal directory, so that the restored tally keeps its id.
+SHARD_FILE = 'shard.bin'
+
+# Bit length of the modulus n of the keys generated by default.
+DEFAULT_KEY_SIZE = PRODUCTION_KEY_SIZES[0]
+
+# Width of slots of packed ballots. Packed ballots are accepted only if they are trusted and the key is long enough
+# for them.
+PACKING_SLOT_WIDTH = slot_width(DEFAULT_MAX_VOTERS)
+
+
+# Returns shard id stored in the directory, or generates and saves it on the first start.
+def load_or_generate_shard(directory):
+    path = os.path.join(directory, SHARD_FILE)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as shard:
+            shard.write(os.urandom(SHARD_ID_SIZE))
+            shard.flush()
+            os.fsync(shard.fileno())
+        os.replace(temporary_path, path)
+
+    with open(path, 'rb') as shard:
+        return shard.read()
 
 
 class Crypto(object):
 
     # Constructor.
-    def __init__(self):
-        keys = generate_keys()
+    # If key_file is provided, keys are loaded from it, or generated and saved to it on the first start.
+    # If journal_dir is provided, accepted votes are journaled there and restored on the next start.
+    # If require_proofs is set, only ballots sent with proofs of their validity are accepted.
+    # If credentials_file is provided, it is the registry of eligible voter tokens, and every ballot must be sent
+    # with a token that has not voted yet.
+    # If trust_packed_ballots is set, packed ballots are accepted. They can not be validated, see packing.
+    # Keys shorter than the production key sizes are refused, unless insecure_keys is set for tests and development.
+    def __init__(self, key_file=None, key_size=DEFAULT_KEY_SIZE, journal_dir=None, require_proofs=False,
+                 credentials_file=None, trust_packed_ballots=False, insecure_keys=False):
+        if require_proofs and trust_packed_ballots:
+            raise Exception('Packed ballots can not be accepted when validity proofs are required')
+
+        check_key_size(key_size, insecure_keys)
+        keys = load_or_generate_keys(key_file, key_size)
+        # Key file may hold keys of another size.
+        check_key_size(key_size_of(keys), insecure_keys)
         self.public_key = keys[:2]
         self.private_key = keys[2:4]
+        self.primes = keys[4:6]
+
+        self.require_proofs = require_proofs
+
+        self.encryptor = Encryptor(self.public_key, pool_size=RANDOMIZER_POOL_SIZE)
+        self.decryptor = Decryptor(self.public_key, self.private_key, primes=self.primes)
+
+        packing = trust_packed_ballots and can_pack(
+            self.public_key[0], NUMBER_OF_CANDIDATES, NUMBER_OF_MARKS, PACKING_SLOT_WIDTH)
+        # Bounded extraction relies on valid ballots, so it is only used when every ballot carries a validity proof.
+        # Packed ballots are never accepted together with proofs.
+        extraction = Aggregator.BOUNDED if require_proofs else Aggregator.FULL
+        shard = load_or_generate_shard(journal_dir) if journal_dir is not None else None
+        self.aggregator = Aggregator(self.encryptor, self.decryptor, NUMBER_OF_CANDIDATES, NUMBER_OF_MARKS,
+                                     workers=AGGREGATION_WORKERS, extraction=extraction,
+                                     slot_width=PACKING_SLOT_WIDTH if packing else None, shard=shard)
+
+        # Votes may be processed from several threads, accumulation into the aggregator is serialized.
+        self.lock = threading.Lock()
+
+        self.credentials = None
+        if credentials_file is not None:
+            self.credentials = CredentialRegistry(credentials_file)
 
-        self.encryptor = Encryptor(self.public_key)
-        self.decryptor = Decryptor(self.public_key, self.private_key)
+        # Digests of voter tokens of the ballots journaled since the latest snapshot.
+        self.credentials_since_checkpoint = []
 
-        self.aggregator = Aggregator(self.encryptor, self.decryptor, NUMBER_OF_CANDIDATES, NUMBER_OF_MARKS)
+        # Checkpoint is prepared under the lock as (tally, journal position, token digests) and written after
+        # the lock is released, so that ingestion does not wait for disk syncs. Checkpoints are written one at a time.
+        self.pending_checkpoint = None
+        self.checkpoint_lock = threading.Lock()
 
-    # Adds new matrix of votes.
+        self.journal = None
+        if journal_dir is not None:
+            self.used_credentials_path = os.path.join(journal_dir, USED_CREDENTIALS_FILE)
+            if self.credentials is not None:
+                self.credentials.load_used(self.used_credentials_path)
+            self.journal = BallotJournal(journal_dir)
+            replayed = self.journal.restore(self.aggregator, self.credentials)
+            # Replayed tokens must be saved by the next checkpoint, since its snapshot skips their journal records.
+            self.credentials_since_checkpoint = list(self.journal.restored_credentials)
+            print(f'Restored {self.aggregator.ballots} votes, {replayed} journal records replayed')
+
+    # Adds new matrix of votes received in text format. The first line may hold the voter credential token.
     def process(self, data):
-        data = [[int(it) for it in row.split(',')] for row in data.split('\n')]
-        self.aggregator.add_vote(data)
+        token = None
+        if data.startswith(CREDENTIAL_LINE):
+            line, data = data.split('\n', 1)
+            token = line[len(CREDENTIAL_LINE):]
+
+        self.check_unproven()
+        matrix = [[int(it) for it in row.split(',')] for row in data.split('\n')]
+        self.with_credential(token, lambda digest: self.add_vote(matrix, digest=digest))
+
+    # Adds new matrix of votes received in binary format. Digest is the claimed voter token, if any.
+    def process_binary(self, payload, digest=None):
+        self.check_unproven()
+        self.add_vote(decode_matrix(payload), payload, digest)
+
+    # Adds ballot packed into a single ciphertext, received in binary format.
+    def process_packed(self, payload, digest=None):
+        self.check_unproven()
+        self.check_credential(digest)
+        rows, cols, width, ciphertext = decode_packed_ballot(payload)
+        self.check_ciphertexts([[ciphertext]])
+        with self.lock:
+            self.check_journal()
+            self.aggregator.add_packed_vote(ciphertext, (rows, cols), width)
+            sequence = self.journal_vote(None, payload, RECORD_PACKED_BALLOT, digest)
+
+        self.wait_durable(sequence)
+
+    # Adds packed ballot like process_packed. Returns status of the ballot instead of raising if it is rejected.
+    def process_packed_status(self, payload):
+        try:
+            self.process_packed(payload)
+        except Exception as e:
+            print(f"Rejected vote: {e}")
+            return STATUS_ERROR
+
+        return STATUS_SUCCESS
+
+    # Adds ballot received in a binary frame, either as a matrix, packed or with proof of its validity.
+    # Any of them may be wrapped into a credential ballot frame together with the voter token.
+    def process_ballot_frame(self, frame):
+        token = None
+        if frame[0] == FRAME_CREDENTIAL_BALLOT:
+            token, frame = decode_credential_ballot(frame[1])
+
+        self.with_credential(token, lambda digest: self.process_ballot(frame, digest))
+
+    # Adds ballot frame like process_ballot_frame. Returns status of the ballot instead of raising if it is rejected.
+    def process_ballot_frame_status(self, frame):
+        try:
+            self.process_ballot_frame(frame)
+        except Exception as e:
+            print(f"Rejected vote: {e}")
+            return STATUS_ERROR
+
+        return STATUS_SUCCESS
+
+    # Adds ballot frame that is not wrapped. Digest is the claimed voter token, if any.
+    def process_ballot(self, frame, digest=None):
+        if frame[0] == FRAME_PACKED_BALLOT:
+            self.process_packed(frame[1], digest)
+        elif frame[0] == FRAME_PROVEN_BALLOT:
+            if self.process_proven_batch([frame[1]], [digest])[0] != STATUS_SUCCESS:
+                raise Exception('Ballot is rejected')
+        else:
+            self.process_binary(expect_frame(frame, FRAME_BALLOT), digest)
+
+    # Adds batch of matrices of votes received in binary format. Returns status of every matrix.
+    def process_batch(self, payloads):
+        try:
+            self.check_unproven()
+            self.check_credential(None)
+        except Exception as e:
+            print(f"Rejected votes: {e}")
+            return [STATUS_ERROR] * len(payloads)
+
+        matrices = []
+        statuses = []
+        for payload in payloads:
+            try:
+                matrices.append(decode_matrix(payload))
+                statuses.append(STATUS_SUCCESS)
+            except ProtocolError:
+                matrices.append(None)
+                statuses.append(STATUS_ERROR)
+
+        return self.add_votes(matrices, payloads, statuses)
+
+    # Adds batch of ballots with proofs of their validity received in binary format. Proofs of the whole batch
+    # are verified at once and ballots with invalid proofs are rejected. Returns status of every ballot.
+    # Digests are the claimed voter tokens of the ballots, if any.
+    def process_proven_batch(self, payloads, digests=None):
+        try:
+            self.check_credential(digests)
+        except CredentialError as e:
+            print(f"Rejected votes: {e}")
+            return [STATUS_ERROR] * len(payloads)
+
+        matrices = []
+        matrix_payloads = []
+        proofs = []
+        for payload in payloads:
+            matrix, matrix_payload, proof = None, None, None
+            try:
+                matrix_payload, proof_payload = decode_proven_ballot(payload)
+                matrix, proof = decode_matrix(matrix_payload), decode_proof(proof_payload)
+            except ProtocolError:
+                matrix, proof = None, None
+
+            matrices.append(matrix)
+            matrix_payloads.append(bytes(matrix_payload) if matrix_payload is not None else None)
+            proofs.append(proof)
+
+        proven = [i for i, proof in enumerate(proofs) if proof is not None]
+        valid = verify_ballots([(matrices[i], proofs[i]) for i in proven], self.public_key)
+
+        statuses = [STATUS_ERROR] * len(payloads)
+        for i, is_valid in zip(proven, valid):
+            if is_valid:
+                statuses[i] = STATUS_SUCCESS
+            else:
+                print("Rejected vote: invalid proof")
+                matrices[i] = None
+
+        return self.add_votes(matrices, matrix_payloads, statuses, digests)
+
+    # Adds decoded matrices of votes, skipping the missing ones. Journal records hold the payloads of the matrices
+    # and digests of the voter tokens, if any. Updates statuses of rejected votes and returns them.
+    def add_votes(self, matrices, payloads, statuses, digests=None):
+        sequence = None
+        with self.lock:
+            self.check_journal()
+            for i, matrix in enumerate(matrices):
+                if matrix is None:
+                    continue
+                try:
+                    self.check_ciphertexts(matrix)
+                    self.aggregator.add_vote(matrix)
+                except Exception as e:
+                    print(f"Rejected vote: {e}")
+                    statuses[i] = STATUS_ERROR
+                else:
+                    sequence = self.journal_vote(matrix, payloads[i], digest=digests[i] if digests else None)
+
+        self.wait_durable(sequence)
+        return statuses
+
+    # Raises if ballots without proofs of their validity are not accepted.
+    def check_unproven(self):
+        if self.require_proofs:
+            raise Exception('Ballots must be sent with validity proofs')
+
+    # Raises if ballots without voter credentials are not accepted and the digest of the token is missing.
+    def check_credential(self, digest):
+        if self.credentials is not None and digest is None:
+            raise CredentialError('Voter credential is required')
+
+    # Claims the voter token and calls function with its digest. The token is returned back if the function raises.
+    # Without credentials registry the token is not checked and the digest is None.
+    def with_credential(self, token, function):
+        if self.credentials is None:
+            return function(None)
+
+        self.check_credential(token)
+        digest = self.credentials.claim(token)
+        try:
+            return function(digest)
+        except JournalError:
+            # Ballot may have been counted before the journal failed, so the token stays used.
+            raise
+        except Exception:
+            self.credentials.release(digest)
+            raise
+
+    # Adds new matrix of encrypted votes. Payload is the matrix in binary format, if already available.
+    # Digest is the claimed voter token, if any.
+    def add_vote(self, matrix, payload=None, digest=None):
+        self.check_credential(digest)
+        # Ballot is checked and encoded before it is counted, so that a counted ballot is always journaled.
+        self.check_ciphertexts(matrix)
+        if payload is None and self.journal is not None:
+            payload = encode_matrix(matrix, ciphertext_width(self.public_key[0]))
+        with self.lock:
+            self.check_journal()
+            self.aggregator.add_vote(matrix)
+            sequence = self.journal_vote(matrix, payload, digest=digest)
+
+        self.wait_durable(sequence)
+
+    # Appends accepted vote to the journal and writes a snapshot when it is due. Must be called under the lock.
+    # Vote with digest of the voter token is journaled as credential ballot. Returns sequence number of the record.
+    def journal_vote(self, matrix, payload=None, kind=RECORD_BALLOT, digest=None):
+        if self.journal is None:
+            return None
+
+        if payload is None:
+            payload = encode_matrix(matrix, ciphertext_width(self.public_key[0]))
+        if digest is not None:
+            payload, kind = encode_credential_record(digest, kind, payload), RECORD_CREDENTIAL_BALLOT
+            self.credentials_since_checkpoint.append(digest)
+
+        sequence = self.journal.append(payload, kind)
+        if self.journal.records_since_checkpoint >= CHECKPOINT_INTERVAL:
+            self.prepare_checkpoint()
+
+        return sequence
+
+    # Takes the tally and tokens for the checkpoint, which is written by write_checkpoint. Must be called under
+    # the lock. Checkpoint that is not written yet is replaced, its tokens are kept.
+    def prepare_checkpoint(self):
+        digests, self.credentials_since_checkpoint = self.credentials_since_checkpoint, []
+        if self.pending_checkpoint is not None:
+            digests = self.pending_checkpoint[2] + digests
+
+        position = self.journal.start_checkpoint()
+        self.pending_checkpoint = (self.encode_tally(), position, digests)
+
+    # Writes the prepared checkpoint, if any. Must be called without the lock.
+    # Tokens are saved before the snapshot, so that they are never lost together with the journal records.
+    def write_checkpoint(self):
+        if self.pending_checkpoint is None:
+            return
+
+        with self.checkpoint_lock:
+            with self.lock:
+                checkpoint, self.pending_checkpoint = self.pending_checkpoint, None
+            if checkpoint is None:
+                return
+
+            tally, position, digests = checkpoint
+            try:
+                if len(digests) > 0:
+                    append_used(self.used_credentials_path, digests)
+                self.journal.checkpoint(tally, position)
+            except Exception:
+                # Tokens are saved by the next checkpoint then.
+                with self.lock:
+                    self.credentials_since_checkpoint = digests + self.credentials_since_checkpoint
+                raise
+
+    # Writes due checkpoint and waits until the journal record is synced to disk, so that the vote survives a crash.
+    def wait_durable(self, sequence):
+        self.write_checkpoint()
+        if sequence is not None:
+            self.journal.wait(sequence)
+
+    # Raises if any value of the matrix is not a ciphertext, i.e. an integer in range (0, n^2).
+    def check_ciphertexts(self, matrix):
+        modulo = self.public_key[0] * self.public_key[0]
+        for row in matrix:
+            for value in row:
+                if not 0 < value < modulo:
+                    raise ProtocolError('Ballot value is not a ciphertext')
+
+    # Raises if the journal can no longer write records, so that no ballot is counted without being journaled.
+    def check_journal(self):
+        if self.journal is not None:
+            self.journal.check()
+
+    # Returns depths of the queues of accepted votes as {stage: depth}.
+    def queue_depths(self):
+        if self.journal is None:
+            return {}
+        return {STAGE_JOURNAL: self.journal.pending()}
+
+    # Returns serialized partial tally of this node.
+    def export_tally(self):
+        with self.lock:
+            return self.encode_tally()
+
+    # Serializes the tally of the aggregator. Must be called under the lock.
+    def encode_tally(self):
+        ballots, matrix, shards = self.aggregator.export_tally()
+        return encode_tally(ballots, self.public_key, matrix, shards)
+
+    # Merges partial tally of another node. Raises if the tally has already been merged.
+    def merge_tally(self, payload):
+        ballots, matrix, shards = decode_tally(payload, self.public_key)
+        self.check_ciphertexts(matrix)
+        with self.lock:
+            self.check_journal()
+            self.aggregator.merge_tally(ballots, matrix, shards)
+            sequence = self.journal_vote(None, payload, RECORD_TALLY)
+
+        self.wait_durable(sequence)
 
     # Aggregates and returns the winner.
     def aggregate(self):
-        return self.aggregator.aggregate()
+        with self.lock:
+            return self.aggregator.aggregate()
+
+    # Stops background work and closes the journal.
+    def close(self):
+        self.encryptor.close()
+        if self.credentials is not None:
+            self.credentials.close()
+        if self.journal is not None:
+            self.journal.close()
@@ -0,0 +1,125 @@
+# Big integer arithmetic backends used by cryptosystem modules.
+# Following backends are implemented:
+# 1. python: pure Python reference implementation.
+# 2. builtin: Python built-in pow.
+# 3. gmpy2: GMP based implementation, available only if gmpy2 is installed.
+# Backend is selected at startup by LEGIT_ELECTIONS_BACKEND environment variable,
+# otherwise the fastest available one is used.
+
+import os
+import sys
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+BACKEND_ENVIRONMENT_VARIABLE = 'LEGIT_ELECTIONS_BACKEND'
+
+
+# Calculates the extended gcd iteratively. Returns (g, x, y) such that a * x + b * y = g.
+def gcdex(a, b):
+    assert a >= 0 and b >= 0
+
+    x, y, next_x, next_y = 0, 1, 1, 0
+    while a != 0:
+        quotient = b // a
+        a, b = b % a, a
+        x, next_x = next_x, x - quotient * next_x
+        y, next_y = next_y, y - quotient * next_y
+
+    return b, x, y
+
+
+# Reference implementation written in pure Python.
+class PythonBackend(object):
+    name = 'python'
+
+    # Calculates a to the power of b modulo mod.
+    @staticmethod
+    def powmod(a, b, mod):
+        a = (a + mod) % mod
+        res = 1
+        while b > 0:
+            if b & 1:
+                res = (res * a) % mod
+
+            b = b >> 1
+            a = (a * a) % mod
+
+        return res
+
+    # Calculates the inverse number to inv modulo mod.
+    @staticmethod
+    def invmod(inv, mod):
+        inv = (inv + mod) % mod
+        g, x, y = gcdex(inv, mod)
+        return (x + mod) % mod
+
+
+# Implementation using Python built-in pow.
+class BuiltinBackend(object):
+    name = 'builtin'
+
+    # Calculates a to the power of b modulo mod.
+    @staticmethod
+    def powmod(a, b, mod):
+        return pow(a, b, mod)
+
+    # Calculates the inverse number to inv modulo mod.
+    # Negative exponents in pow are supported starting from Python 3.8.
+    if sys.version_info >= (3, 8):
+        @staticmethod
+        def invmod(inv, mod):
+            return pow(inv, -1, mod)
+    else:
+        invmod = staticmethod(PythonBackend.invmod)
+
+
+# Implementation using gmpy2. Results are converted back to int.
+class Gmpy2Backend(object):
+    name = 'gmpy2'
+
+    # Calculates a to the power of b modulo mod.
+    @staticmethod
+    def powmod(a, b, mod):
+        return int(gmpy2.powmod(a, b, mod))
+
+    # Calculates the inverse number to inv modulo mod.
+    @staticmethod
+    def invmod(inv, mod):
+        return int(gmpy2.invert(inv, mod))
+
+
+BACKENDS = {backend.name: backend for backend in (PythonBackend, BuiltinBackend, Gmpy2Backend)}
+
+
+# Checks whether the backend can be used in current environment.
+def is_available(name):
+    return name in BACKENDS and (name != Gmpy2Backend.name or gmpy2 is not None)
+
+
+# Returns names of all backends that can be used.
+def available_backends():
+    return [name for name in BACKENDS if is_available(name)]
+
+
+# Selects the backend used by powmod and invmod.
+# If name is not provided, it is read from the environment or the fastest available backend is used.
+def select_backend(name=None):
+    global backend
+
+    if name is None:
+        name = os.environ.get(BACKEND_ENVIRONMENT_VARIABLE)
+
+    if name is None:
+        name = Gmpy2Backend.name if is_available(Gmpy2Backend.name) else BuiltinBackend.name
+
+    if not is_available(name):
+        raise Exception(f'Arithmetic backend {name} is not available. Available backends: {available_backends()}')
+
+    backend = BACKENDS[name]
+    return backend
+
+
+backend = select_backend()
@@ -1,5 +1,8 @@
 # Initializes the cryptosystem by generating the private and public keys.
 
+import argparse
+import json
+import os
 import time
 from cryptosystem.cryptosystem_utils import *
 
@@ -9,16 +12,45 @@ from cryptosystem.cryptosystem_utils import *
 # Currently small number, but needs to be updated when is_prime method is changed.
 BIT_LENGTH = 64
 
+# Bit length of the public modulus n of test keys. Election servers refuse keys shorter than PRODUCTION_KEY_SIZES
+# unless insecure keys are allowed.
+KEY_SIZE = 2 * BIT_LENGTH
+PRODUCTION_KEY_SIZES = (2048, 3072)
+
+# Names of the key components in the order they are returned by generate_keys.
+KEY_FIELDS = ('n', 'g', 'phi', 's', 'p', 'q')
+
+
+# Keys shorter than the production key sizes are refused, unless insecure keys are allowed for tests and development.
+def check_key_size(key_size, insecure_keys=False):
+    if key_size < PRODUCTION_KEY_SIZES[0] and not insecure_keys:
+        raise Exception(f'Key of {key_size} bits is shorter than production keys of {PRODUCTION_KEY_SIZES[0]} bits, '
+                        f'insecure keys must be allowed explicitly')
+
+
+# Returns bit length of the modulus n the keys were generated for. Primes have exactly half of its bits.
+def key_size_of(keys):
+    return 2 * max(keys[4], keys[5]).bit_length()
+
 
 # Generates public and private keys for the host.
-def generate_keys():
-    start = time.clock()
+def generate_keys(key_size=KEY_SIZE, parallel=None):
+    start = time.perf_counter()
 
     # Generate primes.
-    prime_p, prime_q = generate_primes(BIT_LENGTH)
+    prime_p, prime_q = generate_primes(key_size // 2, parallel)
 
     print(f'Primes got: {prime_p, prime_q}')
 
+    keys = keys_from_primes(prime_p, prime_q)
+
+    print(f"Time spent for key generation: {time.perf_counter() - start}")
+
+    return keys
+
+
+# Calculates public and private keys from the primes.
+def keys_from_primes(prime_p, prime_q):
     # Calculate public key.
     public_n = prime_p * prime_q
     public_g = public_n + 1
@@ -27,6 +59,49 @@ def generate_keys():
     private_phi = (prime_p-1) * (prime_q-1)
     private_s = invmod(private_phi, public_n)
 
-    print(f"Time spent for key generation: {time.clock() - start}")
+    return public_n, public_g, private_phi, private_s, prime_p, prime_q
+
+
+# Saves keys to the file. The file contains private key, so it is readable only by the owner.
+def save_keys(keys, path):
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'w') as key_file:
+        json.dump(dict(zip(KEY_FIELDS, keys)), key_file)
+
+
+# Loads keys previously saved by save_keys.
+def load_keys(path):
+    with open(path) as key_file:
+        stored = json.load(key_file)
+
+    keys = keys_from_primes(stored['p'], stored['q'])
+    if tuple(stored.get(field) for field in KEY_FIELDS) != keys:
+        raise Exception(f'Key file {path} is corrupted')
+
+    return keys
+
+
+# Loads keys from the file if it exists. Otherwise generates keys and saves them to the file.
+def load_or_generate_keys(path=None, key_size=KEY_SIZE):
+    if path is not None and os.path.exists(path):
+        return load_keys(path)
+
+    keys = generate_keys(key_size)
+    if path is not None:
+        save_keys(keys, path)
+
+    return keys
+
+
+# Pre-generates key material so that the server does not generate keys on startup.
+def main():
+    parser = argparse.ArgumentParser(description='Generate election keys.')
+    parser.add_argument('output', help='path of the key file')
+    parser.add_argument('--key-size', type=int, default=PRODUCTION_KEY_SIZES[0], help='bit length of the modulus n')
+    args = parser.parse_args()
+
+    save_keys(generate_keys(args.key_size), args.output)
+
 
-    return public_n, public_g, private_phi, private_s
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,30 @@
 # Utils used by cryptosystem modules.
 
+from concurrent.futures import ProcessPoolExecutor
 from Crypto.Util import number
+from math import gcd
 from random import randint
+import numpy as np
+from cryptosystem import arithmetic
+
+
+# Primes of at least this bit length are searched for in parallel processes.
+# For shorter primes starting the processes costs more than the search itself.
+PARALLEL_PRIME_BIT_LENGTH = 512
 
 
 # Generates two random primes.
-def generate_primes(bit_length):
-    prime_p = generate_random_prime(bit_length)
-    prime_q = generate_random_prime(bit_length)
+# If parallel is not provided, primes are searched for in parallel only for long bit lengths.
+def generate_primes(bit_length, parallel=None):
+    if parallel is None:
+        parallel = bit_length >= PARALLEL_PRIME_BIT_LENGTH
+
+    if parallel:
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            prime_p, prime_q = executor.map(generate_random_prime, [bit_length, bit_length])
+    else:
+        prime_p = generate_random_prime(bit_length)
+        prime_q = generate_random_prime(bit_length)
 
     while prime_q == prime_p:
         prime_q = generate_random_prime(bit_length)
@@ -23,7 +40,7 @@ def generate_random_prime(bit_length):
 # Generates a coprime to a given integer.
 def generate_coprime(n):
     r = randint(1, n - 1)
-    while gcdex(r, n)[0] != 1:
+    while gcd(r, n) != 1:
         r = randint(1, n - 1)
 
     return r
@@ -31,31 +48,45 @@ def generate_coprime(n):
 
 # Calculates a to the power of b modulo mod.
 def powmod(a, b, mod):
-    a = (a + mod) % mod
-    res = 1
-    while b > 0:
-        if b & 1:
-            res = (res * a) % mod
+    return arithmetic.backend.powmod(a, b, mod)
 
-        b = b >> 1
-        a = (a * a) % mod
 
-    return res
+# Calculates the inverse number to inv modulo mod.
+def invmod(inv, mod):
+    return arithmetic.backend.invmod(inv, mod)
 
 
-# Calculates the extended gcd.
-def gcdex(a, b):
-    assert a >= 0 and b >= 0
+# Calculates a to the power of b modulo mod elementwise. Arguments may be arrays or scalars.
+def powmod_many(a, b, mod):
+    return np.frompyfunc(powmod, 3, 1)(a, b, mod)
 
-    if a == 0:
-        return b, 0, 1
 
-    g, x, y = gcdex(b % a, a)
-    return g, y - (b // a) * x, x
+# Calculates inverse numbers to all elements of the array modulo mod. Returns array of the same shape.
+def invmod_many(inv, mod):
+    inv = np.asarray(inv, dtype=object)
+    result = np.empty(inv.shape, dtype=object)
+    result.flat[:] = batch_invmod(list(inv.flat), mod)
+    return result
 
 
-# Calculates the inverse number to inv modulo mod.
-def invmod(inv, mod):
-    inv = (inv + mod) % mod
-    g, x, y = gcdex(inv, mod)
-    return (x + mod) % mod
+# Calculates inverse numbers to all values modulo mod with Montgomery's trick:
+# one inversion of the product of all values and 3(k - 1) multiplications.
+# Fails like invmod if any of the values is not invertible.
+def batch_invmod(values, mod):
+    if len(values) == 0:
+        return []
+
+    # prefix[i] is the product of the first i + 1 values.
+    prefix = [values[0] % mod]
+    for value in values[1:]:
+        prefix.append((prefix[-1] * value) % mod)
+
+    inverse = invmod(prefix[-1], mod)
+
+    inverses = [0] * len(values)
+    for i in range(len(values) - 1, 0, -1):
+        inverses[i] = (inverse * prefix[i - 1]) % mod
+        inverse = (inverse * values[i]) % mod
+    inverses[0] = inverse
+
+    return inverses
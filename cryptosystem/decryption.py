@@ -1,42 +1,75 @@
 # Defines Decryptor that is used to decrypt a message.
 
-import time
 from cryptosystem.cryptosystem_utils import *
 
 
 class Decryptor(object):
 
     # Constructor.
-    def __init__(self, pub_key, priv_key):
+    # If primes (p, q) are provided, decryption is done modulo p^2 and q^2 and combined using CRT.
+    def __init__(self, pub_key, priv_key, primes=None):
         if len(pub_key) != 2:
             raise Exception(f'Did not provide correct number of arguments for the public _key. Received {pub_key}')
 
         if len(priv_key) != 2:
             raise Exception(f'Did not provide correct number of arguments for the private key. Received {priv_key}')
 
+        if primes is not None and (len(primes) != 2 or primes[0] * primes[1] != pub_key[0]):
+            raise Exception(f'Provided primes do not match the public key. Received {primes}')
+
         # Public key is (n, g).
         self.public_key = pub_key
 
         # Private key is (phi, s).
         self.private_key = priv_key
 
+        # Modulo is n^2.
+        self.n = pub_key[0]
+        self.modulo = self.n * self.n
+
+        self.primes = primes
+        if primes is not None:
+            self.precompute_crt(primes[0], primes[1])
+
+    # Precomputes constants used by CRT decryption.
+    def precompute_crt(self, p, q):
+        self.p, self.q = p, q
+        self.p_square, self.q_square = p * p, q * q
+
+        # hp = L_p((g^(p-1)) % p^2)^(-1) % p and the same for q.
+        self.hp = invmod(self.l_function(powmod(self.public_key[1], p - 1, self.p_square), p), p)
+        self.hq = invmod(self.l_function(powmod(self.public_key[1], q - 1, self.q_square), q), q)
+
+        # Inverse of q modulo p used to combine the residues.
+        self.q_inverse = invmod(q, p)
+
     # Decrypts the message.
     def decrypt(self, encrypted_message):
-        start = time.clock()
-
-        # Modulo is n^2.
-        modulo = self.public_key[0] * self.public_key[0]
+        if self.primes is not None:
+            return self.decrypt_crt(encrypted_message)
 
         # Calculate (cipher ^ phi) % n^2.
-        res = powmod(encrypted_message, self.private_key[0], modulo)
+        res = powmod(encrypted_message, self.private_key[0], self.modulo)
+
+        # Return (L(res) * s) % n.
+        return (self.l_function(res, self.n) * self.private_key[1]) % self.n
+
+    # Decrypts all messages in the list.
+    def decrypt_many(self, encrypted_messages):
+        return [self.decrypt(encrypted_message) for encrypted_message in encrypted_messages]
 
-        # According to algorithm, n must divide (res - 1).
-        if (res - 1) % self.public_key[0] != 0:
-            raise Exception(f'Error in cryptosystem. Decryption failed with this value: {res}')
+    # Decrypts the message modulo p^2 and q^2 and combines the results.
+    def decrypt_crt(self, encrypted_message):
+        m_p = (self.l_function(powmod(encrypted_message, self.p - 1, self.p_square), self.p) * self.hp) % self.p
+        m_q = (self.l_function(powmod(encrypted_message, self.q - 1, self.q_square), self.q) * self.hq) % self.q
 
-        res = (res - 1) // self.public_key[0]
+        return m_q + self.q * (((m_p - m_q) * self.q_inverse) % self.p)
 
-        # print(f'Time spent for message decryption {time.clock() - start}')
+    # Calculates L(x) = (x - 1) / d.
+    @staticmethod
+    def l_function(x, d):
+        # According to algorithm, d must divide (x - 1).
+        if (x - 1) % d != 0:
+            raise Exception(f'Error in cryptosystem. Decryption failed with this value: {x}')
 
-        # Return (res * s) % n.
-        return (res * self.private_key[1]) % self.public_key[0]
+        return (x - 1) // d
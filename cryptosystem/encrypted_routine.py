@@ -3,87 +3,215 @@
 # 1. Conditional gate: Encrypted equivalent of x * y, where y = 0 or 1.
 # 2. Addition gate: Encrypted equivalent pf x + y.
 # 3. Bit extraction gate: Extracting encrypted bits from encrypted value x.
+#    Bounded variant extracts only the bits needed for values up to a known bound.
 # 4. Greater than gate: comparing two encrypted values.
+#
+# Every gate has a batched variant (with _many suffix) that evaluates the gate for many inputs at once.
+# Batched gates collect all decryptions needed by one layer of the circuit and resolve them
+# with a single decryptor.decrypt_many call, so the number of decryption rounds does not depend on
+# the number of inputs.
 
+import numpy as np
 from cryptosystem.cryptosystem_utils import *
 
+# Values masked by bounded bit extraction are hidden with probability of failure about 2^-STATISTICAL_SECURITY.
+STATISTICAL_SECURITY = 40
+
 
 # Conditional gate.
 def conditional_gate(encrypted_x, encrypted_y, decryptor):
-    y = decryptor.decrypt(encrypted_y)
-    assert y == 0 or y == 1
+    return conditional_gate_many([encrypted_x], [encrypted_y], decryptor)[0]
+
+
+# Batched conditional gate. Decrypts all y in one round.
+def conditional_gate_many(encrypted_xs, encrypted_ys, decryptor):
+    modulo = decryptor.public_key[0] * decryptor.public_key[0]
 
-    return powmod(encrypted_x, y, decryptor.public_key[0] * decryptor.public_key[0])
+    ys = np.array(decryptor.decrypt_many(list(encrypted_ys)), dtype=object)
+    assert all(y == 0 or y == 1 for y in ys)
+
+    return list(powmod_many(np.array(encrypted_xs, dtype=object), ys, modulo))
 
 
 # Addition gate. Returns encrypted z = x + y.
 def addition_gate(bitwise_encrypted_x, bitwise_y, encryptor, decryptor):
+    return addition_gate_many([bitwise_encrypted_x], [bitwise_y], encryptor, decryptor)[0]
+
+
+# Batched addition gate. Bit i of all sums is calculated in one decryption round.
+# Arrays are stacked into matrices, so every step is applied to bit i of all values at once.
+def addition_gate_many(bitwise_encrypted_xs, bitwise_ys, encryptor, decryptor):
     n = encryptor.public_key[0]
     modulo = n * n
 
-    encrypted_carry = encryptor.encrypt(0)
-    bitwise_encrypted_result = []
+    count = len(bitwise_encrypted_xs)
+    lengths = [len(x) for x in bitwise_encrypted_xs]
+    xs, valid = stack_bit_arrays(bitwise_encrypted_xs, 1)
+    ys, _ = stack_bit_arrays(bitwise_ys, 0)
 
-    for i in range(0, len(bitwise_encrypted_x)):
-        encrypted_num = (bitwise_encrypted_x[i] * encryptor.encrypt(bitwise_y[i])) % modulo
-        encrypted_den = powmod(bitwise_encrypted_x[i], (bitwise_y[i] + bitwise_y[i]) % modulo, modulo)
-        encrypted_cur_bit = (encrypted_num * invmod(encrypted_den, modulo)) % modulo
+    encrypted_ys = np.ones(xs.shape, dtype=object)
+    encrypted_ys[valid] = encryptor.encrypt_many(list(ys[valid]))
+
+    # Denominators of current bits do not depend on carries, so all of them are inverted in one batch.
+    encrypted_sums = (xs * encrypted_ys) % modulo
+    encrypted_bit_dens = powmod_many(xs, (ys + ys) % modulo, modulo)
+    encrypted_cur_bits = np.ones(xs.shape, dtype=object)
+    encrypted_cur_bits[valid] = (encrypted_sums[valid] * invmod_many(encrypted_bit_dens[valid], modulo)) % modulo
+
+    encrypted_carries = np.array(encryptor.encrypt_many([0] * count), dtype=object)
+    encrypted_results = np.ones(xs.shape, dtype=object)
+
+    for i in range(0, xs.shape[1]):
+        active = np.nonzero(valid[:, i])[0]
+        encrypted_cur_bit, encrypted_carry = encrypted_cur_bits[active, i], encrypted_carries[active]
+
+        encrypted_product = np.array(conditional_gate_many(encrypted_cur_bit, encrypted_carry, decryptor), dtype=object)
 
         encrypted_num = (encrypted_cur_bit * encrypted_carry) % modulo
-        encrypted_den = powmod(conditional_gate(encrypted_cur_bit, encrypted_carry, decryptor), 2, modulo)
-        bitwise_encrypted_result.append((encrypted_num * invmod(encrypted_den, modulo)) % modulo)
+        encrypted_den = powmod_many(encrypted_product, 2, modulo)
+        encrypted_results[active, i] = (encrypted_num * invmod_many(encrypted_den, modulo)) % modulo
+
+        # (x + y + carry - result) is the product of both denominators, so it needs no inversion.
+        encrypted_next = (encrypted_bit_dens[active, i] * encrypted_den) % modulo
+        encrypted_carries[active] = powmod_many(encrypted_next, (n + 1) >> 1, modulo)
 
-        encrypted_num = (bitwise_encrypted_x[i] * encryptor.encrypt(bitwise_y[i]) * encrypted_carry) % modulo
-        encrypted_den = invmod(bitwise_encrypted_result[i], modulo)
-        encrypted_carry = powmod((encrypted_num * encrypted_den) % modulo, (n + 1) >> 1, modulo)
+    carries = decryptor.decrypt_many(list(encrypted_carries))
 
-    if decryptor.decrypt(encrypted_carry) > 0:
-        bitwise_encrypted_result.append(encrypted_carry)
+    bitwise_encrypted_results = []
+    for k in range(count):
+        bitwise_encrypted_result = list(encrypted_results[k, :lengths[k]])
+        if carries[k] > 0:
+            bitwise_encrypted_result.append(encrypted_carries[k])
+        bitwise_encrypted_results.append(bitwise_encrypted_result)
 
-    return bitwise_encrypted_result
+    return bitwise_encrypted_results
 
 
 # Bit extraction gate.
 def bit_extraction_gate(encrypted_x, encryptor, decryptor):
+    return bit_extraction_gate_many([encrypted_x], encryptor, decryptor)[0]
+
+
+# Batched bit extraction gate.
+def bit_extraction_gate_many(encrypted_xs, encryptor, decryptor):
+    n = encryptor.public_key[0]
+    modulo = n * n
+
+    # Get random coprimes to n.
+    ys = [generate_coprime(n) for _ in encrypted_xs]
+    encrypted_ys = np.array(encryptor.encrypt_many(ys), dtype=object)
+    encrypted_y_arrays = [encryptor.encrypt_many(convert_to_bit_array(y)) for y in ys]
+
+    encrypted_zs = (np.array(encrypted_xs, dtype=object) * invmod_many(encrypted_ys, modulo)) % modulo
+    zs = decryptor.decrypt_many(list(encrypted_zs))
+
+    z_arrays = []
+    for k in range(len(encrypted_xs)):
+        encrypted_y_arrays[k], z_array = prepare_different_arrays(
+            encrypted_y_arrays[k], convert_to_bit_array(zs[k]), encryptor)
+        z_arrays.append(z_array)
+
+    encrypted_x_arrays = addition_gate_many(encrypted_y_arrays, z_arrays, encryptor, decryptor)
+
+    return cut_many(encrypted_x_arrays, n, encryptor, decryptor)
+
+
+# Bit extraction gate for values known to be not greater than the bound.
+def bounded_bit_extraction_gate(encrypted_x, bound, encryptor, decryptor):
+    return bounded_bit_extraction_gate_many([encrypted_x], [bound], encryptor, decryptor)[0]
+
+
+# Batched bounded bit extraction gate. Returns bit arrays of fixed width bound.bit_length() for every value.
+# Value x is masked with random r that is STATISTICAL_SECURITY bits longer than the bound, so z = x + r does not
+# wrap modulo n and reveals nothing about x except with negligible probability. Low bits of z + (-r mod 2^width)
+# are the bits of x, so addition gate runs only over width bits instead of the bit length of n.
+# Falls back to the full bit extraction if n is too short for the mask.
+def bounded_bit_extraction_gate_many(encrypted_xs, bounds, encryptor, decryptor):
     n = encryptor.public_key[0]
     modulo = n * n
 
-    # Get random coprime to n.
-    y = generate_coprime(n)
-    y_array = convert_to_bit_array(y)
-    encrypted_y = encryptor.encrypt(y)
-    encrypted_y_array = [encryptor.encrypt(bit_y) for bit_y in y_array]
+    widths = [bit_width(bound) for bound in bounds]
+    if any(width + STATISTICAL_SECURITY + 1 >= n.bit_length() for width in widths):
+        return [cut_bit_array(bits, width, encryptor)
+                for bits, width in zip(bit_extraction_gate_many(encrypted_xs, encryptor, decryptor), widths)]
 
-    encrypted_z = (encrypted_x * invmod(encrypted_y, modulo)) % modulo
-    z = decryptor.decrypt(encrypted_z)
+    rs = [randint(1, 1 << (width + STATISTICAL_SECURITY)) for width in widths]
+    encrypted_zs = (np.array(encrypted_xs, dtype=object) * np.array(encryptor.encrypt_many(rs), dtype=object)) % modulo
+    zs = decryptor.decrypt_many(list(encrypted_zs))
 
-    encrypted_y_array, z_array = prepare_different_arrays(encrypted_y_array, convert_to_bit_array(z), encryptor)
-    encrypted_x_array = addition_gate(encrypted_y_array, z_array, encryptor, decryptor)
+    encrypted_r_arrays = [encryptor.encrypt_many(fixed_bit_array(-r % (1 << width), width))
+                          for r, width in zip(rs, widths)]
+    z_arrays = [fixed_bit_array(z % (1 << width), width) for z, width in zip(zs, widths)]
 
-    return cut(encrypted_x_array, n, encryptor, decryptor)
+    results = addition_gate_many(encrypted_r_arrays, z_arrays, encryptor, decryptor)
+    return [result[:width] for result, width in zip(results, widths)]
 
 
 # Returns 1 if encrypted_x is greater than encrypted_y.
 # Calculation is done using this formula: result = (1 - (x - y)^2) * t + x(y - 1).
 def greater_than_gate(bitwise_encrypted_x, bitwise_encrypted_y, encryptor, decryptor):
+    return greater_than_gate_many([bitwise_encrypted_x], [bitwise_encrypted_y], encryptor, decryptor)[0]
+
+
+# Batched greater than gate. Accepts lists of bit arrays or matrices with one bit array per row.
+# Products of bits of x and y do not depend on each other and are calculated in one round,
+# after that bit i of all comparisons is processed in one round.
+def greater_than_gate_many(bitwise_encrypted_xs, bitwise_encrypted_ys, encryptor, decryptor):
     n = encryptor.public_key[0]
     modulo = n * n
 
-    encrypted_result = encryptor.encrypt(0)
+    count = len(bitwise_encrypted_xs)
+    xs, valid = stack_bit_arrays(bitwise_encrypted_xs, 1)
+    ys, _ = stack_bit_arrays(bitwise_encrypted_ys, 1)
+
+    encrypted_cur_bits = np.ones(xs.shape, dtype=object)
+    encrypted_cur_bits[valid] = conditional_gate_many(xs[valid], ys[valid], decryptor)
+
+    # Both values inverted in the loop are known in advance, so all of them are inverted in one batch.
+    inverses = invmod_many(np.concatenate([(xs[valid] * ys[valid]) % modulo, encrypted_cur_bits[valid]]), modulo)
+    inverse_dens, inverse_cur_bits = np.ones(xs.shape, dtype=object), np.ones(xs.shape, dtype=object)
+    inverse_dens[valid], inverse_cur_bits[valid] = np.split(inverses, 2)
+
+    encrypted_results = np.array(encryptor.encrypt_many([0] * count), dtype=object)
+
+    for i in range(0, xs.shape[1]):
+        active = np.nonzero(valid[:, i])[0]
+        x, encrypted_cur_bit = xs[active, i], encrypted_cur_bits[active, i]
+
+        encrypted_ones = np.array(encryptor.encrypt_many([1] * len(active)), dtype=object)
+        encrypted_num = (encrypted_ones * powmod_many(encrypted_cur_bit, 2, modulo)) % modulo
+        encrypted_a = (encrypted_num * inverse_dens[active, i]) % modulo
+
+        encrypted_b = np.array(conditional_gate_many(encrypted_a, encrypted_results[active], decryptor), dtype=object)
+
+        encrypted_rest = (encrypted_b * x) % modulo
+        encrypted_results[active] = (encrypted_rest * inverse_cur_bits[active, i]) % modulo
+
+    return list(encrypted_results)
+
+
+# Stacks bit arrays of different lengths into a matrix with one array per row, padded with fill value.
+# Returns the matrix and the mask of positions that belong to the arrays.
+def stack_bit_arrays(bit_arrays, fill):
+    lengths = np.array([len(bit_array) for bit_array in bit_arrays], dtype=int)
+    width = int(lengths.max()) if len(bit_arrays) > 0 else 0
 
-    for i in range(0, len(bitwise_encrypted_x)):
-        encrypted_cur_bit = conditional_gate(bitwise_encrypted_x[i], bitwise_encrypted_y[i], decryptor)
+    valid = np.arange(width)[np.newaxis, :] < lengths[:, np.newaxis]
+    matrix = np.full((len(bit_arrays), width), fill, dtype=object)
+    for k, bit_array in enumerate(bit_arrays):
+        matrix[k, :lengths[k]] = list(bit_array)
 
-        encrypted_num = (encryptor.encrypt(1) * powmod(encrypted_cur_bit, 2, modulo)) % modulo
-        encrypted_den = (bitwise_encrypted_x[i] * bitwise_encrypted_y[i]) % modulo
-        encrypted_a = (encrypted_num * invmod(encrypted_den, modulo)) % modulo
+    return matrix, valid
 
-        encrypted_b = conditional_gate(encrypted_a, encrypted_result, decryptor)
 
-        encrypted_rest = (encrypted_b * bitwise_encrypted_x[i]) % modulo
-        encrypted_result = (encrypted_rest * invmod(encrypted_cur_bit, modulo)) % modulo
+# Pads encrypted bit arrays with encrypted zeros into a matrix with one array per row.
+# Trailing zeros do not change the value, so the rows may be compared with greater than gate.
+def pad_bit_arrays(bit_arrays, encryptor):
+    matrix, valid = stack_bit_arrays(bit_arrays, 1)
 
-    return encrypted_result
+    padding = ~valid
+    matrix[padding] = encryptor.encrypt_many([0] * int(padding.sum()))
+    return matrix
 
 
 # Converts integer to bit array starting from the least significant bit.
@@ -91,6 +219,21 @@ def convert_to_bit_array(x):
     return [int(x) for x in reversed("{0:b}".format(x))]
 
 
+# Returns number of bits needed to write all values from 0 to bound. At least one bit is used.
+def bit_width(bound):
+    return max(1, bound.bit_length())
+
+
+# Converts integer to bit array of the given width starting from the least significant bit.
+def fixed_bit_array(x, width):
+    return [(x >> i) & 1 for i in range(width)]
+
+
+# Cuts or pads encrypted bit array to the given width. Cut bits must be encrypted zeros.
+def cut_bit_array(encrypted_x, width, encryptor):
+    return list(encrypted_x[:width]) + encryptor.encrypt_many([0] * (width - len(encrypted_x)))
+
+
 # Prepares arrays of different kinds for addition gate by adding trailing zeros to make them equally sized.
 # First array is expected to be encrypted array.
 def prepare_different_arrays(encrypted_x, y, encryptor):
@@ -115,20 +258,33 @@ def prepare_similar_arrays(x, y, encryptor=None):
     return x, y
 
 
+# Decrypts all bits of all arrays in one round. Returns values modulo mod.
+def decrypt_arrays(encrypted_arrays, mod, decryptor):
+    encrypted_bits, valid = stack_bit_arrays(encrypted_arrays, 1)
+
+    bits = np.zeros(encrypted_bits.shape, dtype=object)
+    bits[valid] = decryptor.decrypt_many(list(encrypted_bits[valid]))
+
+    weights = np.array([1 << i for i in range(bits.shape[1])], dtype=object)
+    return [int(value) % mod for value in (bits * weights).sum(axis=1)]
+
+
 # Calculates new encrypted number modulo mod since value it represents may be larger than mod.
 def to_number(encrypted_array, mod, encryptor, decryptor):
-    result = 0
-    for i in range(0, len(encrypted_array)):
-        result = (result + decryptor.decrypt(encrypted_array[i]) * (1 << i)) % mod
+    return to_number_many([encrypted_array], mod, encryptor, decryptor)[0]
+
 
-    return encryptor.encrypt(result)
+# Batched to_number.
+def to_number_many(encrypted_arrays, mod, encryptor, decryptor):
+    return encryptor.encrypt_many(decrypt_arrays(encrypted_arrays, mod, decryptor))
 
 
 # Calculates new encrypted array modulo mod since value it represents may be larger than mod.
 def cut(encrypted_array, mod, encryptor, decryptor):
-    result = 0
-    for i in range(0, len(encrypted_array)):
-        result = (result + decryptor.decrypt(encrypted_array[i]) * (1 << i)) % mod
+    return cut_many([encrypted_array], mod, encryptor, decryptor)[0]
 
-    return [encryptor.encrypt(bit) for bit in convert_to_bit_array(result)]
 
+# Batched cut.
+def cut_many(encrypted_arrays, mod, encryptor, decryptor):
+    return [encryptor.encrypt_many(convert_to_bit_array(result))
+            for result in decrypt_arrays(encrypted_arrays, mod, decryptor)]
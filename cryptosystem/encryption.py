@@ -1,32 +1,124 @@
 # Defines Encryptor class that is used to encrypt messages.
 
-import time
+import threading
+from collections import deque
 from cryptosystem.cryptosystem_utils import *
 
 
+# Pool of precomputed randomizers (r^n) % n^2, where r is coprime to n.
+# Randomizers do not depend on the message, so they are computed ahead of time by a background thread.
+class RandomizerPool(object):
+
+    # Constructor.
+    def __init__(self, n, size):
+        self.n = n
+        self.modulo = n * n
+        self.size = size
+
+        self.randomizers = deque()
+        self.refill_event = threading.Event()
+        self.stop_signal = threading.Event()
+
+        self.refill_event.set()
+        self.thread = threading.Thread(target=self.refill_forever, daemon=True)
+        self.thread.start()
+
+    # Generates a single randomizer.
+    def generate(self):
+        return powmod(generate_coprime(self.n), self.n, self.modulo)
+
+    # Takes a randomizer from the pool. Falls back to computing it inline if the pool is drained.
+    def take(self):
+        try:
+            randomizer = self.randomizers.popleft()
+        except IndexError:
+            randomizer = self.generate()
+
+        if len(self.randomizers) < self.size // 2:
+            self.refill_event.set()
+
+        return randomizer
+
+    # Refills the pool whenever it runs low. Runs in the background thread.
+    def refill_forever(self):
+        while not self.stop_signal.is_set():
+            self.refill_event.wait()
+            self.refill_event.clear()
+
+            while len(self.randomizers) < self.size and not self.stop_signal.is_set():
+                self.randomizers.append(self.generate())
+
+    # Stops the background thread.
+    def stop(self):
+        self.stop_signal.set()
+        self.refill_event.set()
+        self.thread.join()
+
+
 class Encryptor(object):
 
     # Constructor.
-    def __init__(self, pub_key):
+    # If pool_size is positive, randomizers are precomputed in background by RandomizerPool.
+    def __init__(self, pub_key, pool_size=0):
         if len(pub_key) != 2:
             raise Exception(f'Did not provide correct number of arguments for the public _key. Received {pub_key}')
 
         # Public key is (n, g).
         self.public_key = pub_key
 
+        # Modulo is n^2.
+        self.n = pub_key[0]
+        self.modulo = self.n * self.n
+
+        # With g = n + 1 we have (g^M) % n^2 = (1 + M * n) % n^2, so no exponentiation is needed.
+        self.fast_base = pub_key[1] == self.n + 1
+
+        self.pool_size = pool_size
+        self.pool = RandomizerPool(self.n, pool_size) if pool_size > 0 else None
+
+    # Pool is not pickled with the encryptor, it is started again after unpickling.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.pool_size > 0:
+            self.pool = RandomizerPool(self.n, self.pool_size)
+
     # Encrypts the message.
     def encrypt(self, message):
-        start = time.clock()
+        return (self.encode(message) * self.randomizer()) % self.modulo
 
-        # Modulo is n^2.
-        modulo = self.public_key[0] * self.public_key[0]
+    # Encrypts all messages in the list.
+    def encrypt_many(self, messages):
+        return [(self.encode(message) * self.randomizer()) % self.modulo for message in messages]
+
+    # Encrypts all messages and returns the ciphertexts with randomness r used for every one of them.
+    # Randomness is needed to prove what the ciphertexts encrypt, so the pool is not used.
+    def encrypt_many_with_randomness(self, messages):
+        randomness = [generate_coprime(self.n) for _ in messages]
+        ciphertexts = [(self.encode(message) * powmod(r, self.n, self.modulo)) % self.modulo
+                       for message, r in zip(messages, randomness)]
+        return ciphertexts, randomness
+
+    # Calculates (g^M) % n^2.
+    def encode(self, message):
+        if self.fast_base:
+            return (1 + message * self.n) % self.modulo
 
-        # First is (g^M) % n^2.
-        first = powmod(self.public_key[1], message, modulo)
+        return powmod(self.public_key[1], message, self.modulo)
 
-        # Second is (r^n) % n^2, where r is coprime to n.
-        second = powmod(generate_coprime(self.public_key[0]), self.public_key[0], modulo)
+    # Calculates (r^n) % n^2, where r is coprime to n.
+    def randomizer(self):
+        if self.pool is not None:
+            return self.pool.take()
 
-        # print(f'Time spent for message encryption {time.clock() - start}')
+        return powmod(generate_coprime(self.n), self.n, self.modulo)
 
-        return (first * second) % modulo
+    # Stops background precomputation, if any.
+    def close(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
@@ -0,0 +1,201 @@
+# Counters and timers of the hot path: encryption, decryption, powmod, invmod and gates.
+# Every measurement is attributed to the stage of aggregation that is running when it is made.
+#
+# Instrumentation is disabled by default and costs nothing then: enable replaces the measured functions with
+# wrappers that count and time the calls, disable puts the original functions back.
+# Functions imported into other modules with wildcard imports are replaced there as well.
+
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from cryptosystem import arithmetic, encrypted_routine
+from cryptosystem.decryption import Decryptor
+from cryptosystem.encryption import Encryptor
+
+# Stage of measurements made outside of any stage, e.g. while accepting votes.
+DEFAULT_STAGE = 'other'
+
+# Aggregation stages.
+STAGE_CANDIDATE_MATRIX = 'candidate_matrix'
+STAGE_GRADE_VECTOR = 'grade_vector'
+STAGE_TIEBREAK = 'tiebreak'
+STAGE_COMPARISON = 'comparison'
+
+# Measured methods of the classes: (class, method, operation, position of the argument with list of values).
+# Decryptor.decrypt_many calls decrypt for every value, so it is not wrapped itself.
+METHODS = [
+    (Encryptor, 'encrypt', 'encrypt', None),
+    (Encryptor, 'encrypt_many', 'encrypt', 1),
+    (Decryptor, 'decrypt', 'decrypt', None),
+]
+
+# Measured gates. Single value gates delegate to the batched ones, so only the batched ones are wrapped.
+GATES = ['conditional_gate_many', 'addition_gate_many', 'bit_extraction_gate_many', 'bounded_bit_extraction_gate_many',
+         'greater_than_gate_many']
+
+# Prefix of the metric names in the Prometheus text format.
+METRIC_PREFIX = 'legit_elections'
+
+enabled = False
+
+# Counters keyed by (stage, operation). Every value is [number of operations, number of calls, seconds].
+counters = {}
+counters_lock = threading.Lock()
+
+# Current stage of the thread.
+local = threading.local()
+
+# Original functions replaced by enable, as (owner, name, original) triples.
+replaced = []
+
+
+# Arithmetic backend that counts and times the operations of the wrapped backend.
+class InstrumentedBackend(object):
+
+    # Constructor.
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.powmod = measure(backend.powmod, 'powmod')
+        self.invmod = measure(backend.invmod, 'invmod')
+
+
+# Returns stage of the current thread.
+def current_stage():
+    return getattr(local, 'stage', DEFAULT_STAGE)
+
+
+# Attributes measurements made inside the block to the stage.
+@contextmanager
+def stage(name):
+    previous = current_stage()
+    local.stage = name
+    try:
+        yield
+    finally:
+        local.stage = previous
+
+
+# Adds measurements to the counter of the operation in the current stage.
+def record(operation, operations, calls, seconds):
+    key = (current_stage(), operation)
+    with counters_lock:
+        counter = counters.setdefault(key, [0, 0, 0.0])
+        counter[0] += operations
+        counter[1] += calls
+        counter[2] += seconds
+
+
+# Wraps the function so that every call is counted and timed as the operation.
+# If items is set, it is the position of the argument with list of values, and every value is counted.
+def measure(function, operation, items=None):
+    def measured(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            operations = len(args[items]) if items is not None else 1
+            record(operation, operations, 1, elapsed)
+
+    measured.__name__ = getattr(function, '__name__', operation)
+    measured.__doc__ = getattr(function, '__doc__', None)
+    return measured
+
+
+# Replaces attribute of the owner and remembers the original one for disable.
+def replace(owner, name, value):
+    replaced.append((owner, name, getattr(owner, name)))
+    setattr(owner, name, value)
+
+
+# Starts counting and timing the hot path.
+def enable():
+    global enabled
+    if enabled:
+        return
+
+    replace(arithmetic, 'backend', InstrumentedBackend(arithmetic.backend))
+
+    for cls, name, operation, items in METHODS:
+        replace(cls, name, measure(getattr(cls, name), operation, items))
+
+    for name in GATES:
+        original = getattr(encrypted_routine, name)
+        wrapper = measure(original, name[:-len('_many')], 0)
+        for module in list(sys.modules.values()):
+            if getattr(module, name, None) is original:
+                replace(module, name, wrapper)
+
+    enabled = True
+
+
+# Stops counting and restores original functions. Collected counters are kept.
+def disable():
+    global enabled
+    while len(replaced) > 0:
+        owner, name, original = replaced.pop()
+        setattr(owner, name, original)
+
+    enabled = False
+
+
+# Clears collected counters.
+def reset():
+    with counters_lock:
+        counters.clear()
+
+
+# Returns collected counters as {stage: {operation: {'count': operations, 'calls': calls, 'seconds': seconds}}}.
+def snapshot():
+    with counters_lock:
+        items = [(key, list(counter)) for key, counter in counters.items()]
+
+    result = {}
+    for (stage_name, operation), (operations, calls, seconds) in sorted(items):
+        result.setdefault(stage_name, {})[operation] = {'count': operations, 'calls': calls, 'seconds': seconds}
+
+    return result
+
+
+# Returns collected counters and clears them. Used to pass counters of worker processes to the main one.
+def collect():
+    if not enabled:
+        return None
+
+    with counters_lock:
+        items = list(counters.items())
+        counters.clear()
+
+    return [(operation, operations, calls, seconds) for (_, operation), (operations, calls, seconds) in items]
+
+
+# Adds counters returned by collect to the current stage.
+def merge(collected):
+    if collected is None:
+        return
+
+    for operation, operations, calls, seconds in collected:
+        record(operation, operations, calls, seconds)
+
+
+# Returns collected counters in the Prometheus text format.
+def prometheus_text():
+    families = [
+        ('operations_total', 'count', 'Number of values processed by the operation.'),
+        ('calls_total', 'calls', 'Number of calls of the operation.'),
+        ('seconds_total', 'seconds', 'Time spent in the operation.'),
+    ]
+
+    counters_snapshot = snapshot()
+    lines = []
+    for metric, field, description in families:
+        lines.append(f'# HELP {METRIC_PREFIX}_{metric} {description}')
+        lines.append(f'# TYPE {METRIC_PREFIX}_{metric} counter')
+        for stage_name, operations in counters_snapshot.items():
+            for operation, counter in operations.items():
+                lines.append(f'{METRIC_PREFIX}_{metric}{{stage="{stage_name}",operation="{operation}"}} {counter[field]}')
+
+    return '\n'.join(lines) + '\n'
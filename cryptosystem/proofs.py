@@ -0,0 +1,214 @@
+# Non-interactive proofs that an encrypted ballot is valid:
+# 1. Every cell encrypts 0 or 1.
+# 2. Every row encrypts sum 1, and for square ballots every column as well, since they are permutation matrices.
+#
+# All statements reduce to proving that some u is an n-th residue modulo n^2, i.e. u = r^n for r known to the
+# prover: a cell c encrypting m gives u = c / g^m = r^n, a row with product C gives u = C / g = (product of r)^n.
+# The proof of knowledge of r is a Sigma protocol: commitment a = rho^n, challenge e, response z = rho * r^e,
+# and the verifier checks z^n = a * u^e. Cells use the OR composition of two such proofs, one of them simulated.
+# Challenges are derived by hashing the statement and commitments (Fiat-Shamir).
+#
+# Verifier checks equations of many ballots at once: every equation is raised to a small random weight and
+# all of them are multiplied together, so only one exponentiation to the power n is needed for the batch.
+# A batch with an invalid equation passes with probability about 2^-BATCH_SECURITY.
+
+import hashlib
+import secrets
+from math import gcd
+
+from cryptosystem.cryptosystem_utils import *
+
+# Bit length of random weights of the batch verification.
+BATCH_SECURITY = 40
+
+# Challenges are at most this long. They must be shorter than the prime factors of n for the proofs to be sound.
+MAX_CHALLENGE_BITS = 128
+
+
+class ProofError(Exception):
+    pass
+
+
+# Returns bit length of challenges for the key.
+def challenge_bits(n):
+    return min(MAX_CHALLENGE_BITS, n.bit_length() // 2 - 1)
+
+
+# Derives challenge from the values by hashing them.
+def challenge(n, *values):
+    digest = hashlib.sha256()
+    for value in values:
+        data = value if isinstance(value, bytes) else str(value).encode('utf-8')
+        digest.update(len(data).to_bytes(4, 'big') + data)
+
+    return int.from_bytes(digest.digest(), 'big') % (1 << challenge_bits(n))
+
+
+# Returns digest of the ciphertexts of the ballot. Every challenge depends on it, so proofs can not be moved
+# from one ballot to another.
+def ballot_digest(ciphertexts):
+    return hashlib.sha256(','.join(str(c) for row in ciphertexts for c in row).encode('utf-8')).digest()
+
+
+# Returns inverse of g modulo n^2. Ciphertext of 1 multiplied by it is an n-th residue.
+def g_inverse(public_key):
+    return invmod(public_key[1], public_key[0] * public_key[0])
+
+
+# Returns ciphertexts of sums of the rows and, for square ballots, of the columns.
+def line_products(ciphertexts, modulo):
+    rows, cols = len(ciphertexts), len(ciphertexts[0])
+    lines = [[ciphertexts[i][j] for j in range(cols)] for i in range(rows)]
+    if rows == cols:
+        lines += [[ciphertexts[i][j] for i in range(rows)] for j in range(cols)]
+
+    products = []
+    for line in lines:
+        product = 1
+        for value in line:
+            product = (product * value) % modulo
+        products.append(product)
+
+    return products
+
+
+# Proves that the cell encrypts the bit, given randomness r used for its encryption.
+# Returns (a0, a1, e0, z0, z1), challenge of the second branch is e - e0.
+def prove_cell(ciphertext, bit, r, public_key, context):
+    n = public_key[0]
+    modulo = n * n
+    bits = challenge_bits(n)
+    us = [ciphertext, (ciphertext * g_inverse(public_key)) % modulo]
+
+    # Branch of the other bit is simulated: response and challenge are picked first, commitment is derived.
+    other = 1 - bit
+    es, zs, commitments = [0, 0], [0, 0], [0, 0]
+    es[other] = secrets.randbits(bits)
+    zs[other] = generate_coprime(n)
+    commitments[other] = (powmod(zs[other], n, modulo) * invmod(powmod(us[other], es[other], modulo), modulo)) % modulo
+
+    rho = generate_coprime(n)
+    commitments[bit] = powmod(rho, n, modulo)
+
+    e = challenge(n, context, ciphertext, commitments[0], commitments[1])
+    es[bit] = (e - es[other]) % (1 << bits)
+    zs[bit] = (rho * powmod(r, es[bit], n)) % n
+
+    return commitments[0], commitments[1], es[0], zs[0], zs[1]
+
+
+# Proves that u = r^n. Returns (a, z).
+def prove_residue(u, r, public_key, context):
+    n = public_key[0]
+    rho = generate_coprime(n)
+    a = powmod(rho, n, n * n)
+    e = challenge(n, context, u, a)
+    return a, (rho * powmod(r, e, n)) % n
+
+
+# Proves that the ballot is valid. Matrix holds plain bits, ciphertexts and randomness are the ones used to
+# encrypt them. Returns (cell proofs, line proofs), cell proofs are listed row by row.
+def prove_ballot(matrix, ciphertexts, randomness, public_key):
+    n = public_key[0]
+    digest = ballot_digest(ciphertexts)
+    rows, cols = len(matrix), len(matrix[0])
+
+    cell_proofs = [prove_cell(ciphertexts[i][j], matrix[i][j], randomness[i][j], public_key, (digest, i, j))
+                   for i in range(rows) for j in range(cols)]
+
+    modulo = n * n
+    inverse = g_inverse(public_key)
+    line_randomness = line_products(randomness, n)
+    line_proofs = [prove_residue((product * inverse) % modulo, line_randomness[k], public_key, (digest, k))
+                   for k, product in enumerate(line_products(ciphertexts, modulo))]
+
+    return cell_proofs, line_proofs
+
+
+# Encrypts the matrix and proves that it is a valid ballot. Returns (encrypted matrix, proof).
+def encrypt_ballot(matrix, encryptor):
+    ciphertexts, randomness = [], []
+    for row in matrix:
+        encrypted_row, row_randomness = encryptor.encrypt_many_with_randomness(row)
+        ciphertexts.append(encrypted_row)
+        randomness.append(row_randomness)
+
+    return ciphertexts, prove_ballot(matrix, ciphertexts, randomness, encryptor.public_key)
+
+
+# Checks the structure of the proof and returns equations (z, a, u, e) meaning z^n = a * u^e that hold if the
+# proof is valid. Raises ProofError if the proof is malformed.
+def ballot_equations(ciphertexts, proof, public_key):
+    n = public_key[0]
+    modulo = n * n
+    bits = challenge_bits(n)
+    inverse = g_inverse(public_key)
+    digest = ballot_digest(ciphertexts)
+    rows, cols = len(ciphertexts), len(ciphertexts[0]) if len(ciphertexts) > 0 else 0
+
+    cell_proofs, line_proofs = proof
+    products = line_products(ciphertexts, modulo) if rows > 0 else []
+    if len(cell_proofs) != rows * cols or len(line_proofs) != len(products):
+        raise ProofError('Proof does not match the shape of the ballot')
+
+    equations = []
+    for k, (a0, a1, e0, z0, z1) in enumerate(cell_proofs):
+        i, j = divmod(k, cols)
+        c = ciphertexts[i][j]
+        if e0 >= (1 << bits):
+            raise ProofError('Challenge is out of range')
+
+        e1 = (challenge(n, (digest, i, j), c, a0, a1) - e0) % (1 << bits)
+        equations.append((z0, a0, c, e0))
+        equations.append((z1, a1, (c * inverse) % modulo, e1))
+
+    for k, ((a, z), product) in enumerate(zip(line_proofs, products)):
+        u = (product * inverse) % modulo
+        equations.append((z, a, u, challenge(n, (digest, k), u, a)))
+
+    return equations
+
+
+# Checks all equations (z, a, u, e) at once with random weights w: product of z^w to the power n must be equal
+# to product of a^w * u^(e * w). All values must be invertible modulo n.
+def verify_equations(equations, n):
+    modulo = n * n
+
+    values = 1
+    for z, a, u, e in equations:
+        if not (0 < z < modulo and 0 < a < modulo and 0 < u < modulo):
+            return False
+        values = (values * z * a * u) % n
+    if gcd(values, n) != 1:
+        return False
+
+    left, right = 1, 1
+    for z, a, u, e in equations:
+        w = secrets.randbits(BATCH_SECURITY) | 1
+        left = (left * powmod(z, w, modulo)) % modulo
+        right = (right * powmod(a, w, modulo) * powmod(u, e * w, modulo)) % modulo
+
+    return powmod(left, n, modulo) == right
+
+
+# Verifies proofs of many ballots, given as (ciphertexts, proof) pairs, in one batch check.
+# If the batch check fails, ballots are checked one by one to find invalid ones. Returns validity of every ballot.
+def verify_ballots(ballots, public_key):
+    n = public_key[0]
+
+    equations = []
+    for ciphertexts, proof in ballots:
+        try:
+            equations.append(ballot_equations(ciphertexts, proof, public_key))
+        except (ProofError, ValueError, TypeError):
+            equations.append(None)
+
+    if None not in equations and verify_equations([e for ballot in equations for e in ballot], n):
+        return [True] * len(ballots)
+
+    return [ballot is not None and verify_equations(ballot, n) for ballot in equations]
+
+
+# Verifies proof of a single ballot.
+def verify_ballot(ciphertexts, proof, public_key):
+    return verify_ballots([(ciphertexts, proof)], public_key)[0]
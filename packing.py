@@ -0,0 +1,73 @@
+# Packed ballots: the whole grade matrix is written into slots of a single plaintext and encrypted once.
+# Cell (i, j) of a matrix with cols columns occupies slot i * cols + j, every slot is slot_width bits wide.
+# Multiplying packed ciphertexts adds the matrices slot by slot, as long as no slot overflows, so slot width is
+# chosen for the maximum number of voters. Accumulated packed ballots are unpacked into one ciphertext per cell
+# only once, before aggregation.
+#
+# Packed ballots can not be validated: a slot value out of range carries into the neighbouring cells and
+# corrupts tallies of other candidates without any error, and there are no validity proofs for them.
+# So they are accepted only by deployments that explicitly trust their clients, e.g. polling station kiosks.
+
+import numpy as np
+
+from cryptosystem.cryptosystem_utils import powmod_many
+from cryptosystem.encrypted_routine import STATISTICAL_SECURITY, bit_width
+
+# Number of voters packed ballots are sized for by default.
+DEFAULT_MAX_VOTERS = (1 << 20) - 1
+
+
+# Returns width of the slot that holds any count of votes up to max_voters.
+def slot_width(max_voters=DEFAULT_MAX_VOTERS):
+    return bit_width(max_voters)
+
+
+# Returns number of bits taken by a packed matrix.
+def packed_width(rows, cols, width):
+    return rows * cols * width
+
+
+# Checks that packed matrices fit into plaintexts modulo n and can be unpacked by bounded bit extraction.
+def can_pack(n, rows, cols, width):
+    return packed_width(rows, cols, width) + STATISTICAL_SECURITY + 1 < n.bit_length()
+
+
+# Packs matrix of non-negative integers smaller than 2^width into a single integer.
+def pack(matrix, width):
+    value = 0
+    for slot, cell in enumerate(cell for row in matrix for cell in row):
+        if not 0 <= cell < (1 << width):
+            raise Exception(f'Value {cell} does not fit into slot of {width} bits')
+        value |= cell << (slot * width)
+
+    return value
+
+
+# Unpacks integer packed by pack into matrix with the given shape.
+def unpack(value, rows, cols, width):
+    mask = (1 << width) - 1
+    return [[(value >> ((i * cols + j) * width)) & mask for j in range(cols)] for i in range(rows)]
+
+
+# Encrypts matrix as a single packed ciphertext.
+def encrypt_packed(matrix, encryptor, width):
+    if not can_pack(encryptor.public_key[0], len(matrix), len(matrix[0]), width):
+        raise Exception(f'Matrix of {len(matrix)}x{len(matrix[0])} slots of {width} bits does not fit into the key')
+
+    return encryptor.encrypt(pack(matrix, width))
+
+
+# Combines encrypted bits of a packed value into encrypted values of the slots, without decryption.
+# Value of slot is sum(bit_i * 2^i), which is the product of E(bit_i)^(2^i).
+def unpack_encrypted(encrypted_bits, slots, width, modulo):
+    weights = np.array([1 << i for i in range(width)], dtype=object)
+
+    values = []
+    for slot in range(slots):
+        bits = np.array(encrypted_bits[slot * width:(slot + 1) * width], dtype=object)
+        value = 1
+        for power in powmod_many(bits, weights, modulo):
+            value = (value * power) % modulo
+        values.append(value)
+
+    return values
@@ -0,0 +1,426 @@
+# Binary wire format used alongside the text KEY/DATA/NAMES protocol.
+# Every message is a frame: header (version, frame type, payload length) followed by the payload.
+# Integers are written as fixed width big-endian byte strings, so no decimal conversion is needed.
+
+import hashlib
+import struct
+
+PROTOCOL_VERSION = 1
+
+# Client sends this text request to switch the connection to binary frames.
+BINARY_KEY_REQUEST = b"BKEY\n"
+
+# Client sends this text request to open a persistent session of binary frames.
+# Server confirms the session with a status frame, then answers request frames until the close frame.
+SESSION_REQUEST = b"SESSION\n"
+
+# Overloaded server answers text requests with this line followed by the number of seconds to wait before
+# retrying. Binary requests are answered with the busy frame instead.
+BUSY_RESPONSE = b"BUSY\n"
+
+# Text ballot may start with this line followed by the voter credential token.
+CREDENTIAL_LINE = "TOKEN "
+
+# Frame types.
+FRAME_KEY = 1
+FRAME_BALLOT = 2
+FRAME_STATUS = 3
+FRAME_NAMES = 4
+FRAME_BATCH = 5
+FRAME_BATCH_STATUS = 6
+FRAME_CLOSE = 7
+FRAME_TALLY = 8
+FRAME_PACKED_BALLOT = 9
+FRAME_PROVEN_BALLOT = 10
+FRAME_PROVEN_BATCH = 11
+FRAME_CREDENTIAL_BALLOT = 12
+FRAME_BUSY = 13
+
+# Status codes sent in the status frame.
+STATUS_SUCCESS = 0
+STATUS_ERROR = 1
+
+# Frame header is version (1 byte), frame type (1 byte) and payload length (4 bytes).
+HEADER = struct.Struct('>BBI')
+
+# Key payload header is the width of key components in bytes.
+KEY_HEADER = struct.Struct('>H')
+
+# Matrix payload header is number of rows, number of columns and width of every value in bytes.
+MATRIX_HEADER = struct.Struct('>HHH')
+
+STATUS = struct.Struct('>B')
+
+# Busy payload is the number of milliseconds to wait before retrying.
+BUSY = struct.Struct('>I')
+
+# Batch payload header is number of ballots, every ballot is prefixed by its length.
+BATCH_HEADER = struct.Struct('>H')
+BATCH_ITEM_HEADER = struct.Struct('>I')
+
+# Packed ballot payload header is number of rows, number of columns and slot width in bits, followed by
+# the ciphertext.
+PACKED_HEADER = struct.Struct('>HHB')
+
+# Proof payload header is number of cell proofs, number of line proofs and width of every value in bytes.
+# Cell proof is (a0, a1, e0, z0, z1), line proof is (a, z).
+PROOF_HEADER = struct.Struct('>HHH')
+CELL_PROOF_SIZE = 5
+LINE_PROOF_SIZE = 2
+
+# Credential ballot payload header is length of the voter token and frame type of the ballot, followed by
+# the token and payload of the ballot frame.
+CREDENTIAL_HEADER = struct.Struct('>HB')
+
+# Tally payload header is number of ballots, fingerprint of the public key and number of shard ids, followed by
+# the shard ids and the matrix.
+TALLY_HEADER = struct.Struct('>Q8sH')
+TALLY_SHARD_SIZE = 16
+
+# Frames with larger payload are rejected without reading them.
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Raised when the server is overloaded and rejects the request. Retry after is in seconds.
+class ServerBusy(Exception):
+
+    # Constructor.
+    def __init__(self, retry_after):
+        super().__init__(f'Server is busy, retry after {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+# Returns number of bytes needed to write any value modulo n^2.
+def ciphertext_width(n):
+    return ((n * n).bit_length() + 7) // 8
+
+
+# Builds frame of the given type.
+def encode_frame(frame_type, payload):
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, len(payload)) + payload
+
+
+# Parses frame header. Returns (frame type, payload length).
+def decode_header(header):
+    version, frame_type, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f'Unsupported protocol version: {version}')
+    if length > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f'Frame payload is too large: {length} bytes')
+
+    return frame_type, length
+
+
+# Checks that the frame has expected type. Raises ServerBusy if the server answered with the busy frame.
+def expect_frame(frame, frame_type):
+    if frame[0] == FRAME_BUSY and frame_type != FRAME_BUSY:
+        raise ServerBusy(decode_busy(frame[1]))
+    if frame[0] != frame_type:
+        raise ProtocolError(f'Expected frame of type {frame_type}, received {frame[0]}')
+
+    return frame[1]
+
+
+# Encodes busy payload. Retry after is in seconds.
+def encode_busy(retry_after):
+    return BUSY.pack(int(retry_after * 1000))
+
+
+# Decodes busy payload. Returns retry after in seconds.
+def decode_busy(payload):
+    if len(payload) != BUSY.size:
+        raise ProtocolError('Busy payload has wrong length')
+    return BUSY.unpack(payload)[0] / 1000
+
+
+# Encodes busy response to a text request.
+def encode_busy_text(retry_after):
+    return BUSY_RESPONSE + f'{retry_after}\n'.encode('utf-8')
+
+
+# Raises ServerBusy if the text response is the busy response.
+def check_busy_text(response):
+    if response.startswith(BUSY_RESPONSE):
+        try:
+            retry_after = float(response[len(BUSY_RESPONSE):].split(b'\n')[0])
+        except ValueError:
+            raise ProtocolError('Busy response is malformed')
+        raise ServerBusy(retry_after)
+
+
+# Encodes public key (n, g).
+def encode_key(public_key):
+    width = (max(public_key).bit_length() + 7) // 8
+    return KEY_HEADER.pack(width) + b''.join(k.to_bytes(width, 'big') for k in public_key)
+
+
+# Decodes public key (n, g).
+def decode_key(payload):
+    if len(payload) < KEY_HEADER.size:
+        raise ProtocolError('Key payload is truncated')
+
+    width, = KEY_HEADER.unpack_from(payload)
+    if len(payload) != KEY_HEADER.size + 2 * width:
+        raise ProtocolError('Key payload has wrong length')
+
+    offset = KEY_HEADER.size
+    return [int.from_bytes(payload[offset + i * width:offset + (i + 1) * width], 'big') for i in range(2)]
+
+
+# Encodes matrix of non-negative integers each written with width bytes.
+def encode_matrix(matrix, width):
+    rows, cols = len(matrix), len(matrix[0]) if len(matrix) > 0 else 0
+    values = bytearray(MATRIX_HEADER.pack(rows, cols, width))
+    for row in matrix:
+        if len(row) != cols:
+            raise ProtocolError('Matrix rows have different lengths')
+        for value in row:
+            values += int(value).to_bytes(width, 'big')
+
+    return bytes(values)
+
+
+# Decodes matrix encoded by encode_matrix. Returns list of rows.
+def decode_matrix(payload):
+    payload = memoryview(payload)
+    if len(payload) < MATRIX_HEADER.size:
+        raise ProtocolError('Matrix payload is truncated')
+
+    rows, cols, width = MATRIX_HEADER.unpack_from(payload)
+    if len(payload) != MATRIX_HEADER.size + rows * cols * width:
+        raise ProtocolError('Matrix payload has wrong length')
+
+    offset = MATRIX_HEADER.size
+    matrix = []
+    for i in range(rows):
+        row = []
+        for j in range(cols):
+            row.append(int.from_bytes(payload[offset:offset + width], 'big'))
+            offset += width
+        matrix.append(row)
+
+    return matrix
+
+
+# Encodes ballot packed into a single ciphertext.
+def encode_packed_ballot(rows, cols, slot_width, ciphertext, width):
+    return PACKED_HEADER.pack(rows, cols, slot_width) + ciphertext.to_bytes(width, 'big')
+
+
+# Decodes packed ballot. Returns (rows, cols, slot width, ciphertext).
+def decode_packed_ballot(payload):
+    payload = memoryview(payload)
+    if len(payload) <= PACKED_HEADER.size:
+        raise ProtocolError('Packed ballot payload is truncated')
+
+    rows, cols, slot_width = PACKED_HEADER.unpack_from(payload)
+    return rows, cols, slot_width, int.from_bytes(payload[PACKED_HEADER.size:], 'big')
+
+
+# Encodes ballot frame together with the voter credential token.
+def encode_credential_ballot(token, frame_type, payload):
+    token = token.encode('utf-8')
+    return CREDENTIAL_HEADER.pack(len(token), frame_type) + token + payload
+
+
+# Decodes credential ballot. Returns (token, ballot frame) where ballot frame is (frame type, payload).
+def decode_credential_ballot(payload):
+    payload = memoryview(payload)
+    if len(payload) < CREDENTIAL_HEADER.size:
+        raise ProtocolError('Credential ballot payload is truncated')
+
+    length, frame_type = CREDENTIAL_HEADER.unpack_from(payload)
+    offset = CREDENTIAL_HEADER.size
+    if offset + length > len(payload):
+        raise ProtocolError('Credential ballot payload is truncated')
+
+    try:
+        token = bytes(payload[offset:offset + length]).decode('utf-8')
+    except UnicodeDecodeError:
+        raise ProtocolError('Voter token is not valid UTF-8')
+
+    return token, (frame_type, payload[offset + length:])
+
+
+# Encodes proof of ballot validity created by cryptosystem.proofs.
+def encode_proof(proof, width):
+    cell_proofs, line_proofs = proof
+    values = bytearray(PROOF_HEADER.pack(len(cell_proofs), len(line_proofs), width))
+    for value in (value for values in cell_proofs + line_proofs for value in values):
+        values += int(value).to_bytes(width, 'big')
+
+    return bytes(values)
+
+
+# Decodes proof of ballot validity. Returns (cell proofs, line proofs).
+def decode_proof(payload):
+    payload = memoryview(payload)
+    if len(payload) < PROOF_HEADER.size:
+        raise ProtocolError('Proof payload is truncated')
+
+    cells, lines, width = PROOF_HEADER.unpack_from(payload)
+    if len(payload) != PROOF_HEADER.size + (cells * CELL_PROOF_SIZE + lines * LINE_PROOF_SIZE) * width:
+        raise ProtocolError('Proof payload has wrong length')
+
+    offset = PROOF_HEADER.size
+    values = [int.from_bytes(payload[offset + i * width:offset + (i + 1) * width], 'big')
+              for i in range(cells * CELL_PROOF_SIZE + lines * LINE_PROOF_SIZE)]
+    cell_values = values[:cells * CELL_PROOF_SIZE]
+    line_values = values[cells * CELL_PROOF_SIZE:]
+
+    return ([tuple(cell_values[i:i + CELL_PROOF_SIZE]) for i in range(0, len(cell_values), CELL_PROOF_SIZE)],
+            [tuple(line_values[i:i + LINE_PROOF_SIZE]) for i in range(0, len(line_values), LINE_PROOF_SIZE)])
+
+
+# Encodes ballot with proof of its validity: length of the matrix payload, matrix payload and proof payload.
+def encode_proven_ballot(matrix_payload, proof_payload):
+    return BATCH_ITEM_HEADER.pack(len(matrix_payload)) + matrix_payload + proof_payload
+
+
+# Decodes ballot with proof of its validity. Returns (matrix payload, proof payload).
+def decode_proven_ballot(payload):
+    payload = memoryview(payload)
+    if len(payload) < BATCH_ITEM_HEADER.size:
+        raise ProtocolError('Proven ballot payload is truncated')
+
+    length, = BATCH_ITEM_HEADER.unpack_from(payload)
+    offset = BATCH_ITEM_HEADER.size
+    if offset + length > len(payload):
+        raise ProtocolError('Proven ballot payload is truncated')
+
+    return payload[offset:offset + length], payload[offset + length:]
+
+
+# Returns short fingerprint of the public key, used to check that tallies are encrypted with the same key.
+def key_fingerprint(public_key):
+    n = public_key[0]
+    return hashlib.sha256(n.to_bytes((n.bit_length() + 7) // 8, 'big')).digest()[:8]
+
+
+# Encodes partial tally: number of ballots, the accumulated encrypted matrix and ids of the shards included in it.
+def encode_tally(ballots, public_key, matrix, shards):
+    if any(len(shard) != TALLY_SHARD_SIZE for shard in shards):
+        raise ProtocolError('Shard id has wrong length')
+
+    header = TALLY_HEADER.pack(ballots, key_fingerprint(public_key), len(shards))
+    return header + b''.join(shards) + encode_matrix(matrix, ciphertext_width(public_key[0]))
+
+
+# Decodes partial tally. Returns (ballots, matrix, shards).
+def decode_tally(payload, public_key):
+    payload = memoryview(payload)
+    if len(payload) < TALLY_HEADER.size:
+        raise ProtocolError('Tally payload is truncated')
+
+    ballots, fingerprint, count = TALLY_HEADER.unpack_from(payload)
+    if fingerprint != key_fingerprint(public_key):
+        raise ProtocolError('Tally is encrypted with a different key')
+
+    offset = TALLY_HEADER.size + count * TALLY_SHARD_SIZE
+    if offset > len(payload):
+        raise ProtocolError('Tally payload is truncated')
+    shards = [bytes(payload[i:i + TALLY_SHARD_SIZE]) for i in range(TALLY_HEADER.size, offset, TALLY_SHARD_SIZE)]
+
+    return ballots, decode_matrix(payload[offset:]), shards
+
+
+# Encodes status frame payload.
+def encode_status(status):
+    return STATUS.pack(status)
+
+
+# Decodes status frame payload.
+def decode_status(payload):
+    if len(payload) != STATUS.size:
+        raise ProtocolError('Status payload has wrong length')
+
+    status, = STATUS.unpack(payload)
+    return status
+
+
+# Encodes list of names.
+def encode_names(names):
+    return '\n'.join(names).encode("utf-8")
+
+
+# Decodes list of names.
+def decode_names(payload):
+    try:
+        return bytes(payload).decode("utf-8").split("\n")
+    except UnicodeDecodeError:
+        raise ProtocolError('Names are not valid UTF-8')
+
+
+# Encodes batch of already encoded ballots.
+def encode_batch(payloads):
+    batch = bytearray(BATCH_HEADER.pack(len(payloads)))
+    for payload in payloads:
+        batch += BATCH_ITEM_HEADER.pack(len(payload)) + payload
+
+    return bytes(batch)
+
+
+# Decodes batch into list of encoded ballots.
+def decode_batch(payload):
+    payload = memoryview(payload)
+    if len(payload) < BATCH_HEADER.size:
+        raise ProtocolError('Batch payload is truncated')
+
+    count, = BATCH_HEADER.unpack_from(payload)
+
+    offset = BATCH_HEADER.size
+    payloads = []
+    for _ in range(count):
+        if offset + BATCH_ITEM_HEADER.size > len(payload):
+            raise ProtocolError('Batch payload is truncated')
+        length, = BATCH_ITEM_HEADER.unpack_from(payload, offset)
+        offset += BATCH_ITEM_HEADER.size
+        if offset + length > len(payload):
+            raise ProtocolError('Batch payload is truncated')
+        payloads.append(payload[offset:offset + length])
+        offset += length
+
+    if offset != len(payload):
+        raise ProtocolError('Batch payload has wrong length')
+
+    return payloads
+
+
+# Encodes statuses of ballots in the batch, one byte per ballot.
+def encode_batch_status(statuses):
+    return bytes(statuses)
+
+
+# Decodes statuses of ballots in the batch.
+def decode_batch_status(payload):
+    return list(payload)
+
+
+# Reads exactly size bytes from the socket into a preallocated buffer.
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ProtocolError('Connection closed in the middle of a frame')
+        received += count
+
+    return buffer
+
+
+# Reads one frame from the socket. Returns (frame type, payload).
+def read_frame(sock):
+    frame_type, length = decode_header(recv_exact(sock, HEADER.size))
+    return frame_type, recv_exact(sock, length)
+
+
+# Reads one frame from the asyncio stream. Returns (frame type, payload).
+async def read_frame_async(reader):
+    frame_type, length = decode_header(await reader.readexactly(HEADER.size))
+    return frame_type, await reader.readexactly(length)
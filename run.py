@@ -1,21 +1,75 @@
 from server import Server
+from client import request_tallies
+from async_server import AsyncServer
+from crypto import DEFAULT_KEY_SIZE
 from candidates import candidates, NUMBER_OF_CANDIDATES
+from cryptosystem import instrumentation
+import os
 import sys
 import signal
 
 def sigterm_handler(_bla, _te):
     server.stop()
 
-server = Server(max_seconds=20)
+# Pass --metrics to count and time hot path operations, they are served on METRICS request.
+if "--metrics" in sys.argv:
+    instrumentation.enable()
+
+# Pass --require-proofs to accept only ballots sent with proofs of their validity.
+require_proofs = "--require-proofs" in sys.argv
+
+# Pass --trust-packed-ballots to accept ballots packed into a single ciphertext. They can not be validated, so only
+# deployments that trust their clients should accept them.
+trust_packed_ballots = "--trust-packed-ballots" in sys.argv
+
+# Pass --key-size followed by bit length of the modulus n to generate keys of that size if there is no key file.
+key_size = int(sys.argv[sys.argv.index("--key-size") + 1]) if "--key-size" in sys.argv else DEFAULT_KEY_SIZE
+
+# Pass --insecure-keys to allow keys shorter than the production key sizes, for tests and development only.
+insecure_keys = "--insecure-keys" in sys.argv
+
+# Pass --async to serve all connections on a single asyncio event loop.
+server_class = AsyncServer if "--async" in sys.argv else Server
+
+# Pass --coordinator to merge partial tallies of the ingest nodes listed in LEGIT_ELECTIONS_NODES as ip:port pairs
+# separated by commas, instead of gathering votes. Nodes export their tallies only to the holder of
+# LEGIT_ELECTIONS_TALLY_TOKEN, nodes without it never export them.
+coordinator = "--coordinator" in sys.argv
+tally_token = os.environ.get("LEGIT_ELECTIONS_TALLY_TOKEN")
+
+server = server_class(max_seconds=20, key_file=os.environ.get("LEGIT_ELECTIONS_KEY_FILE"),
+                      journal_dir=os.environ.get("LEGIT_ELECTIONS_JOURNAL_DIR"), require_proofs=require_proofs,
+                      credentials_file=os.environ.get("LEGIT_ELECTIONS_CREDENTIALS_FILE"),
+                      trust_packed_ballots=trust_packed_ballots, tally_token=tally_token, key_size=key_size,
+                      insecure_keys=insecure_keys)
 signal.signal(signal.SIGTERM, sigterm_handler)
 signal.signal(signal.SIGINT, sigterm_handler)
 
+
+# Returns nodes listed in LEGIT_ELECTIONS_NODES as (ip, port).
+def shard_nodes():
+    nodes = []
+    for node in os.environ.get("LEGIT_ELECTIONS_NODES", "").split(","):
+        if node:
+            ip, port = node.rsplit(":", 1)
+            nodes.append((ip, int(port)))
+    return nodes
+
+
 if __name__ == "__main__":
-    server.run()
-    server.wait_until_done()
+    if coordinator:
+        if tally_token is None:
+            raise Exception("Coordinator needs LEGIT_ELECTIONS_TALLY_TOKEN to request tallies of the nodes")
+        for tally in request_tallies(shard_nodes(), tally_token):
+            server.crypto.merge_tally(tally)
+        print(f"Merged tallies of {server.crypto.aggregator.ballots} votes")
+    else:
+        server.run()
+        server.wait_until_done()
+        print("Finished gathering votes")
 
-    print("Finished gathering votes")
     # Some computations
     winner = server.crypto.aggregate()
     assert 0 <= winner < NUMBER_OF_CANDIDATES
     print(f'Election winner is: {candidates[winner]}')
+    server.crypto.close()
@@ -1,10 +1,15 @@
+import hmac
+import queue
 import socket
 import threading
 from datetime import timedelta, datetime
 from candidates import candidates as names
+import admission
+from protocol import *
+from cryptosystem import instrumentation
 
 # try:
-from crypto import Crypto
+from crypto import DEFAULT_KEY_SIZE, Crypto
 # except ImportError:
     # class Crypto:
 
@@ -22,18 +27,117 @@ bind_port = 9999
 
 # names = [str(i + 1) for i in range(5)]
 
+# Reads from accepted connections fail after this number of seconds without data, so that no client holds
+# a worker forever.
+CONNECTION_TIMEOUT = 30
+
+# Session is closed after this number of seconds without any frame.
+SESSION_TIMEOUT = 60
+
+# Sessions hold a worker for their whole lifetime, so at most this share of the workers is given to sessions
+# by default, and the other workers stay free for single requests.
+SESSION_WORKERS_SHARE = 0.5
+
+# Ballots are processed by at most this share of the workers at once by default, so that the other workers stay
+# free for key, names and metrics requests, and ballots over it are answered as busy instead of taking them.
+INGEST_WORKERS_SHARE = 0.5
+
+# Session frames with ballots. They are processed only if admitted to the ingest stage.
+SESSION_BALLOT_FRAMES = (FRAME_BATCH, FRAME_PACKED_BALLOT, FRAME_CREDENTIAL_BALLOT, FRAME_PROVEN_BATCH)
+
+
+# Processes session frame with ballots. Returns response frame with their statuses.
+# Malformed batch is answered with the error status, so that the session stays open.
+def process_session_ballots(crypto, frame_type, payload):
+    if frame_type in (FRAME_BATCH, FRAME_PROVEN_BATCH):
+        try:
+            payloads = decode_batch(payload)
+        except ProtocolError as e:
+            print(f"Rejected votes: {e}")
+            return encode_frame(FRAME_STATUS, encode_status(STATUS_ERROR))
+        if frame_type == FRAME_BATCH:
+            statuses = crypto.process_batch(payloads)
+        else:
+            statuses = crypto.process_proven_batch(payloads)
+        return encode_frame(FRAME_BATCH_STATUS, encode_batch_status(statuses))
+    elif frame_type == FRAME_PACKED_BALLOT:
+        return encode_frame(FRAME_STATUS, encode_status(crypto.process_packed_status(payload)))
+    else:
+        return encode_frame(FRAME_STATUS, encode_status(crypto.process_ballot_frame_status((frame_type, payload))))
+
+
+# Returns busy response to the request: busy frame to binary requests and busy line to text ones.
+def busy_response(request, retry_after):
+    if request.startswith(SESSION_REQUEST) or request.startswith(BINARY_KEY_REQUEST):
+        return encode_frame(FRAME_BUSY, encode_busy(retry_after))
+    return encode_busy_text(retry_after)
+
+
+# Sends the response if the client is still connected. Client that has gone away is not an error of the server.
+def send_quietly(client_socket, response):
+    try:
+        client_socket.sendall(response)
+    except OSError as e:
+        print(f"Client error: {e}")
+
+
+# Raises if the tally request does not carry the export token of the server. Exporting the tally unpacks packed
+# ballots under the crypto lock, so it is only served to the coordinator, and never if the server has no token.
+def check_tally_request(tally_token, payload):
+    if tally_token is None or not hmac.compare_digest(bytes(payload), tally_token.encode('utf-8')):
+        raise ProtocolError('Tally export is not authorized')
+
+
+# Returns error response to the request: error status frame to binary requests and error line to text ones.
+def error_response(request):
+    if request.startswith(SESSION_REQUEST) or request.startswith(BINARY_KEY_REQUEST):
+        return encode_frame(FRAME_STATUS, encode_status(STATUS_ERROR))
+    return Server.ERROR
+
 
 class Server:
     KEY_REQUEST = b"KEY\n"
     DATA_REQUEST = b"DATA\n"
     NAMES_REQUEST = b"NAMES\n"
+    METRICS_REQUEST = b"METRICS\n"
     SUCCESS = b"SUCCESS\n"
     ERROR = b"ERROR\n"
 
-    def __init__(self, ip_address="127.0.0.1", post=9999, backlog=5, max_seconds=5 * 60):
-        self.crypto = Crypto()
+    # Connections over workers + queue_size, sessions over max_sessions and ballots over max_ingest processed at once
+    # are answered as busy.
+    # If tally_token is provided, partial tally is exported to sessions that send it with the tally request.
+    # Keys of key_size bits are generated if key_file has none, insecure_keys allows keys shorter than production
+    # keys for tests and development.
+    def __init__(self, ip_address="127.0.0.1", post=9999, backlog=128, max_seconds=5 * 60, key_file=None,
+                 journal_dir=None, workers=16, queue_size=1024, require_proofs=False, credentials_file=None,
+                 trust_packed_ballots=False, max_ingest=None, retry_after=admission.RETRY_AFTER,
+                 connection_timeout=CONNECTION_TIMEOUT, session_timeout=SESSION_TIMEOUT, max_sessions=None,
+                 tally_token=None, key_size=DEFAULT_KEY_SIZE, insecure_keys=False):
+        self.crypto = Crypto(key_file, key_size, journal_dir=journal_dir, require_proofs=require_proofs,
+                             credentials_file=credentials_file, trust_packed_ballots=trust_packed_ballots,
+                             insecure_keys=insecure_keys)
         self.stop_signal = threading.Event()
         self.backlog = backlog
+
+        # Accepted connections wait in the queue until one of the worker threads handles them.
+        # Connections over the admission limit are answered as busy by the rejecting thread.
+        self.workers_count = workers
+        self.connections = queue.Queue()
+        self.workers = []
+        self.connection_stage = admission.AdmissionStage(admission.STAGE_CONNECTIONS, workers + queue_size, retry_after)
+        self.ingest_stage = admission.AdmissionStage(
+            admission.STAGE_INGEST, max_ingest or max(1, int(workers * INGEST_WORKERS_SHARE)), retry_after)
+        self.session_stage = admission.AdmissionStage(
+            admission.STAGE_SESSIONS, max_sessions or max(1, int(workers * SESSION_WORKERS_SHARE)), retry_after)
+        self.session_timeout = session_timeout
+        self.tally_token = tally_token
+        self.rejections = queue.Queue(maxsize=queue_size)
+        self.rejector = None
+
+        # Connections handled by the workers right now. They are shut down on stop, so that workers can be joined.
+        self.connection_timeout = connection_timeout
+        self.active_connections = set()
+        self.active_lock = threading.Lock()
         self.max_work_time = timedelta(seconds=max_seconds)
 
         self.bind_ip = ip_address
@@ -55,6 +159,8 @@ class Server:
         server.settimeout(self.listen_timeout)
         print(f"Started listening on {self.bind_ip}:{self.bind_port}")
 
+        self.start_workers()
+
         self.started = datetime.now()
         time_exceeded = False
         while self._continue() and not time_exceeded:
@@ -64,17 +170,95 @@ class Server:
                 pass
             else:
                 print(f"Accepted connection from {address[0]}:{address[1]}")
-                # client_handler = threading.Thread(
-                #     target=self.handle_client_connection,
-                #     args=(client_sock,)
-                # )
-                # client_handler.start()
-                self.handle_client_connection(client_sock)
+                self.admit_connection(client_sock)
             time_exceeded = self._time_exceeded()
 
         if time_exceeded:
             print(f"Server exceeded time limit")
 
+        server.close()
+        self.stop_workers()
+
+    def start_workers(self):
+        for _ in range(self.workers_count):
+            worker = threading.Thread(target=self.work_forever, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        self.rejector = threading.Thread(target=self.reject_forever, daemon=True)
+        self.rejector.start()
+
+    def stop_workers(self):
+        # Workers finish already queued connections before receiving the stop marker.
+        # Connections in progress, e.g. idle sessions, are shut down instead of waiting for their timeout.
+        for _ in self.workers:
+            self.connections.put(None)
+        with self.active_lock:
+            for client_socket in self.active_connections:
+                try:
+                    client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+        self.rejections.put(None)
+        self.rejector.join()
+        self.rejector = None
+
+    def admit_connection(self, client_socket):
+        if self.connection_stage.try_enter():
+            self.connections.put(client_socket)
+            return
+
+        # Busy response is sent by the rejecting thread, so that accepting never waits for slow clients.
+        # If even the rejecting thread is behind, the connection is closed and the client retries on its own.
+        try:
+            self.rejections.put_nowait(client_socket)
+        except queue.Full:
+            client_socket.close()
+
+    def work_forever(self):
+        while True:
+            client_socket = self.connections.get()
+            if client_socket is None:
+                return
+            client_socket.settimeout(self.connection_timeout)
+            with self.active_lock:
+                self.active_connections.add(client_socket)
+
+            # Errors of a single connection must not stop the worker, otherwise every bad client shrinks the pool.
+            try:
+                self.handle_client_connection(client_socket)
+            except Exception as e:
+                print(f"Server error: {e}")
+            finally:
+                with self.active_lock:
+                    self.active_connections.discard(client_socket)
+                self.connection_stage.leave()
+
+    def reject_forever(self):
+        while True:
+            client_socket = self.rejections.get()
+            if client_socket is None:
+                return
+            self.reject_connection(client_socket)
+
+    # Answers the connection as busy. Metrics are still served, so that overload can be observed.
+    def reject_connection(self, client_socket):
+        try:
+            client_socket.settimeout(self.listen_timeout)
+            request = client_socket.recv(4096)
+            if request.startswith(Server.METRICS_REQUEST):
+                self.handle_metrics_request(client_socket)
+            else:
+                client_socket.sendall(busy_response(request, self.connection_stage.retry_after))
+        except OSError as e:
+            print(f"Server error: {e}")
+        finally:
+            client_socket.close()
+
     def _continue(self):
         return not self.stop_signal.is_set()
 
@@ -100,29 +284,101 @@ class Server:
             client_socket.send(Server.ERROR)
         else:
             data = request[len(Server.DATA_REQUEST):]
-            self.crypto.process(data.decode("utf-8"))
+            with self.ingest_stage.admit():
+                self.crypto.process(data.decode("utf-8"))
+
+    def handle_binary_data_request(self, client_socket):
+        client_socket.sendall(encode_frame(FRAME_KEY, encode_key(self.crypto.public_key)))
+
+        status = STATUS_SUCCESS
+        try:
+            frame = read_frame(client_socket)
+            with self.ingest_stage.admit():
+                self.crypto.process_ballot_frame(frame)
+        except ServerBusy as e:
+            client_socket.sendall(encode_frame(FRAME_BUSY, encode_busy(e.retry_after)))
+            return
+        except Exception as e:
+            print(f"Server error: {e}")
+            status = STATUS_ERROR
+
+        client_socket.sendall(encode_frame(FRAME_STATUS, encode_status(status)))
+
+    # Handles frames of the session until it is closed by the client or stays idle for the session timeout.
+    def handle_session(self, client_socket):
+        client_socket.settimeout(self.session_timeout)
+        client_socket.sendall(encode_frame(FRAME_STATUS, encode_status(STATUS_SUCCESS)))
+
+        while True:
+            try:
+                frame_type, payload = read_frame(client_socket)
+            except socket.timeout:
+                print("Closed idle session")
+                return
+            if frame_type == FRAME_CLOSE:
+                return
+            client_socket.sendall(self.session_response(frame_type, payload))
+
+    # Returns response frame to the session frame.
+    def session_response(self, frame_type, payload):
+        if frame_type == FRAME_NAMES:
+            return encode_frame(FRAME_NAMES, encode_names(names))
+        elif frame_type == FRAME_KEY:
+            return encode_frame(FRAME_KEY, encode_key(self.crypto.public_key))
+        elif frame_type == FRAME_TALLY:
+            check_tally_request(self.tally_token, payload)
+            return encode_frame(FRAME_TALLY, self.crypto.export_tally())
+        elif frame_type in SESSION_BALLOT_FRAMES:
+            # Busy session stays open, the client may send the same frame again later.
+            try:
+                with self.ingest_stage.admit():
+                    return process_session_ballots(self.crypto, frame_type, payload)
+            except ServerBusy as e:
+                return encode_frame(FRAME_BUSY, encode_busy(e.retry_after))
+
+        raise ProtocolError(f'Unexpected frame in session: {frame_type}')
 
     def handle_name_request(self, client_socket):
         message = Server.NAMES_REQUEST + b'\n'.join([k.encode("utf-8") for k in names])
         client_socket.send(message)
 
+    def handle_metrics_request(self, client_socket):
+        text = instrumentation.prometheus_text() + admission.prometheus_text(
+            [self.connection_stage, self.session_stage, self.ingest_stage], self.crypto.queue_depths())
+        client_socket.sendall(text.encode("utf-8"))
+
     def handle_client_connection(self, client_socket):
+        request = b''
         try:
             request = client_socket.recv(4096)
             print(request)
             print(f"Received {len(request)} bytes")
-            if request.startswith(Server.KEY_REQUEST):
+            if request.startswith(SESSION_REQUEST):
+                with self.session_stage.admit():
+                    self.handle_session(client_socket)
+                return
+            elif request.startswith(BINARY_KEY_REQUEST):
+                # Binary requests report their status in a status frame.
+                self.handle_binary_data_request(client_socket)
+                return
+            elif request.startswith(Server.METRICS_REQUEST):
+                # Metrics text is the whole response, so that it may be parsed as is.
+                self.handle_metrics_request(client_socket)
+                return
+            elif request.startswith(Server.KEY_REQUEST):
                 self.handle_data_request(client_socket)
             elif request.startswith(Server.NAMES_REQUEST):
                 self.handle_name_request(client_socket)
             else:
                 print("here")
                 client_socket.send(Server.ERROR)
+        except ServerBusy as e:
+            send_quietly(client_socket, busy_response(request, e.retry_after))
         except BaseException as e:
             print(f"Server error: {e}")
             import traceback
             traceback.print_tb(e.__traceback__)
-            client_socket.send(Server.ERROR)
+            send_quietly(client_socket, error_response(request))
         else:
             print(f"Successful data transfer")
             client_socket.send(Server.SUCCESS)
@@ -0,0 +1,51 @@
+import pytest
+
+from aggregator import *
+
+keys = generate_keys()
+public_key, private_key, primes = keys[0:2], keys[2:4], keys[4:6]
+enc = Encryptor(public_key)
+dec = Decryptor(public_key, private_key, primes)
+
+ballots = [
+    [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+    [[0, 1, 0], [1, 0, 0], [0, 0, 1]],
+    [[0, 0, 1], [0, 1, 0], [1, 0, 0]],
+]
+
+
+def tally(aggregator):
+    return [dec.decrypt_many(row) for row in aggregator.matrix]
+
+
+def test_homomorphic_accumulation_matches_bitwise():
+    homomorphic = Aggregator(enc, dec, 3, 3)
+    bitwise = Aggregator(enc, dec, 3, 3, accumulation=Aggregator.BITWISE)
+    for ballot in ballots:
+        encrypted = [enc.encrypt_many(row) for row in ballot]
+        homomorphic.add_vote(encrypted)
+        bitwise.add_vote(encrypted)
+
+    expected = np.sum(np.array(ballots), axis=0).tolist()
+    assert tally(homomorphic) == tally(bitwise) == expected
+    assert homomorphic.ballots == bitwise.ballots == len(ballots)
+
+
+def test_homomorphic_tally_stays_reduced():
+    modulo = public_key[0] * public_key[0]
+    aggregator = Aggregator(enc, dec, 3, 3)
+    for _ in range(20):
+        aggregator.add_vote([enc.encrypt_many(row) for row in ballots[0]])
+
+    assert all(0 < value < modulo for row in aggregator.matrix for value in row)
+    assert tally(aggregator) == (20 * np.array(ballots[0])).tolist()
+
+
+def test_vote_of_wrong_shape_is_rejected():
+    aggregator = Aggregator(enc, dec, 3, 3)
+    with pytest.raises(Exception):
+        aggregator.add_vote([enc.encrypt_many([1, 0])] * 3)
+    with pytest.raises(Exception):
+        Aggregator(enc, dec, 3, 3, accumulation='unknown')
+
+    assert aggregator.ballots == 0
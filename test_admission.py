@@ -0,0 +1,144 @@
+import socket
+import threading
+
+import pytest
+
+import client
+from server import Server
+from admission import *
+from candidates import NUMBER_OF_CANDIDATES
+from cryptosystem.cryptosystem_setup import KEY_SIZE
+from protocol import *
+
+
+def test_stage_rejects_requests_over_limit():
+    stage = AdmissionStage(STAGE_INGEST, 2, retry_after=0.5)
+    with stage.admit():
+        with stage.admit():
+            with pytest.raises(ServerBusy) as busy:
+                with stage.admit():
+                    pass
+            assert busy.value.retry_after == 0.5
+            assert stage.depth == 2
+
+    assert (stage.depth, stage.admitted, stage.rejected) == (0, 2, 1)
+
+
+def test_busy_responses_round_trip():
+    with pytest.raises(ServerBusy) as busy:
+        expect_frame((FRAME_BUSY, encode_busy(1.5)), FRAME_STATUS)
+    assert busy.value.retry_after == 1.5
+
+    with pytest.raises(ServerBusy) as busy:
+        check_busy_text(encode_busy_text(2.0))
+    assert busy.value.retry_after == 2.0
+    check_busy_text(b"SUCCESS\n")
+
+
+def test_metrics_include_queue_depths():
+    stage = AdmissionStage(STAGE_CONNECTIONS, 3)
+    stage.try_enter()
+    text = prometheus_text([stage], {STAGE_JOURNAL: 7})
+    assert 'legit_elections_queue_depth{stage="connections"} 1' in text
+    assert 'legit_elections_queue_depth{stage="journal"} 7' in text
+    assert 'legit_elections_queue_limit{stage="connections"} 3' in text
+
+
+def busy_request():
+    raise ServerBusy(0)
+
+
+def test_client_retries_while_server_is_busy(monkeypatch):
+    delays = []
+    monkeypatch.setattr(client.time, 'sleep', delays.append)
+    responses = iter([ServerBusy(1.0), ConnectionResetError(), 'accepted'])
+
+    def request():
+        response = next(responses)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert client.with_retries(request) == 'accepted'
+    assert 1.0 <= delays[0] <= 1.5 and client.RETRY_DELAY <= delays[1] <= client.RETRY_DELAY * 1.5
+
+    with pytest.raises(ServerBusy):
+        client.with_retries(busy_request, attempts=2)
+
+
+# Accepts one binary ballot connection and drops it after the ballot is received, as if the server crashed.
+def drop_after_ballot(listener):
+    connection, _ = listener.accept()
+    with connection:
+        connection.recv(4096)
+        connection.sendall(encode_frame(FRAME_KEY, encode_key((35, 36))))
+        read_frame(connection)
+
+
+def test_client_does_not_retry_sent_ballot(monkeypatch):
+    monkeypatch.setattr(client.time, 'sleep', lambda delay: None)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    server = threading.Thread(target=drop_after_ballot, args=(listener,))
+    server.start()
+
+    voter = client.Client(server_port=listener.getsockname()[1], binary=True)
+    attempts = []
+
+    def send():
+        attempts.append(voter.request_keys())
+        return voter.send_matrix([[1, 2], [3, 4]])
+
+    try:
+        with pytest.raises(client.BallotUnconfirmed):
+            client.with_retries(send)
+    finally:
+        server.join()
+        listener.close()
+
+    assert attempts == [[35, 36]]
+
+
+# Returns number of a free local port.
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def test_server_answers_busy_over_limits():
+    port = free_port()
+    server = Server(post=port, max_seconds=60, workers=2, queue_size=0, max_sessions=2, retry_after=0.25,
+                    key_size=KEY_SIZE, insecure_keys=True)
+    server.run()
+    sessions = []
+    try:
+        assert server.ingest_stage.limit < server.workers_count
+
+        session = client.ClientSession(server_port=port)
+        client.with_retries(session.open)
+        sessions.append(session)
+        matrix = client.encrypt_matrix(client.votes_to_matrix(range(1, NUMBER_OF_CANDIDATES + 1)),
+                                       server.crypto.encryptor)
+
+        # Ballots over the ingest limit get the busy frame and the session stays open.
+        assert server.ingest_stage.try_enter()
+        with pytest.raises(ServerBusy) as busy:
+            session.send_matrices([matrix])
+        assert busy.value.retry_after == 0.25
+        server.ingest_stage.leave()
+        assert session.send_matrices([matrix]) == [True]
+
+        # Connections over the workers get the busy frame or the busy line.
+        sessions.append(client.ClientSession(server_port=port))
+        sessions[-1].open()
+        for binary in (True, False):
+            with pytest.raises(ServerBusy):
+                client.Client(server_port=port, binary=binary).request_keys()
+        assert server.connection_stage.rejected == 2 and server.ingest_stage.rejected == 1
+    finally:
+        for session in sessions:
+            session.close()
+        server.stop()
+        server.crypto.close()
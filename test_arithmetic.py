@@ -0,0 +1,55 @@
+from random import getrandbits
+
+from cryptosystem import arithmetic
+from cryptosystem.arithmetic import gcdex
+from cryptosystem.cryptosystem_utils import *
+
+n = generate_random_prime(64) * generate_random_prime(64)
+modulo = n * n
+
+
+def test_backends_match_reference():
+    reference = arithmetic.PythonBackend
+    values = [generate_coprime(modulo) for _ in range(20)]
+    exponents = [0, 1, 2, n, getrandbits(256)]
+
+    for name in arithmetic.available_backends():
+        backend = arithmetic.BACKENDS[name]
+        for a in values:
+            assert backend.invmod(a, modulo) == reference.invmod(a, modulo)
+            assert (a * backend.invmod(a, modulo)) % modulo == 1
+            for b in exponents:
+                assert backend.powmod(a, b, modulo) == reference.powmod(a, b, modulo)
+
+
+def test_gcdex_large_numbers():
+    a, b = getrandbits(4096), getrandbits(4096)
+    g, x, y = gcdex(a, b)
+    assert a * x + b * y == g
+    assert a % g == 0 and b % g == 0
+
+
+def test_select_backend():
+    selected = arithmetic.backend
+    try:
+        arithmetic.select_backend(arithmetic.PythonBackend.name)
+        assert powmod(3, n, modulo) == pow(3, n, modulo)
+        assert invmod(3, modulo) == arithmetic.PythonBackend.invmod(3, modulo)
+    finally:
+        arithmetic.select_backend(selected.name)
+
+
+def test_batch_invmod_matches_invmod():
+    values = [generate_coprime(modulo) for _ in range(50)]
+
+    assert batch_invmod(values, modulo) == [invmod(value, modulo) for value in values]
+    assert batch_invmod([], modulo) == []
+
+
+def test_elementwise_powmod_and_invmod():
+    values = np.array([generate_coprime(modulo) for _ in range(10)], dtype=object)
+    exponents = np.array([getrandbits(64) for _ in range(10)], dtype=object)
+
+    assert list(powmod_many(values, exponents, modulo)) == [powmod(a, b, modulo) for a, b in zip(values, exponents)]
+    assert list(powmod_many(values, 2, modulo)) == [powmod(a, 2, modulo) for a in values]
+    assert list(invmod_many(values, modulo)) == [invmod(a, modulo) for a in values]
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+import async_client
+from async_client import AsyncClient
+from async_server import AsyncServer
+from candidates import NUMBER_OF_CANDIDATES, candidates
+from client import encrypt_matrix, votes_to_matrix
+from cryptosystem.cryptosystem_setup import KEY_SIZE
+from protocol import *
+from test_admission import free_port
+
+
+def test_async_round_trip():
+    port = free_port()
+    server = AsyncServer(post=port, max_seconds=60, executor_workers=2, key_size=KEY_SIZE, insecure_keys=True)
+    server.run()
+    votes = list(range(1, NUMBER_OF_CANDIDATES + 1))
+    try:
+        assert asyncio.run(AsyncClient(server_port=port).request_names()) == candidates
+        for binary in (False, True):
+            assert asyncio.run(async_client.send_votes(votes, server_port=port, binary=binary))
+        assert server.crypto.aggregator.ballots == 2
+    finally:
+        server.stop()
+        server.crypto.close()
+
+
+# Sends the ballot, keys are requested before the ingest limit is filled.
+async def send_when_busy(server, port, binary):
+    voter = AsyncClient(server_port=port, binary=binary)
+    keys = await voter.request_keys()
+    matrix = encrypt_matrix(votes_to_matrix(range(1, NUMBER_OF_CANDIDATES + 1)), server.crypto.encryptor)
+    assert keys == list(server.crypto.public_key)
+
+    assert server.ingest_stage.try_enter()
+    try:
+        await voter.send_matrix(matrix)
+    finally:
+        server.ingest_stage.leave()
+
+
+def test_async_server_answers_busy_over_ingest_limit():
+    port = free_port()
+    server = AsyncServer(post=port, max_seconds=60, executor_workers=1, max_ingest=1, retry_after=0.25,
+                         key_size=KEY_SIZE, insecure_keys=True)
+    server.run()
+    try:
+        for binary in (False, True):
+            with pytest.raises(ServerBusy) as busy:
+                asyncio.run(send_when_busy(server, port, binary))
+            assert busy.value.retry_after == 0.25
+        assert server.ingest_stage.rejected == 2 and server.crypto.aggregator.ballots == 0
+    finally:
+        server.stop()
+        server.crypto.close()
@@ -0,0 +1,167 @@
+import errno
+import os
+
+import pytest
+
+from aggregator import *
+from ballot_journal import *
+from protocol import ProtocolError, encode_matrix, encode_tally, ciphertext_width
+
+keys = generate_keys()
+public_key, private_key, primes = keys[0:2], keys[2:4], keys[4:6]
+enc = Encryptor(public_key)
+dec = Decryptor(public_key, private_key, primes)
+width = ciphertext_width(public_key[0])
+
+ballot = [[1, 0], [0, 1]]
+
+
+def new_aggregator():
+    return Aggregator(enc, dec, 2, 2)
+
+
+def encrypted_ballot():
+    return [enc.encrypt_many(row) for row in ballot]
+
+
+# Accepts ballots the same way Crypto does: applies them and appends them to the journal.
+def accept(aggregator, journal, count):
+    for _ in range(count):
+        matrix = encrypted_ballot()
+        aggregator.add_vote(matrix)
+        journal.wait(journal.append(encode_matrix(matrix, width)))
+
+
+# Serializes the tally for a snapshot the same way Crypto does.
+def exported(aggregator):
+    ballots, matrix, shards = aggregator.export_tally()
+    return encode_tally(ballots, public_key, matrix, shards)
+
+
+def tally(aggregator):
+    return [dec.decrypt_many(row) for row in aggregator.matrix]
+
+
+def test_restore_replays_journal(tmp_path):
+    journal = BallotJournal(str(tmp_path))
+    aggregator = new_aggregator()
+    assert journal.restore(aggregator) == 0
+    accept(aggregator, journal, 3)
+    journal.close()
+
+    restored = new_aggregator()
+    assert BallotJournal(str(tmp_path)).restore(restored) == 3
+    assert tally(restored) == [[3, 0], [0, 3]]
+    assert restored.ballots == 3
+
+
+def test_restore_replays_only_tail_after_checkpoint(tmp_path):
+    journal = BallotJournal(str(tmp_path))
+    aggregator = new_aggregator()
+    journal.restore(aggregator)
+    accept(aggregator, journal, 2)
+    journal.checkpoint(exported(aggregator))
+    accept(aggregator, journal, 1)
+    journal.close()
+
+    restored = new_aggregator()
+    assert BallotJournal(str(tmp_path)).restore(restored) == 1
+    assert tally(restored) == [[3, 0], [0, 3]]
+
+
+def test_torn_record_is_dropped(tmp_path):
+    journal = BallotJournal(str(tmp_path))
+    aggregator = new_aggregator()
+    journal.restore(aggregator)
+    accept(aggregator, journal, 2)
+    journal.close()
+
+    path = os.path.join(str(tmp_path), JOURNAL_FILE)
+    with open(path, 'r+b') as journal_file:
+        journal_file.truncate(os.path.getsize(path) - 1)
+
+    restored = new_aggregator()
+    journal = BallotJournal(str(tmp_path))
+    assert journal.restore(restored) == 1
+    accept(restored, journal, 1)
+    journal.close()
+
+    restored = new_aggregator()
+    assert BallotJournal(str(tmp_path)).restore(restored) == 2
+    assert tally(restored) == [[2, 0], [0, 2]]
+
+
+def test_older_snapshot_is_skipped(tmp_path):
+    journal = BallotJournal(str(tmp_path))
+    aggregator = new_aggregator()
+    journal.restore(aggregator)
+    accept(aggregator, journal, 1)
+    older = (exported(aggregator), journal.start_checkpoint())
+    accept(aggregator, journal, 1)
+    journal.checkpoint(exported(aggregator))
+    journal.checkpoint(*older)
+    journal.close()
+
+    restored = new_aggregator()
+    assert BallotJournal(str(tmp_path)).restore(restored) == 0
+    assert tally(restored) == [[2, 0], [0, 2]]
+
+
+def test_ballot_with_invalid_value_is_not_counted(tmp_path):
+    from crypto import Crypto
+    from client import text_ballot
+
+    node = Crypto(str(tmp_path / 'keys'), KEY_SIZE, journal_dir=str(tmp_path / 'journal'), insecure_keys=True)
+    matrix = [node.encryptor.encrypt_many([1, 0, 0, 0, 0]) for _ in range(5)]
+    matrix[2][3] = -matrix[2][3]
+    with pytest.raises(ProtocolError):
+        node.process(text_ballot(matrix).decode('utf-8'))
+
+    assert node.aggregator.ballots == 0
+    assert node.journal.sequence == 0
+    node.close()
+
+
+def test_write_error_is_raised_to_waiters(tmp_path, monkeypatch):
+    journal = BallotJournal(str(tmp_path))
+    journal.restore(new_aggregator())
+
+    def full_disk(descriptor):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(os, 'fsync', full_disk)
+    sequence = journal.append(encode_matrix(encrypted_ballot(), width))
+    with pytest.raises(JournalError):
+        journal.wait(sequence)
+    with pytest.raises(JournalError):
+        journal.check()
+
+    monkeypatch.undo()
+    journal.close()
+
+
+def test_journal_is_compacted_after_snapshot(tmp_path):
+    path = os.path.join(str(tmp_path), JOURNAL_FILE)
+    journal = BallotJournal(str(tmp_path))
+    aggregator = new_aggregator()
+    journal.restore(aggregator)
+    accept(aggregator, journal, 3)
+    size = os.path.getsize(path)
+    journal.checkpoint(exported(aggregator))
+    assert os.path.getsize(path) == JOURNAL_HEADER.size
+
+    accept(aggregator, journal, 2)
+    assert os.path.getsize(path) < size
+    journal.close()
+
+    restored = new_aggregator()
+    journal = BallotJournal(str(tmp_path))
+    assert journal.restore(restored) == 2
+    accept(restored, journal, 1)
+    journal.checkpoint(exported(restored))
+    accept(restored, journal, 1)
+    journal.close()
+
+    restored = new_aggregator()
+    assert BallotJournal(str(tmp_path)).restore(restored) == 1
+    assert tally(restored) == [[7, 0], [0, 7]]
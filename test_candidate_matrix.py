@@ -0,0 +1,42 @@
+import pytest
+
+from aggregator import *
+
+keys = generate_keys()
+enc = Encryptor(keys[0:2])
+dec = Decryptor(keys[0:2], keys[2:4], keys[4:6])
+
+ballots = [
+    [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]],
+    [[0, 1, 0, 0], [1, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]],
+    [[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]],
+    [[0, 0, 0, 1], [0, 1, 0, 0], [1, 0, 0, 0], [0, 0, 1, 0]],
+    [[1, 0, 0, 0], [0, 0, 0, 1], [0, 1, 0, 0], [0, 0, 1, 0]],
+]
+
+
+# Returns aggregator with all ballots added.
+def aggregated(extraction):
+    a = Aggregator(enc, dec, 4, 4, extraction=extraction)
+    for ballot in ballots:
+        a.add_vote([enc.encrypt_many(row) for row in ballot])
+    return a
+
+
+def test_prefix_sums():
+    a = aggregated(Aggregator.FULL)
+    expected = np.sum(np.array(ballots), axis=0).tolist()
+
+    for i, row in enumerate(a.matrix):
+        assert dec.decrypt_many(a.prefix_sums(row)) == [sum(expected[i][:j]) for j in range(len(row) + 1)]
+
+
+# Cell j of the candidate matrix is 1 if the row total is greater than the doubled sum of the first j values.
+@pytest.mark.parametrize('extraction', [Aggregator.FULL, Aggregator.BOUNDED])
+def test_candidate_matrix(extraction):
+    a = aggregated(extraction)
+    expected = [[int(sum(row) > 2 * sum(row[:j])) for j in range(len(row))]
+                for row in np.sum(np.array(ballots), axis=0).tolist()]
+
+    c = a.create_candidate_matrix(a.matrix)
+    assert [dec.decrypt_many(row) for row in c] == expected
@@ -0,0 +1,112 @@
+import os
+
+import pytest
+
+from aggregator import *
+from ballot_journal import *
+from credentials import *
+from protocol import *
+
+keys = generate_keys()
+enc = Encryptor(keys[0:2])
+dec = Decryptor(keys[0:2], keys[2:4], keys[4:6])
+
+tokens = [f'voter-{i}' for i in range(1000)]
+
+
+def new_registry(tmp_path):
+    path = str(tmp_path / 'registry.bin')
+    assert build_registry(path, tokens + tokens[:10]) == len(tokens)
+    return CredentialRegistry(path)
+
+
+def test_eligible_tokens_are_found(tmp_path):
+    registry = new_registry(tmp_path)
+    assert all(registry.is_eligible(token_digest(token)) for token in tokens)
+    assert not any(registry.is_eligible(token_digest(f'intruder-{i}')) for i in range(1000))
+    registry.close()
+
+
+def test_token_votes_once(tmp_path):
+    registry = new_registry(tmp_path)
+    digest = registry.claim(tokens[0])
+    with pytest.raises(CredentialError, match='already been used'):
+        registry.claim(tokens[0])
+    with pytest.raises(CredentialError, match='not eligible'):
+        registry.claim('intruder')
+
+    # Token of a rejected ballot may be used again.
+    registry.release(digest)
+    assert registry.claim(tokens[0]) == digest
+    registry.close()
+
+
+def test_used_tokens_are_loaded_without_torn_digest(tmp_path):
+    path = str(tmp_path / 'used.bin')
+    append_used(path, [token_digest(token) for token in tokens[:3]])
+    with open(path, 'ab') as used:
+        used.write(b'torn')
+
+    registry = new_registry(tmp_path)
+    registry.load_used(path)
+    assert registry.used_count() == 3
+    assert os.path.getsize(path) == 3 * DIGEST_SIZE
+    registry.close()
+
+
+def test_restore_marks_tokens_of_journaled_ballots(tmp_path):
+    registry = new_registry(tmp_path)
+    width = ciphertext_width(keys[0])
+    journal = BallotJournal(str(tmp_path / 'journal'))
+    journal.restore(Aggregator(enc, dec, 2, 2))
+    for token in tokens[:2]:
+        payload = encode_matrix([enc.encrypt_many(row) for row in [[1, 0], [0, 1]]], width)
+        journal.append(encode_credential_record(registry.claim(token), RECORD_BALLOT, payload), RECORD_CREDENTIAL_BALLOT)
+    journal.close()
+    registry.close()
+
+    restored = new_registry(tmp_path)
+    aggregator = Aggregator(enc, dec, 2, 2)
+    assert BallotJournal(str(tmp_path / 'journal')).restore(aggregator, restored) == 2
+    assert aggregator.ballots == 2
+    with pytest.raises(CredentialError):
+        restored.claim(tokens[1])
+    restored.claim(tokens[2])
+    restored.close()
+
+
+def test_credential_ballot_round_trip():
+    token, (frame_type, payload) = decode_credential_ballot(encode_credential_ballot('voter-1', FRAME_BALLOT, b'abc'))
+    assert (token, frame_type, bytes(payload)) == ('voter-1', FRAME_BALLOT, b'abc')
+
+
+def test_tokens_stay_used_across_restarts_and_checkpoints(tmp_path, monkeypatch):
+    import crypto
+    from client import encrypt_matrix, text_ballot, votes_to_matrix
+
+    monkeypatch.setattr(crypto, 'CHECKPOINT_INTERVAL', 4)
+    registry = str(tmp_path / 'registry.bin')
+    build_registry(registry, tokens)
+
+    def start():
+        return crypto.Crypto(str(tmp_path / 'keys'), KEY_SIZE, journal_dir=str(tmp_path / 'journal'),
+                             credentials_file=registry, insecure_keys=True)
+
+    def vote(node, token):
+        matrix = encrypt_matrix(votes_to_matrix([1, 2, 3, 4, 5]), node.encryptor)
+        node.process(text_ballot(matrix, token).decode('utf-8'))
+
+    # Tokens of the first run are replayed by the second one, which then writes a snapshot without their records.
+    for run_tokens in [tokens[:2], tokens[2:4]]:
+        node = start()
+        for token in run_tokens:
+            vote(node, token)
+        node.close()
+
+    node = start()
+    assert node.aggregator.ballots == 4
+    for token in tokens[:4]:
+        with pytest.raises(CredentialError, match='already been used'):
+            vote(node, token)
+    assert node.aggregator.ballots == 4
+    node.close()
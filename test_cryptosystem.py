@@ -0,0 +1,146 @@
+import pytest
+
+from cryptosystem.cryptosystem_setup import *
+from cryptosystem.encryption import *
+from cryptosystem.decryption import *
+from cryptosystem.encrypted_routine import *
+
+keys = generate_keys()
+public_key, private_key, primes = keys[0:2], keys[2:4], keys[4:6]
+
+messages = [0, 1, 2, 17, 12345, public_key[0] - 1]
+
+
+def test_encrypt_decrypt():
+    enc = Encryptor(public_key)
+    dec = Decryptor(public_key, private_key)
+
+    assert [dec.decrypt(enc.encrypt(m)) for m in messages] == messages
+    assert dec.decrypt_many(enc.encrypt_many(messages)) == messages
+
+
+def test_randomizer_pool():
+    enc = Encryptor(public_key, pool_size=16)
+    dec = Decryptor(public_key, private_key)
+
+    try:
+        encrypted = enc.encrypt_many(messages * 10)
+    finally:
+        enc.close()
+
+    assert dec.decrypt_many(encrypted) == messages * 10
+    assert len(set(encrypted)) == len(encrypted)
+
+
+def test_crt_decryption():
+    enc = Encryptor(public_key)
+    dec = Decryptor(public_key, private_key)
+    crt_dec = Decryptor(public_key, private_key, primes=primes)
+
+    encrypted = enc.encrypt_many(messages)
+    assert crt_dec.decrypt_many(encrypted) == dec.decrypt_many(encrypted) == messages
+
+
+def test_homomorphic_addition():
+    enc = Encryptor(public_key)
+    dec = Decryptor(public_key, private_key, primes=primes)
+    modulo = public_key[0] * public_key[0]
+
+    assert dec.decrypt((enc.encrypt(20) * enc.encrypt(22)) % modulo) == 42
+
+
+def test_save_and_load_keys(tmp_path):
+    path = str(tmp_path / 'keys.json')
+    save_keys(keys, path)
+
+    assert load_keys(path) == keys
+    assert load_or_generate_keys(path) == keys
+
+
+def test_short_keys_are_refused_unless_insecure(tmp_path):
+    from crypto import Crypto
+
+    path = str(tmp_path / 'keys.json')
+    save_keys(keys, path)
+    assert key_size_of(keys) == KEY_SIZE
+
+    # Short keys are refused whether they would be generated or loaded from the key file.
+    for key_file in (None, path):
+        with pytest.raises(Exception, match='production'):
+            Crypto(key_file, KEY_SIZE)
+    with pytest.raises(Exception, match='production'):
+        Crypto(path, PRODUCTION_KEY_SIZES[0])
+
+    node = Crypto(path, KEY_SIZE, insecure_keys=True)
+    assert node.public_key == keys[0:2]
+    node.close()
+
+
+def test_parallel_prime_generation():
+    parallel_keys = generate_keys(key_size=256, parallel=True)
+    n, g, phi, s, p, q = parallel_keys
+
+    assert p != q and p * q == n
+    assert Decryptor((n, g), (phi, s), primes=(p, q)).decrypt(Encryptor((n, g)).encrypt(42)) == 42
+
+
+def test_bounded_bit_extraction():
+    enc = Encryptor(public_key)
+    dec = Decryptor(public_key, private_key, primes)
+
+    values, bounds = [0, 1, 6, 7, 8, 1000], [0, 1, 7, 7, 16, 1000]
+    bit_arrays = bounded_bit_extraction_gate_many(enc.encrypt_many(values), bounds, enc, dec)
+
+    assert [len(bits) for bits in bit_arrays] == [1, 1, 3, 3, 5, 10]
+    assert decrypt_arrays(bit_arrays, public_key[0], dec) == values
+
+
+# Returns value of the encrypted bit array starting from the least significant bit.
+def bits_value(encrypted_bits, dec):
+    return sum(bit << i for i, bit in enumerate(dec.decrypt_many(encrypted_bits)))
+
+
+# Batched gates match plaintext results, and the single-input gates delegate to them.
+def test_batched_gates():
+    enc = Encryptor(public_key)
+    dec = Decryptor(public_key, private_key, primes)
+
+    xs, ys = [0, 1, 5, 6, 13, 200], [0, 1, 1, 0, 1, 0]
+    encrypted_xs, encrypted_ys = enc.encrypt_many(xs), enc.encrypt_many(ys)
+    products = conditional_gate_many(encrypted_xs, encrypted_ys, dec)
+    assert dec.decrypt_many(products) == [x * y for x, y in zip(xs, ys)]
+    assert dec.decrypt(conditional_gate(encrypted_xs[4], encrypted_ys[4], dec)) == 13
+
+    # Values of different bit widths are processed in one batch.
+    xs, ys = [0, 1, 6, 7, 200, 3], [0, 1, 7, 1, 100, 250]
+    bit_arrays = bit_extraction_gate_many(enc.encrypt_many(xs), enc, dec)
+    assert [bits_value(bits, dec) for bits in bit_arrays] == xs
+    assert bits_value(bit_extraction_gate(enc.encrypt(200), enc, dec), dec) == 200
+
+    pairs = [prepare_similar_arrays(convert_to_bit_array(x), convert_to_bit_array(y)) for x, y in zip(xs, ys)]
+    sums = addition_gate_many([enc.encrypt_many(x) for x, _ in pairs], [y for _, y in pairs], enc, dec)
+    assert [bits_value(bits, dec) for bits in sums] == [x + y for x, y in zip(xs, ys)]
+    assert bits_value(addition_gate(enc.encrypt_many(pairs[4][0]), pairs[4][1], enc, dec), dec) == 300
+
+    pairs = [prepare_similar_arrays(enc.encrypt_many(convert_to_bit_array(x)),
+                                    enc.encrypt_many(convert_to_bit_array(y)), enc) for x, y in zip(xs, ys)]
+    greater = greater_than_gate_many([x for x, _ in pairs], [y for _, y in pairs], enc, dec)
+    assert dec.decrypt_many(greater) == [int(x > y) for x, y in zip(xs, ys)]
+    assert dec.decrypt(greater_than_gate(pairs[4][0], pairs[4][1], enc, dec)) == 1
+
+
+def test_padded_bit_arrays():
+    enc = Encryptor(public_key)
+    dec = Decryptor(public_key, private_key, primes)
+    n = public_key[0]
+
+    # Arrays of different widths are padded into one matrix, which the batched gates accept as is.
+    xs, ys = [0, 1, 6, 7, 200, 3], [0, 1, 7, 1, 100, 250]
+    bit_arrays = bit_extraction_gate_many(enc.encrypt_many(xs), enc, dec)
+    assert decrypt_arrays(bit_arrays, n, dec) == xs
+
+    padded = pad_bit_arrays(bit_arrays + [enc.encrypt_many(convert_to_bit_array(y)) for y in ys], enc)
+    assert len({len(row) for row in padded}) == 1
+    assert decrypt_arrays(list(padded), n, dec) == xs + ys
+    greater = greater_than_gate_many(padded[:len(xs)], padded[len(xs):], enc, dec)
+    assert dec.decrypt_many(greater) == [int(x > y) for x, y in zip(xs, ys)]
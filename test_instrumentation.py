@@ -0,0 +1,51 @@
+from aggregator import *
+from cryptosystem import instrumentation
+
+keys = generate_keys()
+enc = Encryptor(keys[0:2])
+dec = Decryptor(keys[0:2], keys[2:4], keys[4:6])
+
+
+def test_disabled_instrumentation_keeps_original_functions():
+    encrypt, backend, gate = Encryptor.encrypt, arithmetic.backend, greater_than_gate_many
+
+    instrumentation.enable()
+    assert Encryptor.encrypt is not encrypt
+    instrumentation.disable()
+
+    assert Encryptor.encrypt is encrypt
+    assert arithmetic.backend is backend
+    assert greater_than_gate_many is gate
+
+
+def test_counters_are_attributed_to_stages():
+    a = Aggregator(enc, dec, 3, 3, extraction=Aggregator.BOUNDED)
+    for ballot in ([[1, 0, 0], [0, 1, 0], [0, 0, 1]], [[0, 1, 0], [1, 0, 0], [0, 0, 1]]):
+        a.add_vote([enc.encrypt_many(row) for row in ballot])
+
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        a.aggregate()
+        with instrumentation.stage('custom'):
+            dec.decrypt_many(enc.encrypt_many([1, 2, 3]))
+    finally:
+        instrumentation.disable()
+
+    snapshot = instrumentation.snapshot()
+    candidate_matrix = snapshot[instrumentation.STAGE_CANDIDATE_MATRIX]
+    assert candidate_matrix['bounded_bit_extraction_gate']['count'] == 12
+    assert candidate_matrix['greater_than_gate']['count'] == 9
+    assert candidate_matrix['powmod']['count'] > 0
+    assert instrumentation.STAGE_GRADE_VECTOR in snapshot
+    assert instrumentation.STAGE_TIEBREAK in snapshot
+    assert snapshot['custom']['encrypt']['count'] == 3
+    assert snapshot['custom']['encrypt']['calls'] == 1
+    assert snapshot['custom']['decrypt']['count'] == 3
+
+    text = instrumentation.prometheus_text()
+    assert 'legit_elections_operations_total{stage="custom",operation="decrypt"} 3' in text
+
+    # Nothing is counted once disabled.
+    dec.decrypt(enc.encrypt(1))
+    assert instrumentation.snapshot() == snapshot
@@ -0,0 +1,57 @@
+import pytest
+
+from aggregator import *
+from packing import *
+
+keys = generate_keys()
+enc = Encryptor(keys[0:2])
+dec = Decryptor(keys[0:2], keys[2:4], keys[4:6])
+
+ballots = [
+    [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+    [[0, 1, 0], [1, 0, 0], [0, 0, 1]],
+    [[0, 0, 1], [0, 1, 0], [1, 0, 0]],
+    [[1, 0, 0], [0, 0, 1], [0, 1, 0]],
+    [[0, 1, 0], [0, 1, 0], [1, 0, 0]],
+]
+
+
+def test_pack_unpack():
+    matrix = [[0, 1, 7], [3, 0, 5]]
+    assert unpack(pack(matrix, 3), 2, 3, 3) == matrix
+
+
+def test_packed_ballots_match_matrix_ballots():
+    # Slots of 2 bits hold up to 3 ballots, so accumulated ballots are unpacked once before the fourth.
+    width = slot_width(3)
+    packed = Aggregator(enc, dec, 3, 3, slot_width=width)
+    plain = Aggregator(enc, dec, 3, 3)
+    for ballot in ballots:
+        packed.add_packed_vote(encrypt_packed(ballot, enc, width), (3, 3), width)
+        plain.add_vote([enc.encrypt_many(row) for row in ballot])
+
+    assert packed.ballots == len(ballots)
+    assert packed.aggregate() == plain.aggregate()
+    assert [dec.decrypt_many(row) for row in packed.matrix] == [dec.decrypt_many(row) for row in plain.matrix]
+
+
+def test_packed_ballot_with_other_slots_is_rejected():
+    aggregator = Aggregator(enc, dec, 3, 3, slot_width=slot_width(3))
+    with pytest.raises(Exception, match='slots'):
+        aggregator.add_packed_vote(encrypt_packed(ballots[0], enc, 4), (3, 3), 4)
+
+
+def test_packed_ballots_are_rejected_unless_trusted():
+    from crypto import Crypto
+    from protocol import ciphertext_width, encode_packed_ballot
+
+    node = Crypto(key_size=KEY_SIZE, insecure_keys=True)
+    width = slot_width(3)
+    payload = encode_packed_ballot(5, 5, width, node.encryptor.encrypt(0), ciphertext_width(node.public_key[0]))
+    with pytest.raises(Exception, match='not accepted'):
+        node.process_packed(payload)
+    assert node.aggregator.ballots == 0
+    node.close()
+
+    with pytest.raises(Exception, match='validity proofs'):
+        Crypto(key_size=KEY_SIZE, require_proofs=True, trust_packed_ballots=True, insecure_keys=True)
@@ -0,0 +1,46 @@
+from cryptosystem.cryptosystem_setup import *
+from cryptosystem.encryption import *
+from cryptosystem.proofs import *
+from protocol import *
+
+keys = generate_keys()
+enc = Encryptor(keys[0:2])
+
+ballots = [
+    [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+    [[0, 1, 0], [1, 0, 0], [0, 0, 1]],
+    [[0, 0, 1], [0, 1, 0], [1, 0, 0]],
+]
+
+
+def test_valid_ballots_pass_batch_verification():
+    proven = [encrypt_ballot(ballot, enc) for ballot in ballots]
+    assert verify_ballots(proven, enc.public_key) == [True] * len(ballots)
+
+
+def test_invalid_cell_is_found_in_batch():
+    proven = [encrypt_ballot(ballot, enc) for ballot in ballots]
+
+    # Cell encrypting 7 can not be proven, so proof of an encryption of 0 is reused for it.
+    ciphertexts, proof = proven[1]
+    ciphertexts = [list(row) for row in ciphertexts]
+    ciphertexts[0][0] = enc.encrypt(7)
+    proven[1] = (ciphertexts, proof)
+
+    assert verify_ballots(proven, enc.public_key) == [True, False, True]
+
+
+def test_ballot_that_is_not_permutation_is_rejected():
+    assert not verify_ballot(*encrypt_ballot([[1, 0, 0], [1, 0, 0], [0, 0, 1]], enc), enc.public_key)
+
+
+def test_proof_of_other_ballot_is_rejected():
+    first, second = encrypt_ballot(ballots[0], enc), encrypt_ballot(ballots[1], enc)
+    assert verify_ballots([(first[0], second[1]), second], enc.public_key) == [False, True]
+
+
+def test_proof_round_trip():
+    ciphertexts, proof = encrypt_ballot(ballots[0], enc)
+    decoded = decode_proof(encode_proof(proof, ciphertext_width(keys[0])))
+    assert decoded == (list(proof[0]), list(proof[1]))
+    assert verify_ballot(ciphertexts, decoded, enc.public_key)
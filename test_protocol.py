@@ -0,0 +1,61 @@
+import socket
+
+import pytest
+
+from protocol import *
+
+n = (1 << 127) - 1
+width = ciphertext_width(n)
+matrix = [[0, 1, n * n - 1], [n, 2, 3]]
+
+
+def test_key_round_trip():
+    assert decode_key(encode_key((n, n + 1))) == [n, n + 1]
+
+
+def test_matrix_round_trip():
+    payload = encode_matrix(matrix, width)
+
+    assert len(payload) == MATRIX_HEADER.size + 6 * width
+    assert decode_matrix(payload) == matrix
+
+
+def test_truncated_matrix_is_rejected():
+    with pytest.raises(ProtocolError):
+        decode_matrix(encode_matrix(matrix, width)[:-1])
+
+
+def test_read_frame_from_socket():
+    left, right = socket.socketpair()
+    try:
+        frame = encode_frame(FRAME_BALLOT, encode_matrix(matrix, width))
+        # Send in small pieces to check that frames are reassembled.
+        for i in range(0, len(frame), 7):
+            left.sendall(frame[i:i + 7])
+
+        assert decode_matrix(expect_frame(read_frame(right), FRAME_BALLOT)) == matrix
+    finally:
+        left.close()
+        right.close()
+
+
+def test_unsupported_version_is_rejected():
+    with pytest.raises(ProtocolError):
+        decode_header(HEADER.pack(PROTOCOL_VERSION + 1, FRAME_STATUS, 1))
+
+
+def test_batch_round_trip():
+    payloads = [encode_matrix(matrix, width), b'', encode_matrix([[1]], 1)]
+    decoded = decode_batch(encode_batch(payloads))
+
+    assert [bytes(payload) for payload in decoded] == payloads
+    assert decode_matrix(decoded[0]) == matrix
+    assert decode_batch_status(encode_batch_status([STATUS_SUCCESS, STATUS_ERROR])) == [STATUS_SUCCESS, STATUS_ERROR]
+
+
+@pytest.mark.parametrize('decode', [decode_key, decode_matrix, decode_batch, decode_status, decode_packed_ballot,
+                                    decode_credential_ballot, decode_proof, decode_proven_ballot])
+def test_short_payload_is_rejected(decode):
+    for payload in (b'', b'\x01\x02'):
+        with pytest.raises(ProtocolError):
+            decode(payload)
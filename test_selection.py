@@ -0,0 +1,63 @@
+from aggregator import *
+from cryptosystem import instrumentation
+
+keys = generate_keys()
+enc = Encryptor(keys[0:2])
+dec = Decryptor(keys[0:2], keys[2:4], keys[4:6])
+
+ballots = [
+    [[1, 0, 0], [0, 1, 0], [0, 1, 0], [0, 0, 1]],
+    [[0, 1, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]],
+    [[0, 1, 0], [0, 1, 0], [1, 0, 0], [1, 0, 0]],
+    [[0, 0, 1], [0, 1, 0], [1, 0, 0], [0, 1, 0]],
+]
+
+
+# Returns aggregator with the ballots added.
+def aggregated(selection, ballots, workers=1):
+    a = Aggregator(enc, dec, len(ballots[0]), len(ballots[0][0]), selection=selection, workers=workers,
+                   extraction=Aggregator.BOUNDED)
+    for ballot in ballots:
+        a.add_vote([enc.encrypt_many(row) for row in ballot])
+
+    return a
+
+
+# Aggregates the ballots with the selection mode.
+def winner(selection, ballots, workers=1):
+    return aggregated(selection, ballots, workers).aggregate()
+
+
+def test_tournament_matches_sequential_selection():
+    for count in range(1, len(ballots) + 1):
+        assert winner(Aggregator.TOURNAMENT, ballots[:count]) == winner(Aggregator.SEQUENTIAL, ballots[:count])
+
+
+def test_tournament_keeps_earlier_of_equal_candidates():
+    assert winner(Aggregator.TOURNAMENT, [[[1, 0], [1, 0], [1, 0]]]) == 0
+
+
+def test_tiebreak_values_are_extracted_at_most_once():
+    tied = [[[1, 0], [1, 0], [1, 0], [1, 0]], [[0, 1], [0, 1], [0, 1], [0, 1]]]
+
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        assert winner(Aggregator.SEQUENTIAL, tied) == 0
+    finally:
+        instrumentation.disable()
+
+    comparison = instrumentation.snapshot()[instrumentation.STAGE_COMPARISON]
+    assert comparison['bounded_bit_extraction_gate']['count'] == 2 * len(tied[0])
+    assert comparison['greater_than_gate']['count'] == len(tied[0]) + 4 * (len(tied[0]) - 1)
+
+
+def test_parallel_aggregation_matches_serial():
+    serial, parallel = aggregated(Aggregator.TOURNAMENT, ballots), aggregated(Aggregator.TOURNAMENT, ballots, 2)
+    with parallel.parallel():
+        assert parallel.executor is not None
+        candidates = parallel.create_candidate_matrix(parallel.matrix)
+
+    expected = serial.create_candidate_matrix(serial.matrix)
+    assert [dec.decrypt_many(row) for row in candidates] == [dec.decrypt_many(row) for row in expected]
+    assert parallel.aggregate() == serial.aggregate()
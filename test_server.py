@@ -0,0 +1,114 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import client
+from candidates import NUMBER_OF_CANDIDATES
+from cryptosystem.cryptosystem_setup import KEY_SIZE
+from protocol import *
+from server import Server
+from test_admission import free_port
+
+
+# Opens a session and resets the connection, as a client that crashed does.
+def reset_session(port):
+    connection = socket.create_connection(('127.0.0.1', port))
+    connection.sendall(SESSION_REQUEST)
+    read_frame(connection)
+    connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    connection.close()
+
+
+def test_reset_connections_do_not_stop_workers():
+    port = free_port()
+    server = Server(post=port, max_seconds=60, workers=2, key_size=KEY_SIZE, insecure_keys=True)
+    server.run()
+    try:
+        client.with_retries(lambda: reset_session(port))
+        reset_session(port)
+        time.sleep(0.5)
+
+        assert all(worker.is_alive() for worker in server.workers)
+        assert client.Client(server_port=port).request_names()
+    finally:
+        server.stop()
+        server.crypto.close()
+
+
+def test_stop_does_not_wait_for_open_sessions():
+    port = free_port()
+    server = Server(post=port, max_seconds=60, workers=2, key_size=KEY_SIZE, insecure_keys=True)
+    server.run()
+    session = client.ClientSession(server_port=port)
+    client.with_retries(session.open)
+    try:
+        stopping = threading.Thread(target=server.stop)
+        stopping.start()
+        stopping.join(5)
+        assert not stopping.is_alive()
+    finally:
+        session.client.close()
+        server.crypto.close()
+
+
+def test_idle_connection_times_out():
+    port = free_port()
+    server = Server(post=port, max_seconds=60, workers=1, connection_timeout=0.5, key_size=KEY_SIZE, insecure_keys=True)
+    server.run()
+    try:
+        idle = client.with_retries(lambda: socket.create_connection(('127.0.0.1', port)))
+        idle.settimeout(5)
+        assert idle.recv(4096) == Server.ERROR
+        idle.close()
+        assert client.Client(server_port=port).request_names()
+    finally:
+        server.stop()
+        server.crypto.close()
+
+
+def test_sessions_are_limited_and_closed_when_idle():
+    port = free_port()
+    server = Server(post=port, max_seconds=60, workers=2, session_timeout=0.5, key_size=KEY_SIZE, insecure_keys=True)
+    server.run()
+    session = client.ClientSession(server_port=port)
+    try:
+        client.with_retries(session.open)
+        with pytest.raises(ServerBusy):
+            client.ClientSession(server_port=port).open()
+        assert client.Client(server_port=port).request_names()
+
+        # Idle session is closed and its place is given to the next session.
+        time.sleep(1)
+        assert session.client.recv(4096) == b''
+        with client.ClientSession(server_port=port) as other:
+            assert other.request_names()
+    finally:
+        session.client.close()
+        server.stop()
+        server.crypto.close()
+
+
+def test_tally_is_exported_only_with_token():
+    port = free_port()
+    server = Server(post=port, max_seconds=60, workers=4, max_sessions=4, tally_token='secret',
+                    key_size=KEY_SIZE, insecure_keys=True)
+    server.run()
+    try:
+        matrix = client.encrypt_matrix(client.votes_to_matrix(range(1, NUMBER_OF_CANDIDATES + 1)),
+                                       server.crypto.encryptor)
+        with client.ClientSession(server_port=port) as session:
+            assert session.send_matrices([matrix]) == [True]
+
+        for token in ('wrong', ''):
+            with client.ClientSession(server_port=port) as session:
+                with pytest.raises(ProtocolError):
+                    session.request_tally(token)
+
+        [tally] = client.request_tallies([('127.0.0.1', port)], 'secret')
+        assert decode_tally(tally, server.crypto.public_key)[0] == 1
+    finally:
+        server.stop()
+        server.crypto.close()
@@ -0,0 +1,81 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from aggregator import *
+from protocol import ProtocolError, encode_tally, decode_tally
+
+keys = generate_keys()
+public_key, private_key, primes = keys[0:2], keys[2:4], keys[4:6]
+
+ballots = [
+    [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+    [[0, 1, 0], [1, 0, 0], [0, 0, 1]],
+    [[0, 0, 1], [0, 1, 0], [1, 0, 0]],
+    [[1, 0, 0], [0, 0, 1], [0, 1, 0]],
+]
+
+
+# Accumulates ballots on a separate ingest node and exports its partial tally.
+def ingest_shard(shard_ballots):
+    enc = Encryptor(public_key)
+    dec = Decryptor(public_key, private_key, primes)
+    shard = Aggregator(enc, dec, 3, 3)
+    for ballot in shard_ballots:
+        shard.add_vote([enc.encrypt_many(row) for row in ballot])
+
+    shard_ballots, matrix, shards = shard.export_tally()
+    return encode_tally(shard_ballots, public_key, matrix, shards)
+
+
+def test_merge_shards_from_processes():
+    enc = Encryptor(public_key)
+    dec = Decryptor(public_key, private_key, primes)
+    coordinator = Aggregator(enc, dec, 3, 3)
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        for tally in executor.map(ingest_shard, [ballots[:1], ballots[1:]]):
+            coordinator.merge_tally(*decode_tally(tally, public_key))
+
+    expected = np.sum(np.array(ballots), axis=0).tolist()
+    assert [dec.decrypt_many(row) for row in coordinator.matrix] == expected
+    assert coordinator.ballots == len(ballots)
+
+
+def test_merge_tally_with_different_key():
+    other_keys = generate_keys()
+    enc = Encryptor(other_keys[0:2])
+    dec = Decryptor(other_keys[0:2], other_keys[2:4])
+
+    with pytest.raises(ProtocolError):
+        Aggregator(enc, dec, 3, 3).merge_tally(*decode_tally(ingest_shard(ballots), other_keys[0:2]))
+
+
+def test_tally_is_merged_once():
+    enc = Encryptor(public_key)
+    dec = Decryptor(public_key, private_key, primes)
+    first, second = (decode_tally(ingest_shard(ballots[:2]), public_key) for _ in range(2))
+    coordinator = Aggregator(enc, dec, 3, 3)
+    coordinator.merge_tally(*first)
+    coordinator.merge_tally(*second)
+
+    # Tally of a coordinator includes the shards merged into it.
+    other = Aggregator(enc, dec, 3, 3)
+    other.merge_tally(*coordinator.export_tally())
+    for tally in (first, second, coordinator.export_tally()):
+        with pytest.raises(Exception, match='already been merged'):
+            other.merge_tally(*tally)
+    assert other.ballots == 4
+
+
+def test_bounded_merge_checks_number_of_ballots():
+    enc = Encryptor(public_key)
+    dec = Decryptor(public_key, private_key, primes)
+    shard_ballots, matrix, shards = decode_tally(ingest_shard(ballots), public_key)
+    coordinator = Aggregator(enc, dec, 3, 3, extraction=Aggregator.BOUNDED)
+
+    for wrong in (shard_ballots - 1, shard_ballots + 1):
+        with pytest.raises(Exception, match='do not add up'):
+            coordinator.merge_tally(wrong, matrix, shards)
+    coordinator.merge_tally(shard_ballots, matrix, shards)
+    assert coordinator.ballots == len(ballots)